@@ -0,0 +1,187 @@
+# あやねるアナライザー
+# 棋譜ファイルの各局面を、複数のエンジンで並列に解析して、局面ごとの最善手・評価値・読み筋をJSONで書き出すスクリプト。(KifuAnalyzer)
+# 大量の棋譜を一晩かけて解析するような用途を想定している。
+
+# === 本スクリプトの引数の意味 ===
+
+# --engine
+# 解析に用いるエンジンの実行ファイル名
+
+# --eval
+# エンジンの評価関数のフォルダ
+
+# --home
+# エンジンなどが存在するホームディレクトリ
+
+# --hash
+# 1エンジンあたりのHashのサイズ[MB]
+
+# --thread
+# 1エンジンあたりのスレッド数
+
+# --cores
+# CPUのコア数。cores / thread 個のエンジンを並列に動かして解析する。
+
+# --kifu
+# 棋譜ファイル。1行に1局、"startpos moves ..."や"sfen ... moves ..."のような書式で書かれているものとする。
+# ayaneru-colosseum.pyの対局棋譜や、定跡ファイルをそのまま指定できる。
+
+# --start_ply , --end_ply
+# 各棋譜の何手目の局面から何手目の局面までを解析するか。0なら開始局面。
+# end_plyを省略すると棋譜の最後の局面まで。(デフォルト:0 , 最後まで)
+
+# --depth
+# 各局面を解析するときの探索深さ。(デフォルト:10)
+
+# --go
+# 指定すると--depthの代わりに、"go"コマンドのパラメーターとしてこれを用いる。例) --go "nodes 1000000"
+
+# --multipv
+# 1局面あたりに出力する読み筋の数。(デフォルト:1)
+
+# --output
+# 解析結果のファイル。省略時は"{kifu}.analysis.jsonl"。1局面解析するごとに1行追記する。
+# 中断しても(Ctrl+Cで止めても)、同じ棋譜と同じ出力ファイルで再度実行すれば、解析済みの局面は飛ばして続きから解析する。
+# 探索条件を変えて解析し直すときは、別のファイルにすること。
+
+import os
+import time
+import argparse
+import shogi.Ayane as ayane
+
+
+def AyaneruAnalyze():
+
+    # --- コマンドラインのparseここから ---
+
+    parser = argparse.ArgumentParser("ayaneru-analyze.py")
+
+    # engine path
+    parser.add_argument(
+        "--engine", type=str, default="exe/YaneuraOu.exe", help="engine path"
+    )
+
+    # eval folder
+    parser.add_argument("--eval", type=str, default="eval", help="eval folder")
+
+    # home folder
+    parser.add_argument("--home", type=str, default="", help="home folder")
+
+    # hash size
+    parser.add_argument("--hash", type=int, default=128, help="engine hash size[MB]")
+
+    # threads
+    parser.add_argument("--thread", type=int, default=1, help="number of engine threads")
+
+    # cores
+    parser.add_argument(
+        "--cores", type=int, default=8, help="cpu cores(number of logical threads)"
+    )
+
+    # kifu
+    parser.add_argument("--kifu", type=str, required=True, help="kifu filepath")
+
+    # start_ply , end_ply
+    parser.add_argument("--start_ply", type=int, default=0, help="first ply to analyze")
+    parser.add_argument("--end_ply", type=int, default=None, help="last ply to analyze")
+
+    # depth
+    parser.add_argument("--depth", type=int, default=10, help="search depth")
+
+    # go
+    parser.add_argument("--go", type=str, default=None, help="go command options")
+
+    # multipv
+    parser.add_argument("--multipv", type=int, default=1, help="multipv")
+
+    # output
+    parser.add_argument(
+        "--output", type=str, default=None, help="analysis result filepath"
+    )
+
+    args = parser.parse_args()
+
+    # --- コマンドラインのparseここまで ---
+
+    home = args.home
+    kifu_path = os.path.join(home, args.kifu)
+    output_path = (
+        os.path.join(home, args.output)
+        if args.output is not None
+        else kifu_path + ".analysis.jsonl"
+    )
+    go_options = args.go if args.go is not None else "depth {0}".format(args.depth)
+
+    print("home           : {0}".format(args.home))
+    print("engine         : {0}".format(args.engine))
+    print("eval           : {0}".format(args.eval))
+    print("hash           : {0}".format(args.hash))
+    print("thread         : {0}".format(args.thread))
+    print("cores          : {0}".format(args.cores))
+    print("kifu           : {0}".format(args.kifu))
+    print("start_ply      : {0}".format(args.start_ply))
+    print("end_ply        : {0}".format(args.end_ply))
+    print("go             : {0}".format(go_options))
+    print("multipv        : {0}".format(args.multipv))
+    print("output         : {0}".format(output_path))
+
+    analyzer = ayane.KifuAnalyzer()
+    analyzer.engine_path = os.path.join(home, args.engine)
+    analyzer.options = {
+        "Hash": str(args.hash),
+        "Threads": str(args.thread),
+        "EvalDir": os.path.join(home, args.eval),
+        "NetworkDelay": "0",
+        "NetworkDelay2": "0",
+        "MinimumThinkingTime": "0",
+        "BookFile": "no_book",
+    }
+    analyzer.parallel = max(int(args.cores / args.thread), 1)
+    analyzer.go_options = go_options
+    analyzer.multipv = args.multipv
+    analyzer.start_ply = args.start_ply
+    analyzer.end_ply = args.end_ply
+    analyzer.output_path = output_path
+
+    # 残り時間を表示するために、先に棋譜ファイルを一度読んで局面の数を数えておく。
+    with open(kifu_path, "r", encoding="utf-8") as f:
+        total = analyzer.count_positions(f)
+    print("positions      : {0}".format(total))
+
+    # 途中経過は10秒に1回だけ表示する。
+    start_time = time.time()
+    last_time = start_time
+
+    def progress(done: int, total: int):
+        nonlocal last_time
+        now = time.time()
+        if now - last_time < 10 and done != total:
+            return
+        last_time = now
+        # 残り時間は、今回解析した局面の平均から見積もる。
+        analyzed = analyzer.analyzed
+        elapsed = now - start_time
+        speed = analyzed / elapsed if elapsed > 0 else 0
+        rest = (total - done) / speed if speed > 0 else 0
+        print(
+            "analyzed {0}/{1} ({2:.1f}%) , {3:.2f} positions/s , rest {4:.0f}[s]".format(
+                done, total, done * 100 / max(total, 1), speed, rest
+            ),
+            flush=True,
+        )
+
+    try:
+        with open(kifu_path, "r", encoding="utf-8") as f:
+            analyzer.analyze(f, progress, total)
+    except KeyboardInterrupt:
+        print("interrupted. run again with the same --output to resume.")
+
+    print(
+        "analyzed {0} positions , skipped {1} positions -> {2}".format(
+            analyzer.analyzed, analyzer.skipped, output_path
+        )
+    )
+
+
+if __name__ == "__main__":
+    AyaneruAnalyze()
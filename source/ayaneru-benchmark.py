@@ -0,0 +1,267 @@
+# あやねるベンチマーク
+# 思考しないエンジン(FakeUsiEngine)を相手に対局させて、python側(UsiEngine , AyaneruServer , MultiAyaneruServer)の
+# 処理速度(1秒あたりの対局数、指し手の数、受信した行数)と、1手あたりのpython側の遅延を計測するスクリプト。
+# エンジンの思考時間(--think_time)を除いた時間を計測するので、python側の処理を変更したときに、遅くなっていないかの確認に用いる。
+
+# === 本スクリプトの引数の意味 ===
+
+# --mode
+# process : ayaneru-fake-engine.pyをエンジンのプロセスとして起動する。(本物のエンジンと同じ経路)
+# thread  : FakeUsiEngineをこのプロセス内のスレッドで動かして、socketpairでやりとりする。(プロセス間通信を除いた分)
+# (デフォルト:process)
+
+# --go
+# UsiEngineの計測で"go"を送る回数(デフォルト:2000)
+
+# --games
+# AyaneruServerの計測で対局させる数(デフォルト:20)
+
+# --slots
+# MultiAyaneruServerの計測での並列対局数。","区切りで複数指定すると、それぞれ計測する。(デフォルト:1,2,4,8)
+
+# --duration
+# MultiAyaneruServerの各並列対局数で計測する秒数(デフォルト:10)
+
+# --think_time , --info_lines , --multipv , --resign_ply
+# FakeUsiEngineの思考時間[ms]、1回の思考で出力する読み筋の数、MultiPV、投了する手数(デフォルト:0 , 5 , 1 , 100)
+
+# --transcript , --speed
+# 指定すると、FakeUsiEngineの代わりにReplayUsiEngineで、記録したやりとり(ayaneru-colosseum.py --transcript)を
+# --speed倍速で再生する。本番と同じ量とタイミングの"info"に対するpython側の処理を計測できる。
+# (--think_time , --info_lines , --multipv , --resign_ply は無視される)
+
+# --json
+# 指定したファイルに計測結果をJSONで書き出す。
+
+import os
+import time
+import json
+import argparse
+import threading
+import shogi.Ayane as ayane
+
+
+# engineを、--modeに従ってFakeUsiEngine(--transcriptが指定されていればReplayUsiEngine)に接続する。
+def connect_fake_engine(engine: ayane.UsiEngine, args):
+    if args.transcript is not None:
+        engine.set_engine_options(
+            {
+                "ReplayTranscript": os.path.abspath(args.transcript),
+                "ReplaySpeed": str(args.speed),
+            }
+        )
+        script, start_transport = "ayaneru-replay-engine.py", ayane.ReplayUsiEngine.start_transport
+    else:
+        engine.set_engine_options(
+            {
+                "FakeThinkTime": str(args.think_time),
+                "FakeInfoLines": str(args.info_lines),
+                "MultiPV": str(args.multipv),
+                "FakeResignPly": str(args.resign_ply),
+            }
+        )
+        script, start_transport = "ayaneru-fake-engine.py", ayane.FakeUsiEngine.start_transport
+
+    if args.mode == "process":
+        engine.connect(os.path.join(os.path.dirname(os.path.abspath(__file__)), script))
+    else:
+        engine.connect_transport(start_transport(), script)
+
+
+# UsiEngine単体で、"position"～"go"～"bestmove"を繰り返す。
+def benchmark_usi_engine(args) -> dict:
+    engine = ayane.UsiEngine()
+    connect_fake_engine(engine, args)
+    engine.wait_for_state(ayane.UsiEngineState.WaitCommand)
+
+    latencies = []
+    received_lines = engine.received_lines
+    start_time = time.perf_counter()
+    for _ in range(args.go):
+        engine.usi_position("startpos moves 7g7f 3c3d")
+        go_time = time.perf_counter()
+        engine.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+        latencies.append(time.perf_counter() - go_time - args.think_time / 1000)
+    elapsed = time.perf_counter() - start_time
+    lines = engine.received_lines - received_lines
+    engine.disconnect()
+
+    latencies.sort()
+    return {
+        "name": "UsiEngine",
+        "go": args.go,
+        "go_per_sec": args.go / elapsed,
+        "lines_per_sec": lines / elapsed,
+        "latency_ms": sum(latencies) / len(latencies) * 1000,
+        "latency_p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+# AyaneruServer単体で、1局ずつ対局させる。
+def benchmark_ayaneru_server(args) -> dict:
+    server = ayane.AyaneruServer()
+    for engine in server.engines:
+        connect_fake_engine(engine, args)
+    server.set_time_setting("byoyomi 100")
+
+    game_over = threading.Event()
+    server.game_over_callback = lambda _: game_over.set()
+
+    moves = 0
+    start_time = time.perf_counter()
+    for _ in range(args.games):
+        game_over.clear()
+        server.game_start()
+        game_over.wait()
+        moves += server.game_ply - 1
+    elapsed = time.perf_counter() - start_time
+    lines = sum(engine.received_lines for engine in server.engines)
+    server.terminate()
+
+    return {
+        "name": "AyaneruServer",
+        "games": args.games,
+        "games_per_sec": args.games / elapsed,
+        "moves_per_sec": moves / elapsed,
+        "lines_per_sec": lines / elapsed,
+        "latency_ms": (elapsed / max(moves, 1) - args.think_time / 1000) * 1000,
+    }
+
+
+# MultiAyaneruServerで、slots並列でduration秒間対局させる。
+def benchmark_multi_ayaneru_server(args, slots: int) -> dict:
+    server = ayane.MultiAyaneruServer()
+    server.init_server(slots)
+    for s in server.servers:
+        for engine in s.engines:
+            connect_fake_engine(engine, args)
+    server.set_time_setting("byoyomi 100")
+
+    start_time = time.perf_counter()
+    server.game_start()
+    time.sleep(args.duration)
+    # 集計済みの対局だけを数える。
+    games = server.total_games
+    kifus = list(server.game_kifus)
+    elapsed = time.perf_counter() - start_time
+    server.game_stop()
+
+    moves = sum(len(kifu.sfen.split()) - 2 for kifu in kifus)
+    return {
+        "name": "MultiAyaneruServer",
+        "slots": slots,
+        "games": games,
+        "games_per_sec": games / elapsed,
+        "moves_per_sec": moves / elapsed,
+        # 1スロットあたりの、1手にかかった時間から思考時間を除いたもの
+        "latency_ms": (elapsed * slots / max(moves, 1) - args.think_time / 1000) * 1000,
+    }
+
+
+def AyaneruBenchmark():
+    # --- コマンドラインのparseここから ---
+
+    parser = argparse.ArgumentParser("ayaneru-benchmark.py")
+
+    # mode
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="process",
+        choices=["process", "thread"],
+        help="run the fake engine as a process or a thread",
+    )
+
+    # go
+    parser.add_argument("--go", type=int, default=2000, help="number of go commands")
+
+    # games
+    parser.add_argument("--games", type=int, default=20, help="number of games")
+
+    # slots
+    parser.add_argument(
+        "--slots", type=str, default="1,2,4,8", help="comma separated parallel games"
+    )
+
+    # duration
+    parser.add_argument(
+        "--duration", type=float, default=10, help="seconds for each slots"
+    )
+
+    # fake engine options
+    parser.add_argument("--think_time", type=int, default=0, help="think time[ms]")
+    parser.add_argument("--info_lines", type=int, default=5, help="info lines per go")
+    parser.add_argument("--multipv", type=int, default=1, help="multipv")
+    parser.add_argument("--resign_ply", type=int, default=100, help="resign ply")
+
+    # transcript
+    parser.add_argument(
+        "--transcript", type=str, default=None, help="replay this transcript"
+    )
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed")
+
+    # json
+    parser.add_argument("--json", type=str, default=None, help="result json filepath")
+
+    args = parser.parse_args()
+
+    # --- コマンドラインのparseここまで ---
+
+    print("mode           : {0}".format(args.mode))
+    print("go             : {0}".format(args.go))
+    print("games          : {0}".format(args.games))
+    print("slots          : {0}".format(args.slots))
+    print("duration       : {0}".format(args.duration))
+    print("think_time     : {0}".format(args.think_time))
+    print("info_lines     : {0}".format(args.info_lines))
+    print("multipv        : {0}".format(args.multipv))
+    print("resign_ply     : {0}".format(args.resign_ply))
+    print("transcript     : {0}".format(args.transcript))
+    print("speed          : {0}".format(args.speed))
+
+    results = []
+
+    result = benchmark_usi_engine(args)
+    print(
+        "UsiEngine          : {0:.1f} go/s , {1:.1f} lines/s , latency {2:.3f}ms (p99 {3:.3f}ms)".format(
+            result["go_per_sec"],
+            result["lines_per_sec"],
+            result["latency_ms"],
+            result["latency_p99_ms"],
+        ),
+        flush=True,
+    )
+    results.append(result)
+
+    result = benchmark_ayaneru_server(args)
+    print(
+        "AyaneruServer      : {0:.2f} games/s , {1:.1f} moves/s , {2:.1f} lines/s , latency {3:.3f}ms/move".format(
+            result["games_per_sec"],
+            result["moves_per_sec"],
+            result["lines_per_sec"],
+            result["latency_ms"],
+        ),
+        flush=True,
+    )
+    results.append(result)
+
+    for slots in [int(s) for s in args.slots.split(",")]:
+        result = benchmark_multi_ayaneru_server(args, slots)
+        print(
+            "MultiAyaneruServer : {0:>3} slots , {1:.2f} games/s , {2:.1f} moves/s , latency {3:.3f}ms/move".format(
+                slots,
+                result["games_per_sec"],
+                result["moves_per_sec"],
+                result["latency_ms"],
+            ),
+            flush=True,
+        )
+        results.append(result)
+
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    AyaneruBenchmark()
@@ -0,0 +1,202 @@
+# あやねるブックフィルター
+# 定跡ファイルの開始局面をエンジンで評価して、互角に近い局面だけを残した定跡ファイルを作るスクリプト
+
+# 棋譜から作った定跡ファイルには、どちらかが大きく有利な開始局面が含まれていて、
+# そのような局面からの対局はエンジンの強さと関係なく勝敗が決まるので、対局数の無駄になり、結果のばらつきも大きくなる。
+# このスクリプトで評価値が±margin以内の局面だけを残しておき、出力したファイルを
+# ayaneru-colosseum.py , ayaneru-gate.py の --book_file に --start_gameply 0 で指定すると良い。
+
+# === 本スクリプトの引数の意味 ===
+
+# --engine
+# 局面の評価に用いるエンジンの実行ファイル名
+
+# --eval
+# エンジンの評価関数のフォルダ
+
+# --home
+# エンジンなどが存在するホームディレクトリ
+
+# --hash
+# 1エンジンあたりのHashのサイズ[MB]
+
+# --thread
+# 1エンジンあたりのスレッド数
+
+# --cores
+# CPUのコア数。cores / thread 個のエンジンを並列に動かして評価する。
+
+# --book_file
+# 定跡ファイル("startpos moves ..."や"sfen ... moves ..."のような書式で書かれているものとする)
+
+# --start_gameply
+# 定跡ファイルの開始手数。0を指定すると末尾の局面から開始。1を指定すると初期局面。
+# 対局で用いるのと同じ値を指定すること。
+
+# --depth
+# 各局面を評価するときの探索深さ。(デフォルト:10)
+
+# --margin
+# 出力する局面の評価値の絶対値の上限。(デフォルト:100)
+
+# --cache
+# 評価値のcacheファイル。省略時は、定跡ファイルと同じフォルダに"{book_file}.ply{start_gameply}.depth{depth}.score"。
+# 1局面評価するごとに追記するので、中断しても再度実行すれば続きから評価する。
+# marginを変えて出力し直すときも、評価はやり直さなくて済む。
+
+# --output
+# 出力する定跡ファイル。省略時は"{book_file}.ply{start_gameply}.depth{depth}.margin{margin}.sfen"。
+# 開始手数で打ち切った局面が出力されるので、対局時は--start_gameply 0で用いること。
+
+import os
+import time
+import argparse
+import shogi.Ayane as ayane
+
+
+def AyaneruBookFilter():
+
+    # --- コマンドラインのparseここから ---
+
+    parser = argparse.ArgumentParser("ayaneru-book-filter.py")
+
+    # engine path
+    parser.add_argument(
+        "--engine", type=str, default="exe/YaneuraOu.exe", help="engine path"
+    )
+
+    # eval folder
+    parser.add_argument("--eval", type=str, default="eval", help="eval folder")
+
+    # home folder
+    parser.add_argument("--home", type=str, default="", help="home folder")
+
+    # hash size
+    parser.add_argument("--hash", type=int, default=128, help="engine hash size[MB]")
+
+    # threads
+    parser.add_argument("--thread", type=int, default=1, help="number of engine threads")
+
+    # cores
+    parser.add_argument(
+        "--cores", type=int, default=8, help="cpu cores(number of logical threads)"
+    )
+
+    # book_file
+    parser.add_argument(
+        "--book_file",
+        type=str,
+        default="book/records2016_10818.sfen",
+        help="book filepath",
+    )
+
+    # start_gameply
+    parser.add_argument(
+        "--start_gameply", type=int, default=24, help="start game ply in the book"
+    )
+
+    # depth
+    parser.add_argument("--depth", type=int, default=10, help="search depth")
+
+    # margin
+    parser.add_argument(
+        "--margin", type=int, default=100, help="max absolute eval of output positions"
+    )
+
+    # cache
+    parser.add_argument(
+        "--cache", type=str, default=None, help="eval cache filepath"
+    )
+
+    # output
+    parser.add_argument(
+        "--output", type=str, default=None, help="filtered book filepath"
+    )
+
+    args = parser.parse_args()
+
+    # --- コマンドラインのparseここまで ---
+
+    home = args.home
+    book_path = os.path.join(home, args.book_file)
+    base_path = "{0}.ply{1}.depth{2}".format(
+        book_path, args.start_gameply, args.depth
+    )
+    cache_path = (
+        os.path.join(home, args.cache)
+        if args.cache is not None
+        else base_path + ".score"
+    )
+    output_path = (
+        os.path.join(home, args.output)
+        if args.output is not None
+        else "{0}.margin{1}.sfen".format(base_path, args.margin)
+    )
+
+    print("home           : {0}".format(args.home))
+    print("engine         : {0}".format(args.engine))
+    print("eval           : {0}".format(args.eval))
+    print("hash           : {0}".format(args.hash))
+    print("thread         : {0}".format(args.thread))
+    print("cores          : {0}".format(args.cores))
+    print("book file      : {0}".format(args.book_file))
+    print("start_gameply  : {0}".format(args.start_gameply))
+    print("depth          : {0}".format(args.depth))
+    print("margin         : {0}".format(args.margin))
+    print("cache          : {0}".format(cache_path))
+    print("output         : {0}".format(output_path))
+
+    # 開始局面の列挙(対局時と同じく、start_gameply手目で打ち切って重複を除いたもの)
+    book = ayane.OpeningBook(book_path)
+    sfens = book.start_sfens(args.start_gameply)
+    print("book positions : {0}".format(len(sfens)))
+
+    evaluator = ayane.PositionEvaluator()
+    evaluator.engine_path = os.path.join(home, args.engine)
+    evaluator.options = {
+        "Hash": str(args.hash),
+        "Threads": str(args.thread),
+        "EvalDir": os.path.join(home, args.eval),
+        "NetworkDelay": "0",
+        "NetworkDelay2": "0",
+        "MinimumThinkingTime": "0",
+        "BookFile": "no_book",
+    }
+    evaluator.parallel = max(int(args.cores / args.thread), 1)
+    evaluator.go_options = "depth {0}".format(args.depth)
+    evaluator.cache_path = cache_path
+
+    # 途中経過は1秒に1回だけ表示する。
+    start_time = time.time()
+    last_time = start_time
+
+    def progress(done: int, total: int):
+        nonlocal last_time
+        now = time.time()
+        if now - last_time < 1 and done != total:
+            return
+        last_time = now
+        # 残り時間は、今回評価した局面の平均から見積もる。
+        evaluated = evaluator.evaluated
+        rest = (now - start_time) / evaluated * (total - done) if evaluated else 0
+        print(
+            "evaluated {0}/{1} , rest {2:.0f}[s]".format(done, total, rest), flush=True
+        )
+
+    evaluator.evaluate(sfens, progress)
+
+    # 評価値が±margin以内の局面だけを書き出す。
+    balanced = evaluator.balanced(sfens, args.margin)
+    with open(output_path, "w", encoding="utf-8") as f:
+        for sfen in balanced:
+            f.write(sfen + "\n")
+    book.close()
+
+    print(
+        "output {0}/{1} positions -> {2}".format(len(balanced), len(sfens), output_path)
+    )
+
+
+if __name__ == "__main__":
+
+    AyaneruBookFilter()
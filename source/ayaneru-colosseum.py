@@ -51,8 +51,97 @@
 # --start_gameply
 # 定跡ファイルの開始手数。0を指定すると末尾の局面から開始。1を指定すると初期局面。
 
+# --shared_book
+# 定跡として用いる棋譜ファイル("startpos moves ..."や"sfen ... moves ..."のような書式で書かれているものとする)
+# このファイルをpython側で1回だけ読み込んで全対局で共有し、定跡にある局面ではエンジンに思考させずに、
+# 出現回数に比例した確率で指し手を選ぶ。(エンジン側の定跡は"BookFile"を"no_book"にして用いない)
+
+# --shared_book_ply
+# --shared_book の各棋譜の何手目までを定跡として用いるか。(デフォルト:16)
+
+# --paired
+# 指定すると、定跡ファイルから重複なしに選んだ開始局面を先後入れ替えて2局ずつ対局させ、
+# その2局の結果の組(pentanomial)からもレーティング差と信頼区間を計算する。(--flip_turnは無視される)
+# 開始局面の有利不利が相殺されるので、少ない対局数で同じ精度が得られる。
+
+# --db
+# 指定したSQLiteのデータベースファイルに、1局ごとの対局者、エンジンオプション、持ち時間、開始局面、結果、手数、対局時間と指し手を記録する。
+# 同じファイルを指定すれば、複数回の実行の結果が追記されていく。(ResultStore)
+
+# --checkpoint
+# 途中経過を保存するファイル。(homeフォルダ相対) (デフォルト:colosseum.checkpoint)
+# 対局の集計結果、開始局面の順番、乱数の状態などを一定の対局数ごとに保存する。すべての対局が終わったら削除される。
+# 棋譜は、終局するごとに"{checkpoint}.kifu"に追記していき、checkpointにはそのファイルのどこまでが集計済みかだけを保存する。
+
+# --resume
+# 指定すると、--checkpointのファイルから途中経過を読み込んで、続きから対局する。(ほかの引数は前回と同じにすること)
+
+# --trace
+# 指定したファイルに、各エンジンの思考区間、python側の待ち時間、対局の再開までの時間などを
+# Chrome trace-event形式(JSON)で書き出す。chrome://tracing や https://ui.perfetto.dev で開ける。
+
+# --profile
+# 指定したファイルに、python側の各スレッド(エンジンとの読み書き、対局の進行)が消費したCPU時間と、メモリの増加量を書き出す。
+# 何日もかかる対局で、python側がどこでCPU時間を消費しているか、メモリが増え続けていないかを調べるのに用いる。
+
+# --profile_mode
+# timer    : スレッドごとの経過時間とCPU時間だけを集計する。軽い。
+# cprofile : スレッドごとにcProfileで関数ごとの時間を集計する。数倍遅くなる。
+# (デフォルト:timer)
+
+# --memory_interval
+# --profileを指定したとき、この秒数ごとにtracemallocでメモリを調べる。0なら調べない。(デフォルト:600)
+
+# --transcript
+# 指定したフォルダに、各エンジンとのやりとりをタイムスタンプ付きで"server{番号}-engine{0 or 1}.txt"として記録する。
+# ayaneru-replay-engine.py(ReplayUsiEngine)で、エンジンなしで同じやりとりを再生できる。
+
+# --resource_report
+# 指定すると、対局終了時に各エンジンが思考中に実際に消費したCPU時間(割り当てられた時間×スレッド数に対する割合)と
+# メモリ使用量(RSS)を表示する。CPUの割合が100%を大きく下回るなら並列対局数が多すぎる。(Linuxのみ)
+
+# --affinity
+# 指定すると、並列対局の各スロットに重複しないCPUの集合(なるべく同じNUMAノード内のもの)を割り当てて、
+# 1対局の両エンジンをそのCPUの集合で実行する。スレッドがソケット間を移動しなくなるので、npsが安定する。(Linuxのみ)
+
+# --adaptive
+# 指定すると、CPUのコア数いっぱいまで対局サーバーを用意しておき、2スレッド余らせた並列数から開始して、
+# 時間超過、load average、エンジンのnpsを見ながら並列対局数を自動的に増減させる。
+
+# --sprt
+# 指定すると、1局ごとにSPRT(逐次確率比検定)を行い、判定が確定した時点で--loopの回数に達していなくても終了する。
+# H1 : engine1はengine2より--sprt_elo1だけ強い , H0 : engine1はengine2より--sprt_elo0だけ強い
+# のどちらを採択したかとLLR(対数尤度比)を表示する。
+
+# --sprt_elo0 , --sprt_elo1
+# SPRTの帰無仮説(H0)、対立仮説(H1)のレーティング差(デフォルト:0 , 5)
+
+# --sprt_alpha , --sprt_beta
+# SPRTの第1種、第2種の過誤の確率(デフォルト:0.05 , 0.05)
+
+# --listen
+# "ホスト:ポート番号"を指定すると、このマシンでは(--processesを指定しなければ)対局せずに、そこで待ち受けて、接続してきたayaneru-worker.pyに
+# 1局ずつ対局を割り当て、その結果を集計する。(MatchCoordinator) 複数のマシンで対局させるときに用いる。
+# 例 : --listen 0.0.0.0:4091
+# このとき、--engine1 , --engine2 , --eval1 , --eval2 , --shared_book は各ワーカーの--home相対になり、
+# --cores , --affinity , --memory_policy は各ワーカー側で指定する。(--adaptive , --trace , --profile , --transcript , --resource_report は無視される)
+# 接続が切れたか、一定時間応答のないワーカーの対局は、ほかのワーカーに割り当て直される。
+
+# --processes
+# 指定すると、並列対局の対局サーバーをこの数の子プロセスに分担させて、このプロセスは結果の集計だけを行う。
+# 並列対局数が多い(64以上など)と、1つのpythonのプロセスでは対局サーバーのスレッドがGILを奪い合って、指し手を返すまでの遅延が大きくなる。
+# 子プロセスとはローカルのTCP接続で、--listenのときと同じやりとりをする。(--adaptive , --trace , --profile , --transcript , --resource_report は無視される)
+# --listen と同時に指定すると、このマシンでも対局しつつ、ほかのマシンのayaneru-worker.pyの接続を待ち受ける。
+
+# --memory_policy
+# すべてのエンジンが空きメモリに収まらないときの対処。(デフォルト:cap)
+#  cap        : 収まる数まで並列対局数を減らす。
+#  scale_hash : 並列対局数はそのままに、Hashを減らす。(あやねるゲートではHashはengine_options.txtで設定するので減らせない)
+#  refuse     : エラーにして終了する。
+
 import os
 import time
+import json
 import argparse
 import shogi.Ayane as ayane
 
@@ -118,6 +207,116 @@ def AyaneruColosseum():
         "--start_gameply", type=int, default=24, help="start game ply in the book"
     )
 
+    # shared_book
+    parser.add_argument(
+        "--shared_book", type=str, default=None, help="book filepath shared by engines"
+    )
+    parser.add_argument(
+        "--shared_book_ply", type=int, default=16, help="max ply of shared book"
+    )
+
+    # paired
+    parser.add_argument(
+        "--paired",
+        action="store_true",
+        help="play each opening twice with colors reversed",
+    )
+
+    # db
+    parser.add_argument("--db", type=str, default=None, help="results database filepath")
+
+    # checkpoint
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default="colosseum.checkpoint",
+        help="checkpoint filepath",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="resume from the checkpoint"
+    )
+
+    # trace
+    parser.add_argument(
+        "--trace", type=str, default=None, help="chrome trace-event output filepath"
+    )
+
+    # profile
+    parser.add_argument(
+        "--profile", type=str, default=None, help="profile report output filepath"
+    )
+    parser.add_argument(
+        "--profile_mode",
+        type=str,
+        default="timer",
+        choices=["timer", "cprofile"],
+        help="profile mode",
+    )
+    parser.add_argument(
+        "--memory_interval",
+        type=float,
+        default=600,
+        help="seconds between tracemalloc snapshots",
+    )
+
+    # transcript
+    parser.add_argument(
+        "--transcript", type=str, default=None, help="engine transcript output folder"
+    )
+
+    # resource_report
+    parser.add_argument(
+        "--resource_report",
+        action="store_true",
+        help="report cpu time and rss of engines",
+    )
+
+    # affinity
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="bind engines of each game to a disjoint cpu set",
+    )
+
+    # adaptive
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="adjust the number of parallel games automatically",
+    )
+
+    # sprt
+    parser.add_argument("--sprt", action="store_true", help="stop by SPRT")
+    parser.add_argument("--sprt_elo0", type=float, default=0, help="SPRT elo0")
+    parser.add_argument("--sprt_elo1", type=float, default=5, help="SPRT elo1")
+    parser.add_argument("--sprt_alpha", type=float, default=0.05, help="SPRT alpha")
+    parser.add_argument("--sprt_beta", type=float, default=0.05, help="SPRT beta")
+
+    # memory_policy
+    parser.add_argument(
+        "--memory_policy",
+        type=str,
+        default="cap",
+        choices=["cap", "scale_hash", "refuse"],
+        help="what to do when engines do not fit in memory",
+    )
+
+    # listen
+    parser.add_argument(
+        "--listen",
+        type=str,
+        default=None,
+        help="host:port to distribute games to ayaneru-worker.py",
+    )
+
+    # processes
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="number of child processes to run the games",
+    )
+
     args = parser.parse_args()
 
     # --- コマンドラインのparseここまで ---
@@ -135,6 +334,29 @@ def AyaneruColosseum():
     print("flip_turn      : {0}".format(args.flip_turn))
     print("book file      : {0}".format(args.book_file))
     print("start_gameply  : {0}".format(args.start_gameply))
+    print("shared_book    : {0}".format(args.shared_book))
+    print("shared_book_ply: {0}".format(args.shared_book_ply))
+    print("paired         : {0}".format(args.paired))
+    print("db             : {0}".format(args.db))
+    print("checkpoint     : {0}".format(args.checkpoint))
+    print("resume         : {0}".format(args.resume))
+    print("trace          : {0}".format(args.trace))
+    print("profile        : {0}".format(args.profile))
+    print("profile_mode   : {0}".format(args.profile_mode))
+    print("memory_interval: {0}".format(args.memory_interval))
+    print("transcript     : {0}".format(args.transcript))
+    print("resource_report: {0}".format(args.resource_report))
+    print("affinity       : {0}".format(args.affinity))
+    print("adaptive       : {0}".format(args.adaptive))
+    print("memory_policy  : {0}".format(args.memory_policy))
+    print("listen         : {0}".format(args.listen))
+    print("processes      : {0}".format(args.processes))
+    if args.sprt:
+        print(
+            "sprt           : elo0 = {0} , elo1 = {1} , alpha = {2} , beta = {3}".format(
+                args.sprt_elo0, args.sprt_elo1, args.sprt_alpha, args.sprt_beta
+            )
+        )
 
     # directory
 
@@ -144,23 +366,6 @@ def AyaneruColosseum():
     eval1 = os.path.join(home, args.eval1)
     eval2 = os.path.join(home, args.eval2)
 
-    # マルチあやねるサーバーをそのまま用いる
-    server = ayane.MultiAyaneruServer()
-
-    # 1対局に要するスレッド数
-    # (先後、同時に思考しないので大きいほう)
-    thread_total = max(args.thread1, args.thread2)
-    # 何並列で対局するのか？ 2スレほど余らせておかないとtimeupになるかもしれん。
-    # メモリが足りるかは知らん。メモリ足りないとこれまたメモリスワップでtimeupになる。
-    cores = max(args.cores - 2, 1)
-    game_server_num = int(cores / thread_total)
-
-    # エンジンとのやりとりを標準出力に出力する
-    # server.debug_print = True
-
-    # あやねるサーバーを起動
-    server.init_server(game_server_num)
-
     # エンジンオプション
     options_common = {
         "NetworkDelay": "0",
@@ -180,9 +385,83 @@ def AyaneruColosseum():
         "EvalDir": eval2,
     }
 
-    # 1P,2P側のエンジンそれぞれを設定して初期化する。
-    server.init_engine(0, engine1, {**options_common, **options1p})
-    server.init_engine(1, engine2, {**options_common, **options2p})
+    # 1対局に要するスレッド数
+    # (先後、同時に思考しないので大きいほう)
+    thread_total = max(args.thread1, args.thread2)
+    # 何並列で対局するのか？ 2スレほど余らせておかないとtimeupになるかもしれん。
+    # メモリが足りないとメモリスワップでtimeupになるので、init_server()で空きメモリに収まるように調整する。
+    cores = max(args.cores - 2, 1)
+    game_server_num = int(cores / thread_total)
+
+    if args.listen is not None or args.processes > 0:
+        # 対局はayaneru-worker.pyか子プロセスに割り当てて、ここでは集計だけを行う。
+        server = ayane.MatchCoordinator()
+        if args.listen is not None:
+            host, port = args.listen.rsplit(":", 1)
+            server.host = host
+            server.port = int(port)
+        else:
+            # 子プロセスだけが接続してくる。ポート番号は空いているものを用いる。
+            server.host = "127.0.0.1"
+            server.port = 0
+        server.max_games = args.loop
+
+        # このマシンの子プロセスで対局させる。
+        server.local_processes = args.processes
+        server.local_slots = max(game_server_num, 1)
+        server.local_home = home
+        server.cpu_affinity = args.affinity
+        server.memory_policy = args.memory_policy
+
+        # エンジンは各ワーカーが、そのワーカーの--home相対で起動する。
+        options1p["EvalDir"] = args.eval1
+        options2p["EvalDir"] = args.eval2
+        server.init_engine(0, args.engine1, {**options_common, **options1p})
+        server.init_engine(1, args.engine2, {**options_common, **options2p})
+    else:
+        # マルチあやねるサーバーをそのまま用いる
+        server = ayane.MultiAyaneruServer()
+
+        # 並列対局数を自動調整するなら、コア数いっぱいまで対局サーバーを用意しておいて、上の並列数から開始する。
+        if args.adaptive:
+            controller = ayane.ConcurrencyController()
+            controller.initial_servers = max(game_server_num, 1)
+            server.concurrency_controller = controller
+            game_server_num = max(int(args.cores / thread_total), 1)
+
+        # エンジンとのやりとりを標準出力に出力する
+        # server.debug_print = True
+
+        # 思考区間などを記録する
+        if args.trace is not None:
+            server.tracer = ayane.ChromeTracer()
+
+        # python側のCPU時間とメモリを集計する
+        if args.profile is not None:
+            server.profiler = ayane.Profiler(args.profile_mode, args.memory_interval)
+
+        # エンジンとのやりとりを記録する
+        server.transcript_dir = args.transcript
+
+        # エンジンのCPU時間、RSSを集計する
+        server.resource_accounting = args.resource_report
+
+        # 各スロットにCPUの集合を割り当てる
+        server.cpu_affinity = args.affinity
+
+        # メモリが足りないときの対処
+        server.memory_policy = args.memory_policy
+
+        # あやねるサーバーを起動して、1P,2P側のエンジンそれぞれを設定して初期化する。
+        # エンジンを起動する前に、すべてのエンジンがメモリに収まるかを調べて、収まらないなら並列数(かHash)を減らす。
+        server.init_server(
+            game_server_num,
+            [
+                (engine1, {**options_common, **options1p}),
+                (engine2, {**options_common, **options2p}),
+            ],
+        )
+        print(server.memory_plan)
 
     # 持ち時間設定。
     server.set_time_setting(args.time)
@@ -190,18 +469,50 @@ def AyaneruColosseum():
     # flip_turnを反映させる
     server.flip_turn_every_game = args.flip_turn
 
+    # 開始局面を先後入れ替えて2局ずつ対局させる
+    server.paired_openings = args.paired
+
+    # SPRTで打ち切る
+    if args.sprt:
+        server.sprt = ayane.Sprt(
+            args.sprt_elo0, args.sprt_elo1, args.sprt_alpha, args.sprt_beta
+        )
+
     # 定跡
 
     # テスト用の定跡ファイル
     # args.book_file = "book/records2016_10818.sfen"
+    # 定跡ファイルはmmapで開いて、start_gameply手目で打ち切った開始局面(重複は除去済み)を用いる。
     if args.book_file is None:
-        start_sfens = ["startpos"]
+        server.start_sfens = ["startpos"]
+        server.start_gameply = args.start_gameply
     else:
-        book_filepath = os.path.join(home, args.book_file)
-        with open(book_filepath) as f:
-            start_sfens = f.readlines()
-    server.start_sfens = start_sfens
-    server.start_gameply = args.start_gameply
+        book = ayane.OpeningBook(os.path.join(home, args.book_file))
+        server.start_sfens = book.start_sfens(args.start_gameply)
+        server.start_gameply = 0
+        print("book positions : {0}".format(len(server.start_sfens)))
+
+    # python側で共有する定跡
+    if args.shared_book is not None and isinstance(server, ayane.MatchCoordinator):
+        # 各ワーカーがそのマシンで読み込む。
+        server.shared_book_path = args.shared_book
+        server.shared_book_ply = args.shared_book_ply
+    elif args.shared_book is not None:
+        server.book = ayane.SharedBook()
+        server.book.load(os.path.join(home, args.shared_book), args.shared_book_ply)
+        print("shared book    : {0} positions".format(server.book.positions))
+
+    # 対局結果をデータベースに記録する
+    store = None
+    if args.db is not None:
+        store = ayane.ResultStore(os.path.join(home, args.db))
+        store.start_run("ayaneru-colosseum.py", vars(args))
+        server.result_store = store
+        # 同じ実行ファイルで評価関数だけ違うことがあるので、評価関数のフォルダも対局者名に含める。
+        server.player_names = [
+            "{0}:{1}".format(args.engine1, args.eval1),
+            "{0}:{1}".format(args.engine2, args.eval2),
+        ]
 
     # 対局スレッド数、秒読み設定などを短縮文字列化する。
     if args.thread1 == args.thread2:
@@ -215,27 +526,93 @@ def AyaneruColosseum():
         .replace(" ", "")
     )
 
+    # 途中経過の保存と、--resumeのときはその読み込み。
+    # 前回と引数が違うなら、再開してもおかしなことになるのでエラーにする。
+    checkpoint_path = os.path.join(home, args.checkpoint)
+    checkpoint_args = {key: value for key, value in vars(args).items() if key != "resume"}
+    server.checkpoint_path = checkpoint_path
+    server.checkpoint_extra = {"args": checkpoint_args}
+    server.kifu_path = checkpoint_path + ".kifu"
+    if store is not None:
+        # データベースに記録した対局を指し直すことがないように、1局ごとに保存する。
+        server.checkpoint_interval = 1
+    if args.resume:
+        state = ayane.Checkpoint.load(checkpoint_path)
+        if state is None:
+            print("checkpoint is not found. start from the beginning.")
+        elif state["args"] != json.loads(json.dumps(checkpoint_args)):
+            raise ValueError("checkpoint was made with different arguments.")
+        else:
+            server.restore(state["server"])
+            print(
+                "resume from {0} : {1} games".format(
+                    checkpoint_path, state["server"]["total_games"]
+                )
+            )
+
     # これで対局が開始する
     server.game_start()
+    if isinstance(server, ayane.MatchCoordinator):
+        if args.processes > 0:
+            print(server.memory_plan)
+        if args.listen is not None:
+            print("waiting for workers on {0}:{1}".format(server.host, server.port))
 
     # loop回数試合終了するのを待つ
     last_total_games = 0
     loop = args.loop
 
     # ゲーム数が増えていたら、途中結果を出力する。
+    last_history = 0
+    last_worker_history = 0
+
     def output_info():
-        nonlocal last_total_games, server
+        nonlocal last_total_games, last_history, last_worker_history, server
         if last_total_games != server.total_games:
             last_total_games = server.total_games
             print(game_setting_str + "." + server.game_info())
 
-    while server.total_games < loop:
+        # 並列対局数が変化していたら、その理由を出力する。
+        controller = server.concurrency_controller
+        if controller is not None and last_history != len(controller.history):
+            for history in controller.history[last_history:]:
+                print(history)
+            last_history = len(controller.history)
+
+        # ワーカーの接続、切断を出力する。
+        if (
+            isinstance(server, ayane.MatchCoordinator)
+            and last_worker_history != len(server.history)
+        ):
+            for history in server.history[last_worker_history:]:
+                print(history)
+            last_worker_history = len(server.history)
+
+    while server.total_games < loop and not server.sprt_finished():
         output_info()
         time.sleep(1)
     output_info()
 
+    # game_stop()でエンジンは終了してしまうので、その前に出力しておく。
+    if args.resource_report and not isinstance(server, ayane.MatchCoordinator):
+        print(server.resource_info())
+
     server.game_stop()
 
+    # 最後まで対局したので、途中経過はもう要らない。
+    for path in [checkpoint_path, server.kifu_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    if store is not None:
+        store.close()
+
+    if server.tracer is not None:
+        server.tracer.write(args.trace)
+
+    if server.profiler is not None:
+        server.profiler.write(args.profile)
+
     # 対局棋譜の出力
     # for kifu in server.game_kifus:
     #     print("game sfen = {0} , flip_turn = {1} , game_result = {2}".format(kifu.sfen , kifu.flip_turn , str(kifu.game_result)))
@@ -0,0 +1,76 @@
+# あやねるエンジンサーバー
+# このマシンのエンジンをTCPかUnixドメインのsocketで公開するスクリプト。(UsiEngineServer)
+# 接続ごとにエンジンを起動して、socketとエンジンの標準入出力の間でUSIプロトコルの行を中継する。
+
+# 別のマシン(やコンテナ)でこれを動かしておけば、ayaneru-colosseum.py などの--engine1 , --engine2 に
+# "tcp://そのマシンのアドレス:ポート番号"を指定すると、そのマシンのエンジンと対局させることができる。
+# 例 : python ayaneru-engine-server.py --home /home/yane/shogi --engine exe/YaneuraOu.exe --listen tcp://0.0.0.0:5001
+#      python ayaneru-colosseum.py --engine1 exe/YaneuraOu.exe --engine2 tcp://192.168.0.20:5001 ...
+# エンジンオプション(EvalDirなど)はそのまま送られてくるので、パスはエンジンのあるマシンでのものを指定すること。
+# また、対局させる側の並列対局数の分だけ接続されるので、このマシンのコア数に見合うように並列対局数を決めること。
+
+# === 本スクリプトの引数の意味 ===
+
+# --engine
+# 公開するエンジンの実行ファイル名
+
+# --home
+# エンジンなどが存在するホームディレクトリ
+
+# --listen
+# 待ち受けるアドレス。"tcp://ホスト:ポート番号"か"unix://socketのpath" (デフォルト:tcp://0.0.0.0:5001)
+
+# --max_connections
+# 同時に接続できる数。これを超えた接続はすぐに切る。0なら無制限。(デフォルト:0)
+
+import os
+import argparse
+import shogi.Ayane as ayane
+
+
+def AyaneruEngineServer():
+    # --- コマンドラインのparseここから ---
+
+    parser = argparse.ArgumentParser("ayaneru-engine-server.py")
+
+    # engine path
+    parser.add_argument(
+        "--engine", type=str, default="exe/YaneuraOu.exe", help="engine path"
+    )
+
+    # home folder
+    parser.add_argument("--home", type=str, default="", help="home folder")
+
+    # listen
+    parser.add_argument(
+        "--listen", type=str, default="tcp://0.0.0.0:5001", help="socket address"
+    )
+
+    # max_connections
+    parser.add_argument(
+        "--max_connections", type=int, default=0, help="max number of connections"
+    )
+
+    args = parser.parse_args()
+
+    # --- コマンドラインのparseここまで ---
+
+    print("home           : {0}".format(args.home))
+    print("engine         : {0}".format(args.engine))
+    print("listen         : {0}".format(args.listen))
+    print("max_connections: {0}".format(args.max_connections))
+
+    server = ayane.UsiEngineServer(os.path.join(args.home, args.engine), args.listen)
+    server.max_connections = args.max_connections
+    server.listen()
+    print("listening on {0}".format(server.address), flush=True)
+
+    # Ctrl+Cで終了する。
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    AyaneruEngineServer()
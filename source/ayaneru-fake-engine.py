@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# あやねるフェイクエンジン
+# 思考せずに、それらしい応答だけを返すUSIエンジン。(FakeUsiEngine)
+# python側のオーバーヘッドの計測(ayaneru-benchmark.py)や、本物のエンジンなしで対局スクリプトを試すのに用いる。
+# UsiEngine.connect()などにこのファイルのpathを渡せばエンジンとして起動される。(実行権限が必要)
+# 思考時間、読み筋の数、投了する手数などはエンジンオプションで指定する。(FakeUsiEngineのコメントを参照)
+# 例 : python ayaneru-colosseum.py --home . --engine1 ayaneru-fake-engine.py --engine2 ayaneru-fake-engine.py
+
+import sys
+import shogi.Ayane as ayane
+
+
+if __name__ == "__main__":
+    ayane.FakeUsiEngine().run(sys.stdin, sys.stdout)
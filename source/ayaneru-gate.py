@@ -68,10 +68,92 @@
 # --start_gameply
 # 定跡ファイルの開始手数。0を指定すると末尾の局面から開始。1を指定すると初期局面。
 
+# --shared_book
+# 定跡として用いる棋譜ファイル("startpos moves ..."や"sfen ... moves ..."のような書式で書かれているものとする)
+# このファイルをpython側で1回だけ読み込んで全対局で共有し、定跡にある局面ではエンジンに思考させずに、
+# 出現回数に比例した確率で指し手を選ぶ。(エンジン側の定跡は"BookFile"を"no_book"にして用いない)
+
+# --shared_book_ply
+# --shared_book の各棋譜の何手目までを定跡として用いるか。(デフォルト:16)
+
+# --paired
+# 指定すると、定跡ファイルから重複なしに選んだ開始局面を先後入れ替えて2局ずつ対局させ、
+# その2局の結果の組(pentanomial)からもレーティング差と信頼区間を計算する。(--flip_turnは無視される)
+# 開始局面の有利不利が相殺されるので、少ない対局数で同じ精度が得られる。
+
+# --schedule
+# 対局の組み方。(デフォルト:serial)
+#  serial     : イテレーションごとにランダムに選んだ2つのエンジンで、全コアを使ってloop回対局する。
+#               ペアリングの最後の対局が終わるまで他のコアが遊び、イテレーションごとにエンジンを起動し直す。
+#  roundrobin : すべてのエンジンの組み合わせ(rating_fix同士を除く)をiteration周、それぞれloop回対局する。
+#  gauntlet   : --gauntletのエンジン対その他のすべてのエンジンをiteration周、それぞれloop回対局する。
+#  random     : ランダムに選んだ2つのエンジンの組み合わせをiteration個、それぞれloop回対局する。
+# serial以外では、すべてのペアリングの対局を1つのコアの枠(cores - 2)のなかで並列に行い、対局が終わってコアが空くたびに、
+# そこに収まる(engine_define.txtのthreadsの大きいほうが収まる)ペアリングの対局を開始する。
+# レーティングはペアリングの全対局が終わるごとに更新する。(--memory_policy , --affinity , --adaptive , --paired は無視される)
+
+# --gauntlet
+# --schedule gauntletのときの、その他のすべてのエンジンと対局させるエンジンのフォルダ名。
+# 省略時は、rating_fixではない最初のエンジン。
+
+# --rating
+# レーティングの更新方法。(デフォルト:pairwise)
+#  pairwise : ペアリングの対局が終わるごとに、その勝率から求めたレーティング差(対局回数でclipしたもの)を2つのエンジンに振り分ける。
+#  mle      : それまでの全対局結果から、rating_fixのエンジンのレーティングを基準として、全エンジンのレーティングを
+#             最尤推定し直す。(BradleyTerryRating) 対局の順番に依存せず、同じ対局数でもより正確になる。
+#             対局結果はhomeフォルダの"gate_results.json"に保存され、次回の実行でも用いられる。
+
+# --pairing
+# 対局させる2つのエンジンの選び方。(--schedule serial , random のとき) (デフォルト:random)
+#  random      : ランダムに選ぶ。
+#  informative : それまでの全対局結果から推定したレーティングとその信頼区間をもとに、レーティングが近く、
+#                かつレーティングの不確かなエンジン同士を選ぶ。(BradleyTerryRating.information())
+#                結果がほぼ確定している組み合わせに対局数を使わないので、少ない対局数でレーティングが収束する。
+#                対局結果は--rating mleのときと同じく"gate_results.json"に保存される。
+
+# --db
+# 指定したSQLiteのデータベースファイルに、1局ごとの対局者(エンジンフォルダ名)、エンジンオプション、持ち時間、開始局面、
+# 結果、手数、対局時間と指し手を記録する。(ResultStore)
+# --rating mle , --pairing informative のときは、"gate_results.json"ではなくこのデータベースの全対局結果を用いる。
+
+# --checkpoint
+# 途中経過を保存するファイル。(homeフォルダ相対) (デフォルト:gate.checkpoint)
+# 対局の集計結果、イテレーション番号、ペアリング、乱数の状態などを、一定の対局数ごとと、ペアリングの対局が終わるごとに保存する。
+# 棋譜は、終局するごとに"{checkpoint}.kifu"に追記していき、checkpointにはそのファイルのどこまでが集計済みかだけを保存する。
+# すべての対局が終わったら削除される。
+
+# --resume
+# 指定すると、--checkpointのファイルから途中経過を読み込んで、続きから対局する。(ほかの引数は前回と同じにすること)
+# レーティングはペアリングの対局が終わるごとにengine_define.txtに書き戻されているので、それ以降の対局だけが指し直しになる。
+
+# --trace
+# 指定したファイルに、各エンジンの思考区間、python側の待ち時間、対局の再開までの時間などを
+# Chrome trace-event形式(JSON)で書き出す。chrome://tracing や https://ui.perfetto.dev で開ける。
+
+# --resource_report
+# 指定すると、対局終了時に各エンジンが思考中に実際に消費したCPU時間(割り当てられた時間×スレッド数に対する割合)と
+# メモリ使用量(RSS)を表示する。CPUの割合が100%を大きく下回るなら並列対局数が多すぎる。(Linuxのみ)
+
+# --affinity
+# 指定すると、並列対局の各スロットに重複しないCPUの集合(なるべく同じNUMAノード内のもの)を割り当てて、
+# 1対局の両エンジンをそのCPUの集合で実行する。スレッドがソケット間を移動しなくなるので、npsが安定する。(Linuxのみ)
+
+# --adaptive
+# 指定すると、CPUのコア数いっぱいまで対局サーバーを用意しておき、2スレッド余らせた並列数から開始して、
+# 時間超過、load average、エンジンのnpsを見ながら並列対局数を自動的に増減させる。
+
+# --memory_policy
+# すべてのエンジンが空きメモリに収まらないときの対処。(デフォルト:cap)
+#  cap        : 収まる数まで並列対局数を減らす。
+#  scale_hash : 並列対局数はそのままに、Hashを減らす。(あやねるゲートではHashはengine_options.txtで設定するので減らせない)
+#  refuse     : エラーにして終了する。
+
 import os
 import time
+import json
 import argparse
 import random
+from typing import List, Tuple
 import shogi.Ayane as ayane
 
 
@@ -245,6 +327,99 @@ def AyaneruGate():
         "--start_gameply", type=int, default=24, help="start game ply in the book"
     )
 
+    # shared_book
+    parser.add_argument(
+        "--shared_book", type=str, default=None, help="book filepath shared by engines"
+    )
+    parser.add_argument(
+        "--shared_book_ply", type=int, default=16, help="max ply of shared book"
+    )
+
+    # paired
+    parser.add_argument(
+        "--paired",
+        action="store_true",
+        help="play each opening twice with colors reversed",
+    )
+
+    # schedule
+    parser.add_argument(
+        "--schedule",
+        type=str,
+        default="serial",
+        choices=["serial", "roundrobin", "gauntlet", "random"],
+        help="how to make pairings",
+    )
+
+    # gauntlet
+    parser.add_argument(
+        "--gauntlet", type=str, default=None, help="engine folder of gauntlet player"
+    )
+
+    # pairing
+    parser.add_argument(
+        "--pairing",
+        type=str,
+        default="random",
+        choices=["random", "informative"],
+        help="how to choose the next pairing",
+    )
+
+    # rating
+    parser.add_argument(
+        "--rating",
+        type=str,
+        default="pairwise",
+        choices=["pairwise", "mle"],
+        help="how to update ratings",
+    )
+
+    # db
+    parser.add_argument("--db", type=str, default=None, help="results database filepath")
+
+    # checkpoint
+    parser.add_argument(
+        "--checkpoint", type=str, default="gate.checkpoint", help="checkpoint filepath"
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="resume from the checkpoint"
+    )
+
+    # trace
+    parser.add_argument(
+        "--trace", type=str, default=None, help="chrome trace-event output filepath"
+    )
+
+    # resource_report
+    parser.add_argument(
+        "--resource_report",
+        action="store_true",
+        help="report cpu time and rss of engines",
+    )
+
+    # affinity
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="bind engines of each game to a disjoint cpu set",
+    )
+
+    # adaptive
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="adjust the number of parallel games automatically",
+    )
+
+    # memory_policy
+    parser.add_argument(
+        "--memory_policy",
+        type=str,
+        default="cap",
+        choices=["cap", "scale_hash", "refuse"],
+        help="what to do when engines do not fit in memory",
+    )
+
     args = parser.parse_args()
 
     # --- コマンドラインのparseここまで ---
@@ -257,6 +432,21 @@ def AyaneruGate():
     print("flip_turn      : {0}".format(args.flip_turn))
     print("book file      : {0}".format(args.book_file))
     print("start_gameply  : {0}".format(args.start_gameply))
+    print("shared_book    : {0}".format(args.shared_book))
+    print("shared_book_ply: {0}".format(args.shared_book_ply))
+    print("paired         : {0}".format(args.paired))
+    print("schedule       : {0}".format(args.schedule))
+    print("gauntlet       : {0}".format(args.gauntlet))
+    print("rating         : {0}".format(args.rating))
+    print("pairing        : {0}".format(args.pairing))
+    print("db             : {0}".format(args.db))
+    print("checkpoint     : {0}".format(args.checkpoint))
+    print("resume         : {0}".format(args.resume))
+    print("trace          : {0}".format(args.trace))
+    print("resource_report: {0}".format(args.resource_report))
+    print("affinity       : {0}".format(args.affinity))
+    print("adaptive       : {0}".format(args.adaptive))
+    print("memory_policy  : {0}".format(args.memory_policy))
 
     # directory
 
@@ -311,144 +501,134 @@ def AyaneruGate():
 
     output_engine_rating()
 
-    # サーバーを一つ起動して、任意の2エンジンで100対局ほど繰り返して、レーティングを変動させる。
-    # あとは、それをloop回数だけ繰り返す。
-
-    for it in range(args.iteration):
-        log.print("iteration : {0}".format(it), output_datetime=True)
-
-        # マルチあやねるサーバーの起動
-        server = ayane.MultiAyaneruServer()
-
-        # エンジンとのやりとりを標準出力に出力する
-        # server.debug_print = True
-
-        # 2つのエンジンを選択
-        info1 = None
-        info2 = None
-        while True:
-            num_of_engines = len(engine_infos)
-            p1 = random.randint(0, num_of_engines - 1)
-            p2 = random.randint(0, num_of_engines - 1)
-            # 同じプレイヤー同士の対局には意味がない
-            if p1 == p2:
-                continue
-
-            # engine番号が若い順になって欲しい。
-            if p1 > p2:
-                p1, p2 = p2, p1
-                # pythonのswapテクニック
-
-            info1 = engine_infos[p1]
-            info2 = engine_infos[p2]
-            # 両側がレーティング固定であっても意味がない。
-            if info1.rating_fix and info2.rating_fix:
-                continue
-
-            # 条件を満たしたので抜ける
-            break
-
-        # 今回対局するエンジン名を出力
-
-        log.print(
-            "engine : {0} vs {1}".format(
-                info1.engine_display_name, info2.engine_display_name
-            ),
-            also_print=True,
-        )
-
-        # エンジンの設定
-
-        engine1 = info1.engine_exe_fullpath(home)
-        engine2 = info2.engine_exe_fullpath(home)
-
-        thread1 = info1.engine_threads
-        thread2 = info2.engine_threads
-
-        # 1対局に要するスレッド数
-        # (先後、同時に思考しないので大きいほう)
-        thread_total = max(thread1, thread2)
-        # 何並列で対局するのか？ 2スレほど余らせておかないとtimeupになるかもしれん。
-        # メモリが足りるかは知らん。メモリ足りないとこれまたメモリスワップでtimeupになる。
-        cores = max(args.cores - 2, 1)
-        game_server_num = int(cores / thread_total)
-
-        # あやねるサーバーを起動
-        server.init_server(game_server_num)
-
-        # エンジンオプション
-        options_common = {
-            "NetworkDelay": "0",
-            "NetworkDelay2": "0",
-            "MaxMovesToDraw": "320",
-            "MinimumThinkingTime": "0",
-            "BookFile": "no_book",
-        }
-        # 1P,2P側のエンジンそれぞれを設定して初期化する。
-        server.init_engine(0, engine1, options_common)
-        server.init_engine(1, engine2, options_common)
-
-        # 持ち時間設定。
-        server.set_time_setting(args.time)
-
-        # flip_turnを反映させる
-        server.flip_turn_every_game = args.flip_turn
-
-        # 定跡
-
-        if args.book_file is None:
-            start_sfens = ["startpos"]
+    # 思考区間などを記録する。(全イテレーションを通して1つのtracerに記録する)
+    tracer = ayane.ChromeTracer() if args.trace is not None else None
+
+    # 定跡ファイルはmmapで開いて、start_gameply手目で打ち切った開始局面(重複は除去済み)を全イテレーションで共有する。
+    if args.book_file is None:
+        start_sfens = ["startpos"]
+        start_gameply = args.start_gameply
+    else:
+        book = ayane.OpeningBook(os.path.join(home, args.book_file))
+        start_sfens = book.start_sfens(args.start_gameply)
+        start_gameply = 0
+        log.print("book positions : {0}".format(len(start_sfens)))
+
+    # python側で共有する定跡(全イテレーションで共有する)
+    shared_book = None
+    if args.shared_book is not None:
+        shared_book = ayane.SharedBook()
+        shared_book.load(os.path.join(home, args.shared_book), args.shared_book_ply)
+        log.print("shared book    : {0} positions".format(shared_book.positions))
+
+    # 並列対局数の自動調整。(全イテレーションを通して、時間超過の起きた並列数を覚えておく)
+    controller = ayane.ConcurrencyController() if args.adaptive else None
+
+    # 対局結果をデータベースに記録する
+    store = None
+    if args.db is not None:
+        store = ayane.ResultStore(os.path.join(home, args.db))
+        store.start_run("ayaneru-gate.py", vars(args))
+
+    # 途中経過の保存と、--resumeのときはその読み込み。
+    # 前回と引数が違うなら、再開してもおかしなことになるのでエラーにする。
+    checkpoint_path = os.path.join(home, args.checkpoint)
+    checkpoint_args = {key: value for key, value in vars(args).items() if key != "resume"}
+    resume_state = None
+    if args.resume:
+        resume_state = ayane.Checkpoint.load(checkpoint_path)
+        if resume_state is None:
+            log.print("checkpoint is not found. start from the beginning.", also_print=True)
+        elif resume_state["args"] != json.loads(json.dumps(checkpoint_args)):
+            raise ValueError("checkpoint was made with different arguments.")
         else:
-            book_filepath = os.path.join(home, args.book_file)
-            with open(book_filepath) as f:
-                start_sfens = f.readlines()
-        server.start_sfens = start_sfens
-        server.start_gameply = args.start_gameply
-
-        # 対局スレッド数、秒読み設定などを短縮文字列化する。
-        if thread1 == thread2:
-            game_setting_str = "t{0}".format(thread1)
-        else:
-            game_setting_str = "t{0},{1}".format(thread1, thread2)
-        game_setting_str += (
-            args.time.replace("byoyomi", "b")
-            .replace("time", "t")
-            .replace("inc", "i")
-            .replace(" ", "")
-        )
-
-        # loop回数試合終了するのを待つ
-        last_total_games = 0
-        loop = args.loop
-
-        # ゲーム数が増えていたら、途中結果を出力する。
-        def output_info():
-            nonlocal last_total_games, server, log
-            if last_total_games != server.total_games:
-                last_total_games = server.total_games
-                log.print(game_setting_str + "." + server.game_info())
-
-        # これで対局が開始する
-        server.game_start()
+            log.print("resume from {0}".format(checkpoint_path), also_print=True)
 
-        while server.total_games < loop:
-            output_info()
-            time.sleep(1)
-        output_info()
-
-        server.game_stop()
-
-        # 対局棋譜の出力(ログとしてフォルダに書き出しておく)
-        for kifu in server.game_kifus:
-            log.print(
-                "game sfen = {0} , flip_turn = {1} , game_result = {2}".format(
-                    kifu.sfen, kifu.flip_turn, str(kifu.game_result)
-                ),
-                also_print=False,
+    # 全対局結果からのレーティングの最尤推定(レーティングの更新と、ペアリングの選択に用いる)
+    bradley_terry = None
+    results_path = os.path.join(home, "gate_results.json")
+    if args.rating == "mle" or args.pairing == "informative":
+        bradley_terry = ayane.BradleyTerryRating()
+        for info in engine_infos:
+            if info.rating_fix:
+                bradley_terry.fix(info.engine_folder, info.rating)
+            else:
+                bradley_terry.set_initial_rating(info.engine_folder, info.rating)
+        if store is not None:
+            for result in store.pair_results():
+                bradley_terry.add_result(*result)
+        else:
+            bradley_terry.load(results_path)
+        bradley_terry.calc()
+
+    # 対局させる組み合わせの候補。(engine番号が若い順。両側がレーティング固定のものは除く)
+    candidates = [
+        (p1, p2)
+        for p1 in range(len(engine_infos))
+        for p2 in range(p1 + 1, len(engine_infos))
+        if not (engine_infos[p1].rating_fix and engine_infos[p2].rating_fix)
+    ]
+
+    # 候補のなかから、最も情報の得られる組み合わせを選ぶ。
+    # candidates : engine_infos上のindexの組のlist
+    def select_pairing(candidates: List[Tuple[int, int]]) -> Tuple[int, int]:
+        nonlocal bradley_terry
+        pairs = [
+            (engine_infos[p1].engine_folder, engine_infos[p2].engine_folder)
+            for p1, p2 in candidates
+        ]
+        return candidates[pairs.index(bradley_terry.most_informative(pairs))]
+
+    # 対局結果を追加して、全対局結果からレーティングを推定し直す。
+    def record_result(info1: EngineInfo, info2: EngineInfo, elo: ayane.EloRating):
+        nonlocal log, bradley_terry
+        if store is None:
+            bradley_terry.add_result(
+                info1.engine_folder,
+                info2.engine_folder,
+                elo.player1_win,
+                elo.draw_games,
+                elo.player2_win,
             )
+        # データベースに記録しているなら、結果はそちらに残っているので、それを集計し直す。
+        # (--resumeで指し直した対局の分が重複しないように、対局結果から加算せずにデータベースから読み直す)
+        if store is not None:
+            store.flush()
+            bradley_terry.clear_results()
+            for result in store.pair_results():
+                bradley_terry.add_result(*result)
+        else:
+            bradley_terry.save(results_path)
+        bradley_terry.calc()
+        log.print(bradley_terry.to_string(), also_print=True)
 
-        # 対局が終わったのでレーティングの移動を行う
-        elo = server.game_rating()
+    # 推定し直したレーティングを、全エンジンに反映させる。
+    def update_rating_mle():
+        nonlocal log, bradley_terry
+        for info in engine_infos:
+            if info.rating_fix or info.engine_folder not in bradley_terry.ratings:
+                continue
+            rating = int(round(bradley_terry.ratings[info.engine_folder]))
+            if rating != info.rating:
+                log.print(
+                    "Player : {0} , rating {1} -> {2}".format(
+                        info.engine_display_name, info.rating, rating
+                    ),
+                    also_print=True,
+                )
+                info.rating = rating
+                info.write_engine_define(home)
+
+    # 1つのペアリングのloop回の対局が終わったので、その結果(elo)からレーティングの移動を行う。
+    def update_rating(
+        info1: EngineInfo, info2: EngineInfo, elo: ayane.EloRating, loop: int
+    ):
+        nonlocal log
+        if bradley_terry is not None:
+            record_result(info1, info2, elo)
+        if args.rating == "mle":
+            update_rating_mle()
+            return
 
         # 1P側は2P側よりどれだけ勝るか。
         # 完勝のときは+無限大扱いでいいと思う。(以下でclipするので)
@@ -490,10 +670,321 @@ def AyaneruGate():
         if player2_add != 0:
             info2.write_engine_define(home)
 
+    if args.schedule != "serial":
+        # 1つのコアの枠のなかで、すべてのペアリングの対局を並列に行う。
+        scheduler = ayane.TournamentScheduler()
+        scheduler.cores = max(args.cores - 2, 1)
+        scheduler.time_setting = args.time
+        scheduler.start_sfens = start_sfens
+        scheduler.start_gameply = start_gameply
+        scheduler.flip_turn_every_game = args.flip_turn
+        scheduler.book = shared_book
+        scheduler.tracer = tracer
+
+        options_common = {
+            "NetworkDelay": "0",
+            "NetworkDelay2": "0",
+            "MaxMovesToDraw": "320",
+            "MinimumThinkingTime": "0",
+            "BookFile": "no_book",
+        }
+        for info in engine_infos:
+            scheduler.add_engine(
+                info.engine_exe_fullpath(home),
+                options_common,
+                info.engine_threads,
+                info.rating_fix,
+                info.engine_folder,
+            )
+        scheduler.result_store = store
+
+        gauntlet_player = 0
+        for i, info in enumerate(engine_infos):
+            if (
+                info.engine_folder == args.gauntlet
+                if args.gauntlet is not None
+                else not info.rating_fix
+            ):
+                gauntlet_player = i
+                break
+        scheduler.make_pairings(
+            args.schedule, args.iteration, args.loop, gauntlet_player
+        )
+
+        # 途中経過の保存と復元
+        scheduler.checkpoint_path = checkpoint_path
+        scheduler.checkpoint_extra = {"args": checkpoint_args}
+        scheduler.kifu_path = checkpoint_path + ".kifu"
+        if store is not None:
+            # データベースに記録した対局を指し直すことがないように、1局ごとに保存する。
+            scheduler.checkpoint_interval = 1
+        if resume_state is not None:
+            scheduler.restore(resume_state["scheduler"])
+
+        log.print(
+            "pairings       : {0} , cores {1}".format(
+                len(scheduler.pairings), scheduler.cores
+            ),
+            also_print=True,
+        )
+
+        # ペアリングの全対局が終わるごとにレーティングを更新する。(対局を管理するスレッドから呼び出される)
+        def pairing_finished(pairing: ayane.TournamentPairing):
+            info1 = engine_infos[pairing.player1]
+            info2 = engine_infos[pairing.player2]
+            log.print(
+                "engine : {0} vs {1} : {2}".format(
+                    info1.engine_display_name,
+                    info2.engine_display_name,
+                    pairing.game_rating().pretty_string,
+                ),
+                also_print=True,
+            )
+            for kifu in pairing.game_kifus:
+                log.print(
+                    "game sfen = {0} , flip_turn = {1} , game_result = {2}".format(
+                        kifu.sfen, kifu.flip_turn, str(kifu.game_result)
+                    ),
+                    also_print=False,
+                )
+            update_rating(info1, info2, pairing.game_rating(), pairing.games)
+
+        scheduler.pairing_finished_callback = pairing_finished
+        if args.pairing == "informative":
+            scheduler.pairing_selector = select_pairing
+
+        scheduler.game_start()
+        last_total_games = 0
+        while not scheduler.is_finished():
+            if last_total_games != scheduler.total_games:
+                last_total_games = scheduler.total_games
+                log.print(
+                    "games {0}/{1} , playing {2} , free cores {3}".format(
+                        scheduler.total_games,
+                        (len(scheduler.pairings) + scheduler.pending_pairings)
+                        * args.loop,
+                        scheduler.active_games(),
+                        scheduler.free_cores,
+                    )
+                )
+            time.sleep(1)
+        scheduler.game_stop()
+
+    else:
+        # サーバーを一つ起動して、任意の2エンジンで100対局ほど繰り返して、レーティングを変動させる。
+        # あとは、それをloop回数だけ繰り返す。
+
+        # 再開するイテレーション番号。(途中で落ちたイテレーションなら、その対局の途中経過もある)
+        start_iteration = 0
+        if resume_state is not None:
+            start_iteration = resume_state["iteration"]
+            ayane.Checkpoint.set_random_state(resume_state["random"])
+
+        for it in range(start_iteration, args.iteration):
+            log.print("iteration : {0}".format(it), output_datetime=True)
+
+            # マルチあやねるサーバーの起動
+            server = ayane.MultiAyaneruServer()
+
+            # エンジンとのやりとりを標準出力に出力する
+            # server.debug_print = True
+
+            server.tracer = tracer
+            server.result_store = store
+            server.resource_accounting = args.resource_report
+            server.cpu_affinity = args.affinity
+
+            # 2つのエンジンを選択
+            info1 = None
+            info2 = None
+            if resume_state is not None and "server" in resume_state:
+                # 途中で落ちたイテレーションの続き
+                p1, p2 = resume_state["pairing"]
+                info1 = engine_infos[p1]
+                info2 = engine_infos[p2]
+            elif args.pairing == "informative":
+                # それまでの全対局結果から、最も情報の得られる組み合わせを選ぶ。
+                p1, p2 = select_pairing(candidates)
+                info1 = engine_infos[p1]
+                info2 = engine_infos[p2]
+            else:
+                while True:
+                    num_of_engines = len(engine_infos)
+                    p1 = random.randint(0, num_of_engines - 1)
+                    p2 = random.randint(0, num_of_engines - 1)
+                    # 同じプレイヤー同士の対局には意味がない
+                    if p1 == p2:
+                        continue
+
+                    # engine番号が若い順になって欲しい。
+                    if p1 > p2:
+                        p1, p2 = p2, p1
+                        # pythonのswapテクニック
+
+                    info1 = engine_infos[p1]
+                    info2 = engine_infos[p2]
+                    # 両側がレーティング固定であっても意味がない。
+                    if info1.rating_fix and info2.rating_fix:
+                        continue
+
+                    # 条件を満たしたので抜ける
+                    break
+
+            # 今回対局するエンジン名を出力
+
+            log.print(
+                "engine : {0} vs {1}".format(
+                    info1.engine_display_name, info2.engine_display_name
+                ),
+                also_print=True,
+            )
+
+            # エンジンの設定
+
+            engine1 = info1.engine_exe_fullpath(home)
+            engine2 = info2.engine_exe_fullpath(home)
+
+            thread1 = info1.engine_threads
+            thread2 = info2.engine_threads
+
+            # 1対局に要するスレッド数
+            # (先後、同時に思考しないので大きいほう)
+            thread_total = max(thread1, thread2)
+            # 何並列で対局するのか？ 2スレほど余らせておかないとtimeupになるかもしれん。
+            # メモリが足りないとメモリスワップでtimeupになるので、init_server()で空きメモリに収まるように調整する。
+            cores = max(args.cores - 2, 1)
+            game_server_num = int(cores / thread_total)
+
+            # 並列対局数を自動調整するなら、コア数いっぱいまで対局サーバーを用意しておいて、上の並列数から開始する。
+            if controller is not None:
+                controller.initial_servers = max(game_server_num, 1)
+                controller.history = []
+                server.concurrency_controller = controller
+                game_server_num = max(int(args.cores / thread_total), 1)
+
+            # エンジンオプション
+            options_common = {
+                "NetworkDelay": "0",
+                "NetworkDelay2": "0",
+                "MaxMovesToDraw": "320",
+                "MinimumThinkingTime": "0",
+                "BookFile": "no_book",
+            }
+            # メモリが足りないときの対処
+            server.memory_policy = args.memory_policy
+
+            # あやねるサーバーを起動して、1P,2P側のエンジンそれぞれを設定して初期化する。
+            # エンジンを起動する前に、すべてのエンジンがメモリに収まるかを調べて、収まらないなら並列数を減らす。
+            # (Hashはengine_options.txtで設定されているので、"scale_hash"でもHashは減らせない)
+            server.init_server(
+                game_server_num, [(engine1, options_common), (engine2, options_common)]
+            )
+            log.print(server.memory_plan)
+            server.player_names = [info1.engine_folder, info2.engine_folder]
+
+            # 持ち時間設定。
+            server.set_time_setting(args.time)
+
+            # flip_turnを反映させる
+            server.flip_turn_every_game = args.flip_turn
+
+            # 開始局面を先後入れ替えて2局ずつ対局させる
+            server.paired_openings = args.paired
+
+            # 定跡(イテレーションの開始前に読み込んだもの)
+            server.start_sfens = start_sfens
+            server.start_gameply = start_gameply
+            server.book = shared_book
+
+            # 対局スレッド数、秒読み設定などを短縮文字列化する。
+            if thread1 == thread2:
+                game_setting_str = "t{0}".format(thread1)
+            else:
+                game_setting_str = "t{0},{1}".format(thread1, thread2)
+            game_setting_str += (
+                args.time.replace("byoyomi", "b")
+                .replace("time", "t")
+                .replace("inc", "i")
+                .replace(" ", "")
+            )
+
+            # loop回数試合終了するのを待つ
+            last_total_games = 0
+            loop = args.loop
+
+            # ゲーム数が増えていたら、途中結果を出力する。
+            def output_info():
+                nonlocal last_total_games, server, log
+                if last_total_games != server.total_games:
+                    last_total_games = server.total_games
+                    log.print(game_setting_str + "." + server.game_info())
+
+            # 途中経過の保存と復元
+            server.checkpoint_path = checkpoint_path
+            server.kifu_path = checkpoint_path + ".kifu"
+            server.checkpoint_extra = {
+                "args": checkpoint_args,
+                "iteration": it,
+                "pairing": [p1, p2],
+                "random": ayane.Checkpoint.random_state(),
+            }
+            if store is not None:
+                # データベースに記録した対局を指し直すことがないように、1局ごとに保存する。
+                server.checkpoint_interval = 1
+            if resume_state is not None and "server" in resume_state:
+                server.restore(resume_state["server"])
+            resume_state = None
+
+            # これで対局が開始する
+            server.game_start()
+
+            while server.total_games < loop:
+                output_info()
+                time.sleep(1)
+            output_info()
+
+            # game_stop()でエンジンは終了してしまうので、その前に出力しておく。
+            if args.resource_report:
+                log.print(server.resource_info(), also_print=True)
+
+            if controller is not None:
+                for history in controller.history:
+                    log.print(history, also_print=True)
+
+            server.game_stop()
+
+            # 対局棋譜の出力(ログとしてフォルダに書き出しておく)
+            for kifu in server.game_kifus:
+                log.print(
+                    "game sfen = {0} , flip_turn = {1} , game_result = {2}".format(
+                        kifu.sfen, kifu.flip_turn, str(kifu.game_result)
+                    ),
+                    also_print=False,
+                )
+
+            # 対局が終わったのでレーティングの移動を行う
+            update_rating(info1, info2, server.game_rating(), loop)
+
+            # レーティングを書き戻したので、次のイテレーションから再開できるようにしておく。
+            ayane.Checkpoint.save(
+                checkpoint_path,
+                {
+                    "args": checkpoint_args,
+                    "iteration": it + 1,
+                    "random": ayane.Checkpoint.random_state(),
+                },
+            )
+
     # iteration回数だけ繰り返したので終了する。
+    for path in [checkpoint_path, checkpoint_path + ".kifu"]:
+        if os.path.exists(path):
+            os.remove(path)
     output_engine_rating()
     log.print("iteration end", also_print=True, output_datetime=True)
-    server.terminate()
+    if tracer is not None:
+        tracer.write(args.trace)
+    if store is not None:
+        store.close()
     log.close()
 
 
@@ -0,0 +1,204 @@
+# あやねるマイクロベンチマーク
+# エンジンから受信したメッセージを処理する部分(UsiEngine.dispatch_message , handle_info , handle_bestmove , Scanner ,
+# change_state)と、EloRating.calc()の1回あたりの処理時間を、エンジンの出力のコーパスを用いて計測するスクリプト。
+# エンジンは起動しない。
+
+# 各ケースはtimeitで0.2秒以上かかる回数を求めてから、それを--repeat回繰り返して、最小値と中央値を1メッセージあたりの時間で表示する。
+# 比較には最小値を用いる。(他のプロセスの影響は時間が増える方向にしか働かないため)
+# 変更前に --json base.json で保存しておき、変更後に --compare base.json とすれば、ケースごとの比(変更後/変更前)が表示される。
+
+# === 本スクリプトの引数の意味 ===
+
+# --corpus
+# エンジンの出力を1行1メッセージで並べたファイル。"#"で始まる行と空行は読み飛ばす。(デフォルト:bench/usi-corpus.txt)
+# デフォルトのものは、やねうら王の出力の書式に合わせて手で作ったもの。
+# エンジンの標準出力をファイルに落としたものをそのまま指定しても良い。
+
+# --repeat
+# 各ケースを計測する回数(デフォルト:7)
+
+# --filter
+# ケース名にこの文字列を含むものだけを計測する。
+
+# --json
+# 指定したファイルに計測結果をJSONで書き出す。
+
+# --compare
+# --jsonで書き出したファイルを指定すると、その結果との比を表示する。
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import statistics
+import shogi.Ayane as ayane
+
+
+# corpusを読み込む。
+def read_corpus(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        lines = [line.rstrip("\r\n") for line in f]
+    return [line for line in lines if line != "" and not line.startswith("#")]
+
+
+# 計測ケースのlistを作る。
+# 1つのケースは(ケース名 , 計測する関数 , 関数1回あたりのメッセージ数)
+def make_cases(corpus: list) -> list:
+    infos = [line for line in corpus if line.startswith("info ")]
+    bestmoves = [line for line in corpus if line.startswith("bestmove")]
+
+    def pv_length(line: str) -> int:
+        index = line.find(" pv ")
+        return 0 if index == -1 else len(line[index + 4 :].split())
+
+    long_pv = [line for line in infos if pv_length(line) >= 30]
+    mate = [line for line in infos if " score mate " in line]
+    multipv = [line for line in infos if " multipv " in line]
+    single_pv = [
+        line
+        for line in infos
+        if line not in long_pv and line not in mate and line not in multipv
+    ]
+
+    # 接続していないUsiEngineに直接メッセージを渡す。
+    engine = ayane.UsiEngine()
+    engine.think_result = ayane.UsiThinkResult()
+    engine.engine_state = ayane.UsiEngineState.WaitCommand
+
+    def dispatch_message(lines: list):
+        def run():
+            for line in lines:
+                engine.dispatch_message(line)
+
+        return run
+
+    def handle_info(lines: list):
+        def run():
+            for line in lines:
+                engine.handle_info(line)
+
+        return run
+
+    def handle_bestmove():
+        for line in bestmoves:
+            engine.handle_bestmove(line)
+
+    def scanner():
+        for line in infos:
+            scanner = ayane.Scanner(line.split(), 1)
+            while not scanner.is_eof():
+                if scanner.get_token() == "pv":
+                    scanner.rest_string()
+
+    def change_state():
+        engine.change_state(ayane.UsiEngineState.WaitBestmove)
+        engine.change_state(ayane.UsiEngineState.WaitCommand)
+
+    elo = ayane.EloRating()
+    elo.player1_win = 5123
+    elo.player2_win = 4877
+    elo.black_win = 5210
+    elo.white_win = 4790
+    elo.draw_games = 312
+    elo.pentanomial = [301, 1190, 2110, 1215, 339]
+
+    cases = [
+        ("dispatch_message(corpus)", dispatch_message(corpus), len(corpus)),
+        ("handle_info(single pv)", handle_info(single_pv), len(single_pv)),
+        ("handle_info(multipv)", handle_info(multipv), len(multipv)),
+        ("handle_info(mate)", handle_info(mate), len(mate)),
+        ("handle_info(long pv)", handle_info(long_pv), len(long_pv)),
+        ("handle_bestmove", handle_bestmove, len(bestmoves)),
+        ("Scanner", scanner, len(infos)),
+        ("change_state", change_state, 2),
+        ("EloRating.calc", elo.calc, 1),
+    ]
+    # corpusに該当するメッセージがないケースは除く。
+    return [case for case in cases if case[2] > 0]
+
+
+# funcを計測して、1メッセージあたりの時間[ns]の最小値と中央値を返す。
+def measure(func, messages: int, repeat: int) -> tuple:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number / messages * 1e9 for t in timer.repeat(repeat, number)]
+    return min(times), statistics.median(times)
+
+
+def AyaneruMicroBenchmark():
+    # --- コマンドラインのparseここから ---
+
+    parser = argparse.ArgumentParser("ayaneru-microbenchmark.py")
+
+    # corpus
+    parser.add_argument(
+        "--corpus",
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "usi-corpus.txt"),
+        help="engine output corpus",
+    )
+
+    # repeat
+    parser.add_argument("--repeat", type=int, default=7, help="number of repeats")
+
+    # filter
+    parser.add_argument("--filter", type=str, default="", help="case name filter")
+
+    # json
+    parser.add_argument("--json", type=str, default=None, help="result json filepath")
+
+    # compare
+    parser.add_argument(
+        "--compare", type=str, default=None, help="baseline json filepath"
+    )
+
+    args = parser.parse_args()
+
+    # --- コマンドラインのparseここまで ---
+
+    print("corpus         : {0}".format(args.corpus))
+    print("repeat         : {0}".format(args.repeat))
+    print("filter         : {0}".format(args.filter))
+    print("python         : {0}".format(sys.version.split()[0]))
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = {r["name"]: r for r in json.load(f)["results"]}
+
+    corpus = read_corpus(args.corpus)
+    print("messages       : {0}".format(len(corpus)))
+
+    results = []
+    for name, func, messages in make_cases(corpus):
+        if args.filter not in name:
+            continue
+        best, median = measure(func, messages, args.repeat)
+        line = "{0:<26}: {1:>10.1f} ns/msg (median {2:>10.1f}) x{3}".format(
+            name, best, median, messages
+        )
+        if name in baseline:
+            line += " , {0:.3f}x".format(best / baseline[name]["best_ns"])
+        print(line, flush=True)
+        results.append(
+            {"name": name, "messages": messages, "best_ns": best, "median_ns": median}
+        )
+
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "corpus": args.corpus,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    AyaneruMicroBenchmark()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# あやねるリプレイエンジン
+# UsiEngine.transcript_path(ayaneru-colosseum.py --transcript)で記録したエンジンとのやりとりを再生するUSIエンジン。(ReplayUsiEngine)
+# 受け取ったコマンドに対して、記録したときにエンジンが返した応答を、記録したときと同じタイミングで返す。
+# 本物のエンジンがないマシンでも、記録したときと同じ量の"info"を流して、python側の処理を計測・プロファイルできる。
+
+# 標準入出力でやりとりするので、引数の表示などはしない。
+# UsiEngineから起動する場合は引数を渡せないので、エンジンオプションで
+# "ReplayTranscript"(transcriptのpath)と"ReplaySpeed"(再生速度)を指定すること。
+# 例) usi.set_engine_options({"ReplayTranscript":"/tmp/transcript/server0-engine0.txt","ReplaySpeed":"10"})
+
+# === 本スクリプトの引数の意味 ===
+
+# --transcript
+# 再生するtranscriptのファイル
+
+# --speed
+# 再生速度。2なら記録したときの2倍の速さで応答する。0なら待たずにすぐに応答する。(デフォルト:1)
+
+import sys
+import argparse
+import shogi.Ayane as ayane
+
+
+def AyaneruReplayEngine():
+    parser = argparse.ArgumentParser("ayaneru-replay-engine.py")
+    parser.add_argument("--transcript", type=str, default=None, help="transcript filepath")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed")
+    args = parser.parse_args()
+
+    engine = ayane.ReplayUsiEngine(args.transcript)
+    engine.speed = args.speed
+    engine.run(sys.stdin, sys.stdout)
+
+
+if __name__ == "__main__":
+    AyaneruReplayEngine()
@@ -0,0 +1,121 @@
+# あやねるワーカー
+# ayaneru-colosseum.py --listen で待ち受けているコーディネーターに接続して、
+# 割り当てられた対局をこのマシンで並列に対局させるスクリプト。(MatchWorker)
+# 複数のマシンでそれぞれこのスクリプトを動かすと、それらのマシンの対局をコーディネーターがまとめて集計する。
+
+# エンジン、評価関数のフォルダ、持ち時間などはコーディネーター側のayaneru-colosseum.pyの引数で指定したものが送られてくる。
+# エンジンと評価関数のフォルダ、共有定跡は、このマシンの--home相対で解釈されるので、各マシンで同じ配置にしておくこと。
+
+# === 本スクリプトの引数の意味 ===
+
+# --coordinator
+# 接続するコーディネーターの"ホスト:ポート番号"
+# 例 : --coordinator 192.168.0.10:4091
+
+# --home
+# エンジンなどが存在するホームディレクトリ
+
+# --cores
+# このマシンのCPUのコア数。2スレッド余らせて、エンジンのスレッド数で割った数だけ並列に対局させる。
+
+# --slots
+# 並列対局数。指定すると--coresより優先される。
+
+# --name
+# コーディネーターに表示される名前。(デフォルト:ホスト名)
+
+# --retry
+# コーディネーターに接続できないとき、接続が切れたときに、5秒ごとに接続し直す回数。(デフォルト:12)
+# コーディネーターを--resumeで再起動する間、待っておける。
+
+# --affinity
+# 指定すると、並列対局の各スロットに重複しないCPUの集合を割り当てる。(ayaneru-colosseum.pyの--affinityと同じ)
+
+# --memory_policy
+# すべてのエンジンが空きメモリに収まらないときの対処。(ayaneru-colosseum.pyの--memory_policyと同じ)
+
+import argparse
+import socket
+import shogi.Ayane as ayane
+
+
+def AyaneruWorker():
+    # --- コマンドラインのparseここから ---
+
+    parser = argparse.ArgumentParser("ayaneru-worker.py")
+
+    # coordinator
+    parser.add_argument(
+        "--coordinator", type=str, default="localhost:4091", help="coordinator host:port"
+    )
+
+    # home folder
+    parser.add_argument("--home", type=str, default="", help="home folder")
+
+    # CPUコア数
+    parser.add_argument(
+        "--cores", type=int, default=8, help="cpu cores(number of logical thread)"
+    )
+
+    # 並列対局数
+    parser.add_argument(
+        "--slots", type=int, default=0, help="number of parallel games"
+    )
+
+    # name
+    parser.add_argument(
+        "--name", type=str, default=socket.gethostname(), help="worker name"
+    )
+
+    # retry
+    parser.add_argument(
+        "--retry", type=int, default=12, help="number of reconnection attempts"
+    )
+
+    # affinity
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="bind engines of each game to a disjoint cpu set",
+    )
+
+    # memory_policy
+    parser.add_argument(
+        "--memory_policy",
+        type=str,
+        default="cap",
+        choices=["cap", "scale_hash", "refuse"],
+        help="what to do when engines do not fit in memory",
+    )
+
+    args = parser.parse_args()
+
+    # --- コマンドラインのparseここまで ---
+
+    print("coordinator    : {0}".format(args.coordinator))
+    print("home           : {0}".format(args.home))
+    print("cores          : {0}".format(args.cores))
+    print("slots          : {0}".format(args.slots))
+    print("name           : {0}".format(args.name))
+    print("retry          : {0}".format(args.retry))
+    print("affinity       : {0}".format(args.affinity))
+    print("memory_policy  : {0}".format(args.memory_policy))
+
+    worker = ayane.MatchWorker()
+    worker.home = args.home
+    worker.cores = args.cores
+    worker.slots = args.slots
+    worker.name = args.name
+    worker.retry_count = args.retry
+    worker.server.cpu_affinity = args.affinity
+    worker.server.memory_policy = args.memory_policy
+
+    # コーディネーターが対局の割り当てを終えるまで戻ってこない。
+    host, port = args.coordinator.rsplit(":", 1)
+    worker.run(host, int(port))
+
+    print("finished : {0} games".format(worker.total_games))
+
+
+if __name__ == "__main__":
+    AyaneruWorker()
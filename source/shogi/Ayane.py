@@ -1,16 +1,28 @@
 import threading
 import subprocess
+import shutil
 import time
 import os
+import sys
 import math
 import random
 import io
-from queue import Queue
+import json
+import sqlite3
+import socket
+import multiprocessing
+import mmap
+import re
+import cProfile
+import pstats
+import tracemalloc
+from queue import Queue, Empty, Full
+from array import array
 from enum import Enum
 from enum import IntEnum
 from datetime import datetime
 from typing import Optional, Union, cast
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Callable
 
 # unit_test1.pyのほうのコードを見ると最低限の使い方は理解できるはずです。(それがサンプルを兼ねているので)
 
@@ -154,6 +166,322 @@ class SingletonLog:
     __static_lock_object = threading.Lock()
 
 
+# エンジンの思考区間やハーネス側の待ち時間などを、Chrome trace-event形式で記録するためのクラス。
+# write()で書き出したJSONファイルは、chrome://tracing や https://ui.perfetto.dev で開ける。
+# pidが対局サーバー(スロット)、tidがエンジン(やスロットの対局レーン)に相当する。
+class ChromeTracer:
+    def __init__(self):
+
+        # --- public readonly members ---
+
+        # 記録したイベント。(Chrome trace-eventのdictのlist)
+        self.events: List[dict] = []
+
+        # --- private members ---
+
+        # 時刻の基準。tsはこの時刻からの経過時間[μs]として記録する。
+        self.base_time = time.perf_counter()
+
+        # eventsに追加するときのlock用
+        self.lock_object = threading.Lock()
+
+    # 現在時刻[s]を返す。complete()に渡すstart,endはこれで取得したものとする。
+    def now(self) -> float:
+        return time.perf_counter()
+
+    # start～endの区間(span)を1つ記録する。
+    # name : 区間の名前 , pid/tid : 表示する行 , args : 付随情報(trace viewerで区間を選択すると表示される)
+    def complete(
+        self,
+        name: str,
+        start: float,
+        end: float,
+        pid: int,
+        tid: int,
+        cat: str = "",
+        args: Optional[dict] = None,
+    ):
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start - self.base_time) * 1000000,
+            "dur": max(end - start, 0) * 1000000,
+            "pid": pid,
+            "tid": tid,
+        }
+        if args is not None:
+            event["args"] = args
+        self.append(event)
+
+    # ある時点での出来事を1つ記録する。
+    def instant(
+        self, name: str, pid: int, tid: int, cat: str = "", args: Optional[dict] = None
+    ):
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "i",
+            "s": "t",
+            "ts": (self.now() - self.base_time) * 1000000,
+            "pid": pid,
+            "tid": tid,
+        }
+        if args is not None:
+            event["args"] = args
+        self.append(event)
+
+    # trace viewerでpidの行に表示される名前を設定する。
+    def set_process_name(self, pid: int, name: str):
+        self.append(
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+        )
+
+    # trace viewerでtidの行に表示される名前を設定する。
+    def set_thread_name(self, pid: int, tid: int, name: str):
+        self.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+        )
+
+    # イベントを1つ追加する。
+    def append(self, event: dict):
+        with self.lock_object:
+            self.events.append(event)
+
+    # 記録した内容をChrome trace-event形式のJSONファイルとして書き出す。
+    def write(self, path: str):
+        with self.lock_object:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# python側がどこでCPU時間を消費しているか、メモリが増え続けていないかを、外部のツールなしで調べるためのクラス。
+# UsiEngine , AyaneruServer , MultiAyaneruServerのprofilerに設定しておくと、UsiEngineのread_worker , write_worker、
+# AyaneruServer , MultiAyaneruServerのgame_workerをスレッドごとに計測して、スレッドの終了時に名前ごとに集計する。
+# また、UsiEngine.handle_infoは呼び出しごとの時間を集計する。
+# mode :
+#   "timer"    : 経過時間とCPU時間(time.thread_time())だけを集計する。軽いので長時間の対局でも用いることができる。
+#   "cprofile" : スレッドごとにcProfileで関数ごとのCPU時間を計測して、1つにまとめる。数倍遅くなるので注意。
+#                (エンジンの応答待ちなどで寝ている時間は含まれない)
+# memory_interval : この秒数ごとにtracemallocのsnapshotを取り、最初のsnapshotからの増加量が大きいコードの行を報告する。
+#                   0ならメモリは調べない。(tracemallocを有効にすると、メモリの確保が遅くなる)
+#
+# 使い方)
+#   server.profiler = Profiler("timer", 600)  # init_server()の前に設定する。
+#   ...
+#   server.game_stop()
+#   server.profiler.write("profile.txt")
+class Profiler:
+    def __init__(self, mode: str = "timer", memory_interval: float = 0):
+        if mode not in ("timer", "cprofile"):
+            raise ValueError("illegal profiler mode : " + mode)
+
+        # --- public members ---
+
+        # 報告する関数、コードの行の数
+        self.top = 30
+
+        # memoryのsnapshotを取るときに一緒に記録する値。{名前 : 値を返す関数}
+        # MultiAyaneruServerは"game_kifus"(保持している棋譜の数)などを登録する。
+        self.gauges: Dict[str, Callable[[], int]] = {}
+
+        # --- public readonly members ---
+
+        self.mode = mode
+        self.memory_interval = memory_interval
+
+        # 名前ごとの[回数 , 経過時間[s] , CPU時間[s]]
+        self.timers: Dict[str, List[float]] = {}
+
+        # cprofileで計測した結果を1つにまとめたもの
+        self.stats: Optional[pstats.Stats] = None
+
+        # memoryのsnapshotごとの(start()からの経過時間[s] , tracemallocで確保中のサイズ[byte] , gaugesの値)
+        self.memory_samples: List[Tuple[float, int, Dict[str, int]]] = []
+
+        # --- private members ---
+
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+
+        # 最初と最後のsnapshot
+        self.first_snapshot: Optional[tracemalloc.Snapshot] = None
+        self.last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+        # snapshotを取るスレッドと、その停止用
+        self.memory_thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+        # tracemallocをこのインスタンスが開始したか
+        self.tracemalloc_started = False
+
+    # funcをスレッドとして実行する関数を返す。(threading.Threadのtargetに渡す)
+    # funcが終了したら、nameの経過時間とCPU時間(cprofileなら関数ごとの時間も)を集計する。
+    def wrap(self, name: str, func: Callable[[], None]) -> Callable[[], None]:
+        return lambda: self.run(name, func)
+
+    def run(self, name: str, func: Callable[[], None]):
+        profile = None
+        if self.mode == "cprofile":
+            profile = cProfile.Profile(time.thread_time)
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12以降では、複数のスレッドで同時にcProfileを有効にできない。このスレッドは時間だけ集計する。
+                profile = None
+
+        start_time = time.perf_counter()
+        start_cpu_time = time.thread_time()
+        try:
+            func()
+        finally:
+            if profile is not None:
+                profile.disable()
+            self.add_time(
+                name,
+                time.perf_counter() - start_time,
+                time.thread_time() - start_cpu_time,
+            )
+            if profile is not None:
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+
+    # func(*args)を呼び出して、nameの経過時間とCPU時間を集計する。
+    def measure(self, name: str, func: Callable, *args):
+        start_time = time.perf_counter()
+        start_cpu_time = time.thread_time()
+        try:
+            return func(*args)
+        finally:
+            self.add_time(
+                name,
+                time.perf_counter() - start_time,
+                time.thread_time() - start_cpu_time,
+            )
+
+    # nameの回数、経過時間[s]、CPU時間[s]を加算する。
+    def add_time(self, name: str, elapsed: float, cpu_time: float):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, elapsed, cpu_time]
+            else:
+                timer[0] += 1
+                timer[1] += elapsed
+                timer[2] += cpu_time
+
+    # memoryの計測を開始する。(memory_interval == 0なら何もしない)
+    def start(self):
+        self.start_time = time.perf_counter()
+        if self.memory_interval <= 0 or self.memory_thread is not None:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracemalloc_started = True
+        self.stop_event.clear()
+        self.sample_memory()
+
+        def worker():
+            while not self.stop_event.wait(self.memory_interval):
+                self.sample_memory()
+
+        self.memory_thread = threading.Thread(target=worker, daemon=True)
+        self.memory_thread.start()
+
+    # memoryの計測を終了する。
+    def stop(self):
+        if self.memory_thread is None:
+            return
+        self.stop_event.set()
+        self.memory_thread.join()
+        self.memory_thread = None
+        self.sample_memory()
+        if self.tracemalloc_started:
+            tracemalloc.stop()
+            self.tracemalloc_started = False
+
+    # tracemallocのsnapshotを取り、確保中のサイズとgaugesの値を記録する。
+    def sample_memory(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        current, _ = tracemalloc.get_traced_memory()
+        gauges = {}
+        for name, gauge in list(self.gauges.items()):
+            try:
+                gauges[name] = gauge()
+            except Exception:
+                # 計測対象が終了処理中など。
+                pass
+        with self.lock:
+            if self.first_snapshot is None:
+                self.first_snapshot = snapshot
+            self.last_snapshot = snapshot
+            self.memory_samples.append(
+                (time.perf_counter() - self.start_time, current, gauges)
+            )
+
+    # 集計結果を文字列にして返す。
+    def report(self) -> str:
+        with self.lock:
+            timers = sorted(self.timers.items(), key=lambda t: -t[1][2])
+            lines = ["--- threads and functions (cpu time order) ---"]
+            lines.append(
+                "{0:<32} {1:>10} {2:>12} {3:>12} {4:>7}".format(
+                    "name", "count", "wall[s]", "cpu[s]", "cpu%"
+                )
+            )
+            for name, (count, elapsed, cpu_time) in timers:
+                lines.append(
+                    "{0:<32} {1:>10} {2:>12.3f} {3:>12.3f} {4:>6.1f}%".format(
+                        name, int(count), elapsed, cpu_time, cpu_time * 100 / max(elapsed, 1e-9)
+                    )
+                )
+
+            if self.stats is not None:
+                lines.append("")
+                lines.append("--- cProfile (all threads , cumulative cpu time order) ---")
+                stream = io.StringIO()
+                self.stats.stream = stream
+                self.stats.sort_stats("cumulative").print_stats(self.top)
+                lines.append(stream.getvalue().rstrip())
+
+            if self.memory_samples:
+                lines.append("")
+                lines.append("--- memory ---")
+                for elapsed, current, gauges in self.memory_samples:
+                    lines.append(
+                        "{0:>10.0f}s {1:>10.1f}MB {2}".format(
+                            elapsed,
+                            current / (1024 * 1024),
+                            " , ".join("{0} = {1}".format(k, v) for k, v in gauges.items()),
+                        )
+                    )
+
+            if self.first_snapshot is not None and self.last_snapshot is not None:
+                lines.append("")
+                lines.append("--- memory growth from the first snapshot (top {0}) ---".format(self.top))
+                for stat in self.last_snapshot.compare_to(self.first_snapshot, "lineno")[: self.top]:
+                    lines.append(str(stat))
+
+        return "\n".join(lines) + "\n"
+
+    # report()をファイルに書き出す。
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.report())
+
+
 # 手番を表現するEnum
 class Turn(IntEnum):
     BLACK = 0  # 先手
@@ -367,6 +695,169 @@ class UsiThinkResult:
         return s
 
 
+# "info"で送られてきた読み筋を、探索ごとに深さ順に列指向(array)で記録するもの。
+# UsiEngine.handle_info()はthink_result.pvs[multipv-1]を上書きしていくので、探索の途中経過(深さごとの評価値、
+# nodes/timeの推移、boundの変化)は残らない。UsiEngine.pv_recorderにこれを設定しておくと、それらをすべて記録する。
+# 数千局面分を記録してもpythonのobjectが増えないように、読み筋は指し手の番号(self.move_names のindex)の列として
+# 1つのarray(self.moves)に詰めて、各行からはその開始位置(self.pv_offsets)で参照する。
+#
+# 使い方)
+#   recorder = PvTraceRecorder()
+#   usi.pv_recorder = recorder       # usi_go()ごとに1つの探索として記録される。
+#   ...
+#   start, end = recorder.search_range(0)        # 0番目の探索の行の範囲
+#   recorder.depth[start:end] , recorder.eval[start:end]
+#   columns = recorder.to_numpy()                # numpyがインストールされていれば、各列をnumpyの配列として取得できる。
+#
+# 1つのPvTraceRecorderには、1つのUsiEngineから記録すること。(探索ごとの行が連続している前提)
+class PvTraceRecorder:
+    def __init__(self):
+
+        # --- public readonly members ---
+
+        # 1行(1回の"info")ごとの列。値がなかったものはNO_VALUE。
+        # bound : UsiBoundの値(0:なし 1:upperbound 2:lowerbound 3:exact)
+        self.depth = array("i")
+        self.seldepth = array("i")
+        self.eval = array("i")
+        self.bound = array("b")
+        self.nodes = array("q")
+        self.time = array("q")
+        self.multipv = array("h")
+
+        # 各行の読み筋の、self.movesでの開始位置。行数+1個あって、i行目の読み筋はmoves[pv_offsets[i]:pv_offsets[i+1]]
+        self.pv_offsets = array("q", [0])
+
+        # すべての行の読み筋の指し手の番号を連結したもの。
+        self.moves = array("H")
+
+        # 指し手の番号 → USIの指し手文字列 ("rep_draw"などの特殊な表記も含む)
+        self.move_names: List[str] = []
+
+        # 各探索の最初の行の番号。探索数+1個あって、i番目の探索の行はsearch_offsets[i]～search_offsets[i+1]-1
+        self.search_offsets = array("q", [0])
+
+        # 各探索の局面("position"コマンドで送った文字列)
+        self.search_positions: List[str] = []
+
+        # --- private members ---
+
+        # USIの指し手文字列 → 指し手の番号
+        self.move_ids: Dict[str, int] = {}
+
+    # 値がないことを表す値
+    NO_VALUE = -(2 ** 31)
+
+    # 記録した行数
+    def __len__(self) -> int:
+        return len(self.depth)
+
+    # 記録した探索の数
+    def searches(self) -> int:
+        return len(self.search_positions)
+
+    # 新しい探索の記録を開始する。(UsiEngine.usi_go()から呼び出される)
+    def begin_search(self, position: str = ""):
+        if self.search_positions:
+            self.search_offsets.append(len(self.depth))
+        self.search_positions.append(position)
+
+    # 1行分の読み筋を記録する。(UsiEngine.handle_info()から呼び出される)
+    def record(self, pv: UsiThinkPV, multipv: int):
+        if not self.search_positions:
+            self.begin_search()
+
+        no_value = PvTraceRecorder.NO_VALUE
+        self.depth.append(int(pv.depth) if pv.depth is not None else no_value)
+        self.seldepth.append(int(pv.seldepth) if pv.seldepth is not None else no_value)
+        self.eval.append(int(pv.eval) if pv.eval is not None else no_value)
+        self.bound.append(pv.bound.value if pv.bound is not None else 0)
+        self.nodes.append(int(pv.nodes) if pv.nodes is not None else no_value)
+        self.time.append(int(pv.time) if pv.time is not None else no_value)
+        self.multipv.append(multipv)
+
+        if pv.pv is not None:
+            move_ids = self.move_ids
+            for move in pv.pv.split():
+                move_id = move_ids.get(move)
+                if move_id is None:
+                    move_id = len(self.move_names)
+                    move_ids[move] = move_id
+                    self.move_names.append(move)
+                self.moves.append(move_id)
+        self.pv_offsets.append(len(self.moves))
+
+    # i番目の探索の行の範囲(start , end)を返す。
+    def search_range(self, i: int) -> Tuple[int, int]:
+        start = self.search_offsets[i]
+        end = self.search_offsets[i + 1] if i + 1 < len(self.search_offsets) else len(self.depth)
+        return start, end
+
+    # row行目の読み筋をUSIの指し手文字列のlistで返す。
+    def pv(self, row: int) -> List[str]:
+        return [
+            self.move_names[m]
+            for m in self.moves[self.pv_offsets[row] : self.pv_offsets[row + 1]]
+        ]
+
+    # 各列をnumpyの配列(コピーせずにarrayのバッファをそのまま参照する)にして、{列名 : 配列}で返す。
+    # numpyはこのメソッドでしか用いないので、インストールされていなければここでImportErrorになる。
+    def to_numpy(self) -> dict:
+        import numpy
+
+        return {
+            name: numpy.frombuffer(column, dtype=column.typecode)
+            for name, column in self.columns().items()
+        }
+
+    # 列名とarrayのdict
+    def columns(self) -> Dict[str, array]:
+        return {
+            "depth": self.depth,
+            "seldepth": self.seldepth,
+            "eval": self.eval,
+            "bound": self.bound,
+            "nodes": self.nodes,
+            "time": self.time,
+            "multipv": self.multipv,
+            "pv_offsets": self.pv_offsets,
+            "moves": self.moves,
+            "search_offsets": self.search_offsets,
+        }
+
+    # ファイルに書き出す。
+    # 1行目に列の型と要素数、指し手文字列、局面のJSONを書いて、そのあとに各列のarrayをそのまま書き出す。
+    def save(self, path: str):
+        columns = self.columns()
+        header = {
+            "version": 1,
+            "columns": [[name, a.typecode, len(a)] for name, a in columns.items()],
+            "move_names": self.move_names,
+            "search_positions": self.search_positions,
+        }
+        with open(path, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for a in columns.values():
+                a.tofile(f)
+
+    # save()で書き出したファイルを読み込む。
+    @staticmethod
+    def load(path: str):  # -> PvTraceRecorder
+        recorder = PvTraceRecorder()
+        with open(path, "rb") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            if header.get("version") != 1:
+                raise ValueError("unsupported pv trace file : " + path)
+            for name, typecode, length in header["columns"]:
+                a = array(typecode)
+                a.fromfile(f, length)
+                setattr(recorder, name, a)
+        recorder.move_names = header["move_names"]
+        recorder.move_ids = {move: i for i, move in enumerate(recorder.move_names)}
+        recorder.search_positions = header["search_positions"]
+        return recorder
+
+
 # 文字列のparseを行うもの。
 class Scanner:
     # argsとしてstr[]を渡しておく。
@@ -417,6 +908,399 @@ class Scanner:
         return " ".join(self.args)
 
 
+# プロセスが消費したCPU時間とメモリ使用量(RSS)。
+# Linuxの/proc/<pid>から読み取る。(/procのない環境ではread()がNoneを返す)
+class ProcessUsage:
+    def __init__(self):
+
+        # --- public members ---
+
+        # 消費したCPU時間(utime + stime)の合計[s]
+        self.cpu_time = 0.0
+
+        # 物理メモリ使用量[byte]
+        self.rss = 0
+
+    # pidのプロセスと、その子孫プロセスのCPU時間とRSSの合計を読み取る。
+    # UsiEngineはshell経由でエンジンを起動するので、shellの子プロセスとして起動したエンジンの分も合算する必要がある。
+    # 読み取れなかったときはNoneが返る。
+    @classmethod
+    def read(cls, pid: int):  # -> Optional[ProcessUsage]
+        if not os.path.exists("/proc/{0}/stat".format(pid)):
+            return None
+
+        usage = ProcessUsage()
+        for p in cls.process_tree(pid):
+            try:
+                with open("/proc/{0}/stat".format(p)) as f:
+                    stat = f.read()
+                # 2つ目の項目(プロセス名)は括弧で囲まれていて、空白を含むことがあるので、")"以降をsplitする。
+                fields = stat[stat.rindex(")") + 2 :].split()
+                usage.cpu_time += (int(fields[11]) + int(fields[12])) / cls.clock_ticks
+                usage.rss += int(fields[21]) * cls.page_size
+            except (OSError, ValueError, IndexError):
+                # 読み取り中にプロセスが終了したなど。
+                if p == pid:
+                    return None
+        return usage
+
+    # pidと、その子孫プロセスのpidを列挙して返す。(/procから読み取る)
+    @staticmethod
+    def process_tree(pid: int) -> List[int]:
+        result = []
+        pids = [pid]
+        while pids:
+            p = pids.pop()
+            result.append(p)
+            try:
+                task_folder = "/proc/{0}/task".format(p)
+                for tid in os.listdir(task_folder):
+                    children_path = os.path.join(task_folder, tid, "children")
+                    if os.path.exists(children_path):
+                        with open(children_path) as f:
+                            pids.extend(int(c) for c in f.read().split())
+            except (OSError, ValueError):
+                pass
+        return result
+
+    # --- private static members ---
+
+    # /proc/<pid>/statのutime,stimeの単位([1/s])
+    clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    # /proc/<pid>/statのrssの単位([byte])
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+# CPUのトポロジー(NUMAノード、物理コア)を/sys/devices/system以下から読み取り、
+# 並列対局の各スロットに重複しないCPUの集合を割り当てるためのクラス。
+# 1つのスロットに割り当てるCPUは、なるべく同じNUMAノード内の、同じ物理コアのもの(SMTの兄弟)がまとまるようにする。
+class CpuTopology:
+    def __init__(self):
+
+        # --- public readonly members ---
+
+        # このプロセスが使えるCPU番号のlist
+        if hasattr(os, "sched_getaffinity"):
+            self.cpus = sorted(os.sched_getaffinity(0))
+        else:
+            self.cpus = list(range(os.cpu_count() or 1))
+
+        # CPU番号 → NUMAノード番号 (NUMAノードの情報が取れなければすべて0)
+        self.cpu_to_node: Dict[int, int] = {}
+
+        # CPU番号 → (ソケット番号 , コア番号)
+        self.cpu_to_core: Dict[int, Tuple[int, int]] = {}
+
+        node_folder = "/sys/devices/system/node"
+        if os.path.exists(node_folder):
+            for name in os.listdir(node_folder):
+                if not (name.startswith("node") and name[4:].isdigit()):
+                    continue
+                with open(os.path.join(node_folder, name, "cpulist")) as f:
+                    for cpu in CpuTopology.parse_cpulist(f.read()):
+                        self.cpu_to_node[cpu] = int(name[4:])
+
+        for cpu in self.cpus:
+            self.cpu_to_node.setdefault(cpu, 0)
+            topology_folder = "/sys/devices/system/cpu/cpu{0}/topology".format(cpu)
+            try:
+                with open(os.path.join(topology_folder, "physical_package_id")) as f:
+                    package_id = int(f.read())
+                with open(os.path.join(topology_folder, "core_id")) as f:
+                    core_id = int(f.read())
+            except (OSError, ValueError):
+                package_id, core_id = 0, cpu
+            self.cpu_to_core[cpu] = (package_id, core_id)
+
+    # num個のスロットに、CPUの集合とNUMAノード番号を割り当てて返す。
+    # 返し値 : [(CPU番号のlist , NUMAノード番号) , ...] の形。複数ノードにまたがった集合のノード番号はNoneになる。
+    # CPUの数がnumより少ないときは、仕方ないので同じ集合を複数のスロットに割り当てる。
+    def allocate(self, num: int) -> List[Tuple[List[int], Optional[int]]]:
+        size = max(len(self.cpus) // num, 1)
+
+        # ノードごとに、同じ物理コアのCPUが隣り合うように並べる。
+        nodes: Dict[int, List[int]] = {}
+        for cpu in sorted(
+            self.cpus, key=lambda c: (self.cpu_to_node[c], self.cpu_to_core[c], c)
+        ):
+            nodes.setdefault(self.cpu_to_node[cpu], []).append(cpu)
+
+        sets: List[Tuple[List[int], Optional[int]]] = []
+        rest: List[int] = []
+        for node, cpus in sorted(nodes.items()):
+            while len(cpus) >= size and len(sets) < num:
+                sets.append((cpus[:size], node))
+                cpus = cpus[size:]
+            rest += cpus
+
+        # ノード内で割り切れずに余ったCPUは、ノードをまたいでまとめる。
+        while len(sets) < num and len(rest) >= size:
+            sets.append((rest[:size], None))
+            rest = rest[size:]
+
+        while len(sets) < num:
+            sets.append(sets[len(sets) % max(len(sets), 1)] if sets else (self.cpus, None))
+
+        return sets
+
+    # "0-3,8-11"のような/sys/devices/systemのcpulist表記を、CPU番号のlistに変換する。
+    @staticmethod
+    def parse_cpulist(cpulist: str) -> List[int]:
+        cpus = []
+        for part in cpulist.strip().split(","):
+            if part == "":
+                continue
+            if "-" in part:
+                first, last = part.split("-")
+                cpus.extend(range(int(first), int(last) + 1))
+            else:
+                cpus.append(int(part))
+        return cpus
+
+
+# UsiEngineが"go"～"bestmove"の間に消費したCPU時間などの集計。
+# UsiEngine.resource_accounting == Trueのときに集計される。
+class UsiEngineUsage:
+    def __init__(self):
+
+        # --- public members ---
+
+        # 集計した思考の回数("go"～"bestmove"の回数)
+        self.think_count = 0
+
+        # 思考に割り当てられた時間("go"送信～"bestmove"受信の経過時間)の合計[s]
+        self.think_time = 0.0
+
+        # 思考中に消費したCPU時間の合計[s]
+        self.cpu_time = 0.0
+
+        # "go","bestmove"の時点で計測したRSSの最大値と最後の値[byte]
+        self.max_rss = 0
+        self.last_rss = 0
+
+        # エンジンのスレッド数(エンジンオプションの"Threads")
+        self.threads = 1
+
+    # 割り当てられた時間×スレッド数のうち、実際にCPUを使えていた割合。
+    # 1.0を大きく下回っているなら、他のプロセスにCPUを奪われている(oversubscription)可能性が高い。
+    def cpu_share(self) -> float:
+        if self.think_time == 0:
+            return 0
+        return self.cpu_time / (self.think_time * max(self.threads, 1))
+
+    # 他のUsiEngineUsageの内容を合算する。(複数エンジンの集計用)
+    def add(self, usage):  # usage : UsiEngineUsage
+        self.think_count += usage.think_count
+        self.think_time += usage.think_time
+        self.cpu_time += usage.cpu_time
+        self.max_rss = max(self.max_rss, usage.max_rss)
+        self.last_rss += usage.last_rss
+        self.threads = usage.threads
+
+    # 表示用に文字列化して返す。
+    def to_string(self) -> str:
+        return "cpu {0:.1f}s / think {1:.1f}s x {2} threads (cpu share {3:.1f}%) , max rss {4:.1f}MB".format(
+            self.cpu_time,
+            self.think_time,
+            self.threads,
+            self.cpu_share() * 100,
+            self.max_rss / (1024 * 1024),
+        )
+
+
+# UsiEngineとエンジンの間で、USIプロトコルの1行を送受信するもの。(ローカルのプロセスの標準入出力)
+# UsiSocketTransportと同じく、readline() , write() , is_alive() , close()とpidを持つ。
+class UsiProcessTransport:
+    def __init__(self, command: str, cwd: str):
+
+        # --- public readonly members ---
+
+        # エンジンのプロセスハンドルと、そのプロセスID
+        self.proc = subprocess.Popen(
+            command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE,
+            encoding="utf-8",
+            cwd=cwd,
+        )
+        self.pid: Optional[int] = self.proc.pid
+
+    # 1行受信する。改行を含む。接続が切れていたら""が返る。
+    def readline(self) -> str:
+        return cast(io.TextIOWrapper, self.proc.stdout).readline()
+
+    # 1行送信する。(改行は付与される)
+    def write(self, line: str):
+        stdin = cast(io.TextIOWrapper, self.proc.stdin)
+        stdin.write(line + "\n")
+        stdin.flush()
+
+    # エンジンのプロセスが生きているか
+    def is_alive(self) -> bool:
+        return self.proc.poll() is None
+
+    # 終了させる
+    def close(self):
+        # GCが呼び出されたときに回収されるはずだが、UnitTestでresource leakの警告が出るのが許せないので
+        # この時点でclose()を呼び出しておく。
+        try:
+            cast(io.TextIOWrapper, self.proc.stdin).close()
+        except OSError:
+            # エンジンが先に終了していて、送信できなかった分が残っていた。
+            pass
+        cast(io.TextIOWrapper, self.proc.stdout).close()
+        cast(io.TextIOWrapper, self.proc.stderr).close()
+        self.proc.terminate()
+
+
+# UsiEngineとエンジンの間で、USIプロトコルの1行を送受信するもの。(TCPかUnixドメインのsocket)
+# 別のマシンやコンテナでUsiEngineServerを動かしておけば、そのマシンのエンジンとやりとりできる。
+# UsiEngine.connect()に"tcp://ホスト:ポート番号"か"unix://socketのpath"を渡すと、これで接続する。
+class UsiSocketTransport:
+    def __init__(self, sock: socket.socket):
+
+        # --- public readonly members ---
+
+        # リモートのエンジンのプロセスIDはわからないのでNone。(cpu_affinity , resource_accountingは適用されない)
+        self.pid: Optional[int] = None
+
+        # --- private members ---
+
+        self.sock = sock
+        self.file = sock.makefile("rw", encoding="utf-8", newline="\n")
+
+        # 接続が切れたか
+        self.closed = False
+
+    # 1行受信する。改行を含む。接続が切れていたら""が返る。
+    def readline(self) -> str:
+        try:
+            line = self.file.readline()
+        except (OSError, ValueError):
+            line = ""
+        if not line:
+            self.closed = True
+        return line
+
+    # 1行送信する。(改行は付与される)
+    def write(self, line: str):
+        self.file.write(line + "\n")
+        self.file.flush()
+
+    # 接続が切れていないか
+    def is_alive(self) -> bool:
+        return not self.closed
+
+    # 接続を切る
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.file.close()
+        self.sock.close()
+
+    # addressに接続したUsiSocketTransportを返す。
+    # address : "tcp://ホスト:ポート番号"か"unix://socketのpath"
+    @staticmethod
+    def connect(address: str):  # -> UsiSocketTransport
+        family, sockaddr = UsiSocketTransport.parse_address(address)
+        if family == socket.AF_INET:
+            sock = socket.create_connection(sockaddr)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.connect(sockaddr)
+        return UsiSocketTransport(sock)
+
+    # "tcp://ホスト:ポート番号"か"unix://socketのpath"を、(socketのfamily , socketのアドレス)にして返す。
+    @staticmethod
+    def parse_address(address: str) -> tuple:
+        if address.startswith("tcp://"):
+            host, port = address[len("tcp://") :].rsplit(":", 1)
+            return socket.AF_INET, (host, int(port))
+        if address.startswith("unix://"):
+            return getattr(socket, "AF_UNIX"), address[len("unix://") :]
+        raise ValueError("illegal socket address : " + address)
+
+    # engine_pathが"tcp://"か"unix://"で始まるsocketのアドレスを含むならそのアドレスを、そうでなければNoneを返す。
+    # (os.path.join()でhomeフォルダが前に付与されていても良いように、途中から始まっていても良い)
+    @staticmethod
+    def find_address(engine_path: str) -> Optional[str]:
+        match = re.search(r"(tcp|unix)://.*$", engine_path)
+        return match.group(0) if match is not None else None
+
+    # socket.socketpair()の片側でengine(FakeUsiEngine , ReplayUsiEngine)をスレッドとして動かし、
+    # もう片側のUsiSocketTransportを返す。
+    # engine : run(input , output)で、inputから読み込んだコマンドに対する応答をoutputに書き出すもの
+    @staticmethod
+    def start_engine_thread(engine):  # -> UsiSocketTransport
+        engine_side, harness_side = socket.socketpair()
+
+        def serve():
+            f = engine_side.makefile("rw", encoding="utf-8", newline="\n")
+            try:
+                engine.run(f, f)
+            except (OSError, ValueError):
+                # 接続が切れた。
+                pass
+            finally:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+                engine_side.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        return UsiSocketTransport(harness_side)
+
+
+# UsiEngineとエンジンのやりとりを、タイムスタンプ付きで1行ずつファイルに書き出すもの。(UsiEngine.transcript_path)
+# 書式は"記録開始からの経過時間[s] 向き メッセージ"。向きは"<"がUsiEngine→エンジン、">"がエンジン→UsiEngine。
+# 例)
+#   0.000012 < isready
+#   0.812345 > readyok
+# ReplayUsiEngineで、記録したときと同じタイミングで応答を再生できる。
+class UsiTranscript:
+    def __init__(self, path: str):
+
+        # --- private members ---
+
+        # 送信スレッドと受信スレッドの両方から書き込むのでlockする。
+        self.file = open(path, "w", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+
+    # 1行記録する。
+    # direction : "<"(UsiEngine→エンジン) or ">"(エンジン→UsiEngine)
+    def write(self, direction: str, message: str):
+        elapsed = time.perf_counter() - self.start_time
+        with self.lock:
+            self.file.write("{0:.6f} {1} {2}\n".format(elapsed, direction, message))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    # 記録したファイルを読み込んで、(経過時間[s] , 向き , メッセージ)のlistを返す。
+    @staticmethod
+    def read(path: str) -> List[Tuple[float, str, str]]:
+        entries = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\r\n").split(" ", 2)
+                if len(fields) < 2:
+                    continue
+                entries.append(
+                    (float(fields[0]), fields[1], fields[2] if len(fields) == 3 else "")
+                )
+        return entries
+
+
 # USIプロトコルを用いて思考エンジンとやりとりするためのwrapperクラス
 class UsiEngine:
     def __init__(self):
@@ -432,6 +1316,37 @@ class UsiEngine:
 
         self.think_result = None  # UsiThinkResult
 
+        # これを設定しておくと、"position"送信～"go"送信～"bestmove"受信～次のコマンド送信 の各区間を記録する。
+        # (AyaneruServerから使う場合は、AyaneruServer.tracerを設定すれば良い)
+        self.tracer: Optional[ChromeTracer] = None
+
+        # tracerに記録するときのpid。(AyaneruServerから使う場合は、対局サーバーの番号が設定される)
+        self.trace_pid = 0
+
+        # エンジンのプロセスを実行するCPU番号のlist。connect()の前に設定しておくと、os.sched_setaffinity()で適用される。(Linuxのみ)
+        # Noneなら制限しない。
+        self.cpu_affinity: Optional[List[int]] = None
+
+        # エンジンのメモリを確保するNUMAノード番号。connect()の前に設定しておくと、numactlコマンドが
+        # インストールされている場合はそれを経由してエンジンを起動する。Noneなら指定しない。
+        self.numa_node: Optional[int] = None
+
+        # これをTrueにしておくと、"go"送信時と"bestmove"受信時にエンジンのプロセスのCPU時間とRSSを/procから読み取り、
+        # self.usageに集計する。(Linuxのみ)
+        self.resource_accounting = False
+
+        # エンジンとのやりとりをタイムスタンプ付きで記録するファイルのpath。connect()の前に設定しておくと記録される。
+        # 書式はUsiTranscriptを参照のこと。ReplayUsiEngineで、記録したときと同じタイミングで再生できる。
+        # Noneなら記録しない。
+        self.transcript_path: Optional[str] = None
+
+        # これをconnect()の前に設定しておくと、read_worker , write_workerのスレッドとhandle_infoの時間を集計する。
+        # (AyaneruServerから使う場合は、AyaneruServer.profilerを設定すれば良い)
+        self.profiler: Optional[Profiler] = None
+
+        # これを設定しておくと、usi_go()ごとに、送られてきた"info"の読み筋をすべて記録する。
+        self.pv_recorder: Optional[PvTraceRecorder] = None
+
         # --- readonly members ---
         # (外部からこれらの変数は書き換えないでください)
 
@@ -448,10 +1363,18 @@ class UsiEngine:
         # エラーがなく終了したのであれば0が入る。(readonly)
         self.exit_state: Optional[Union[int, str]] = None
 
+        # resource_accounting == Trueのときの、CPU時間とRSSの集計結果。(readonly)
+        # connect()のときにリセットされる。
+        self.usage = UsiEngineUsage()
+
+        # エンジンから受信した行数。(readonly)
+        # connect()のときにリセットされる。
+        self.received_lines = 0
+
         # --- private members ---
 
-        # エンジンのプロセスハンドル
-        self.proc: Optional[subprocess.Popen] = None
+        # エンジンとの送受信を行うもの(UsiProcessTransport or UsiSocketTransport)
+        self.transport = None
 
         # エンジンとやりとりするスレッド
         self.read_thread: threading.Thread = None
@@ -473,6 +1396,27 @@ class UsiEngine:
         # engine_stateが変化したときのイベント用
         self.state_changed_cv = threading.Condition()
 
+        # "go"を送信した時刻と、その時点でのエンジンのCPU時間。(resource_accounting用)
+        self.go_time = 0.0
+        self.go_cpu_time: Optional[float] = None
+
+        # tracerに記録中の区間の名前と開始時刻、付随情報
+        self.trace_span_name: Optional[str] = None
+        self.trace_span_start = 0.0
+        self.trace_span_args: Optional[dict] = None
+
+        # tracerにこのエンジンの行の名前を設定したpid。(未設定ならNone)
+        self.trace_named_pid: Optional[int] = None
+
+        # trace_span()のlock用
+        self.trace_lock_object = threading.Lock()
+
+        # transcript_pathに記録中のUsiTranscript
+        self.transcript: Optional[UsiTranscript] = None
+
+        # 最後にusi_position()で送った局面(pv_recorderに記録する)
+        self.position = ""
+
         # このクラスのインスタンスの識別用ID。
         # 念の為、lockしてから参照/インクリメントを行う。
         with UsiEngine.static_lock_object:
@@ -496,21 +1440,18 @@ class UsiEngine:
 
     # エンジンに接続する
     # enginePath : エンジンPathを指定する。
+    #   "tcp://ホスト:ポート番号"か"unix://socketのpath"を指定すると、そこで待ち受けているUsiEngineServerに接続する。
     # エンジンが存在しないときは例外がでる。
     def connect(self, engine_path: str):
+        address = UsiSocketTransport.find_address(engine_path)
+        if address is not None:
+            self.connect_transport(UsiSocketTransport.connect(address), address)
+            return
+
         self.disconnect()
 
-        # engine_stateは、disconnect()でUsiEngineState.DisconnectedになってしまうのでいったんNoneに設定してリセット。
-        # 以降は、この変数は、__change_state()を呼び出して変更すること。
-        self.engine_state = None
-        self.exit_state = None
         self.engine_path = engine_path
-
-        # write workerに対するコマンドqueue
-        self.send_queue = Queue()
-
-        # 最後にエンジン側から受信した行
-        self.last_received_line = None
+        self.reset_connection()
 
         # 実行ファイルの存在するフォルダ
         self.engine_fullpath = os.path.join(os.getcwd(), self.engine_path)
@@ -523,16 +1464,59 @@ class UsiEngine:
             self.exit_state = "Connection Error"
             raise FileNotFoundError(self.engine_fullpath + " not found.")
 
-        self.proc = subprocess.Popen(
-            self.engine_fullpath,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            encoding="utf-8",
-            cwd=os.path.dirname(self.engine_fullpath),
+        command = self.engine_fullpath
+        if self.numa_node is not None and shutil.which("numactl") is not None:
+            # --preferredなので、そのノードのメモリが足りなければ他のノードから確保される。
+            command = "numactl --cpunodebind={0} --preferred={0} {1}".format(
+                self.numa_node, command
+            )
+
+        self.transport = UsiProcessTransport(
+            command, os.path.dirname(self.engine_fullpath)
         )
 
+        # 起動直後に適用しておけば、以降にエンジンが生成するスレッドにも引き継がれる。
+        self.apply_cpu_affinity()
+
+        self.start_workers()
+
+    # 接続済みのtransport(UsiProcessTransport or UsiSocketTransport)を用いてエンジンとやりとりする。
+    # socket.socketpair()の片側を渡せば、プロセスを起動せずにテストできる。
+    # name : self.engine_path , self.engine_fullpathに設定する名前
+    def connect_transport(self, transport, name: str = "(transport)"):
+        self.disconnect()
+        self.engine_path = name
+        self.engine_fullpath = name
+        self.reset_connection()
+        self.change_state(UsiEngineState.WaitConnecting)
+        self.transport = transport
+        self.start_workers()
+
+    # 接続ごとの状態を初期化する。
+    def reset_connection(self):
+        # engine_stateは、disconnect()でUsiEngineState.DisconnectedになってしまうのでいったんNoneに設定してリセット。
+        # 以降は、この変数は、__change_state()を呼び出して変更すること。
+        self.engine_state = None
+        self.exit_state = None
+
+        # write workerに対するコマンドqueue
+        self.send_queue = Queue()
+
+        # 最後にエンジン側から受信した行
+        self.last_received_line = None
+
+        # 前回の接続で記録中だった区間は破棄する。
+        self.trace_span_name = None
+        self.received_lines = 0
+
+        # CPU時間などの集計のリセット
+        self.usage = UsiEngineUsage()
+        if self.options is not None and "Threads" in self.options:
+            self.usage.threads = int(self.options["Threads"])
+        self.go_cpu_time = None
+
+    # 接続したエンジンとの読み書きスレッドを開始する。
+    def start_workers(self):
         # self.send_command("usi")
         # "usi"コマンドを先行して送っておく。
         # →　オプション項目が知りたいわけでなければエンジンに対して"usi"、送る必要なかったりする。
@@ -540,15 +1524,42 @@ class UsiEngine:
 
         self.change_state(UsiEngineState.Connected)
 
+        if self.transcript_path is not None:
+            self.transcript = UsiTranscript(self.transcript_path)
+
         # 読み書きスレッド
-        self.read_thread = threading.Thread(target=self.read_worker)
+        read_worker, write_worker = self.read_worker, self.write_worker
+        if self.profiler is not None:
+            read_worker = self.profiler.wrap("UsiEngine.read_worker", read_worker)
+            write_worker = self.profiler.wrap("UsiEngine.write_worker", write_worker)
+        self.read_thread = threading.Thread(target=read_worker)
         self.read_thread.start()
-        self.write_thread = threading.Thread(target=self.write_worker)
+        self.write_thread = threading.Thread(target=write_worker)
         self.write_thread.start()
 
+    # self.cpu_affinityを、エンジンのプロセス(とその子孫プロセス)のすべてのスレッドに適用する。
+    def apply_cpu_affinity(self):
+        pid = self.pid()
+        if self.cpu_affinity is None or pid is None:
+            return
+        if not hasattr(os, "sched_setaffinity"):
+            return
+        for pid in ProcessUsage.process_tree(pid):
+            try:
+                for tid in os.listdir("/proc/{0}/task".format(pid)):
+                    os.sched_setaffinity(int(tid), self.cpu_affinity)
+            except (OSError, ValueError):
+                # 適用中にスレッドが終了したなど。
+                pass
+
     # エンジンのconnect()が呼び出されたあとであるか
     def is_connected(self) -> bool:
-        return self.proc is not None
+        return self.transport is not None
+
+    # エンジンのプロセスID。接続していないか、socketで接続しているならNone。
+    def pid(self) -> Optional[int]:
+        transport = self.transport
+        return transport.pid if transport is not None else None
 
     # エンジン用のプロセスにコマンドを送信する(プロセスの標準入力にメッセージを送る)
     def send_command(self, message: str):
@@ -556,7 +1567,7 @@ class UsiEngine:
 
     # エンジン用のプロセスを終了する
     def disconnect(self):
-        if self.proc is not None:
+        if self.transport is not None:
             self.send_command("quit")
             # スレッドをkillするのはpythonでは難しい。
             # エンジンが行儀よく動作することを期待するしかない。
@@ -570,15 +1581,14 @@ class UsiEngine:
             self.write_thread.join()
             self.write_thread = None
 
-        # GCが呼び出されたときに回収されるはずだが、UnitTestでresource leakの警告が出るのが許せないので
-        # この時点でclose()を呼び出しておく。
-        if self.proc is not None:
-            self.proc.stdin.close()
-            self.proc.stdout.close()
-            self.proc.stderr.close()
-            self.proc.terminate()
+        if self.transport is not None:
+            self.transport.close()
+
+        if self.transcript is not None:
+            self.transcript.close()
+            self.transcript = None
 
-        self.proc = None
+        self.transport = None
         self.change_state(UsiEngineState.Disconnected)
 
     # 指定したUsiEngineStateになるのを待つ
@@ -615,6 +1625,7 @@ class UsiEngine:
     # 例 : "startpos moves ..."とか"sfen ... moves ..."みたいな形式
     # 「USIプロトコル」でググれ。
     def usi_position(self, sfen: str):
+        self.position = sfen
         self.send_command("position " + sfen)
 
     # [ASYNC]
@@ -626,14 +1637,17 @@ class UsiEngine:
     # self.think_result.bestmove != Noneになったらそれがエンジン側から返ってきた最善手なので、それを以て、go_commandが完了したとみなせる。
     def usi_go(self, options: str):
         self.think_result = UsiThinkResult()
+        if self.pv_recorder is not None:
+            self.pv_recorder.begin_search(self.position)
         self.send_command("go " + options)
 
     # [SYNC]
     # go_command()を呼び出して、そのあとbestmoveが返ってくるまで待つ。
     # 思考結果はself.think_resultから取り出せる。
-    def usi_go_and_wait_bestmove(self, options: str):
+    # raise_on_exit : wait_bestmove()を参照のこと。
+    def usi_go_and_wait_bestmove(self, options: str, raise_on_exit: bool = False):
         self.usi_go(options)
-        self.wait_bestmove()
+        self.wait_bestmove(raise_on_exit)
 
     # [SYNC]
     # go_command()を呼び出して、そのあとcheckmateが返ってくるまで待つ。
@@ -652,11 +1666,23 @@ class UsiEngine:
     # [SYNC]
     # bestmoveが返ってくるのを待つ
     # self.think_result.bestmoveからbestmoveを取り出すことができる。
-    def wait_bestmove(self):
+    # raise_on_exit : Trueなら、bestmoveが返ってくる前にエンジンが終了した(受信スレッドが終了した)ときに例外をraiseする。
+    #                 Falseなら、エンジンが終了するとこのメソッドから戻ってこない。
+    def wait_bestmove(self, raise_on_exit: bool = False):
         with self.state_changed_cv:
-            self.state_changed_cv.wait_for(
-                lambda: self.think_result.bestmove is not None
-            )
+            if not raise_on_exit:
+                self.state_changed_cv.wait_for(
+                    lambda: self.think_result.bestmove is not None
+                )
+                return
+            # エンジンが終了しても通知されないので、1秒ごとに確認する。
+            while self.think_result.bestmove is None:
+                read_thread = self.read_thread
+                if read_thread is None or not read_thread.is_alive():
+                    raise ValueError(
+                        "{0} : engine terminated before bestmove.".format(self.instance_id)
+                    )
+                self.state_changed_cv.wait(1)
 
     # [SYNC]
     # checkmateが返ってくるのを待つ
@@ -683,14 +1709,16 @@ class UsiEngine:
     # エンジンとのやりとりを行うスレッド(read方向)
     def read_worker(self):
         while True:
-            line = self.proc.stdout.readline()
+            line = self.transport.readline()
             # プロセスが終了した場合、line = Noneのままreadline()を抜ける。
             if line:
-                self.dispatch_message(line.strip())
+                message = line.strip()
+                if self.transcript is not None:
+                    self.transcript.write(">", message)
+                self.dispatch_message(message)
 
             # プロセスが生きているかのチェック
-            retcode = self.proc.poll()
-            if not line and retcode is not None:
+            if not line and not self.transport.is_alive():
                 self.exit_state = 0
                 # エラー以外の何らかの理由による終了
                 break
@@ -732,8 +1760,21 @@ class UsiEngine:
                 elif token == "usinewgame" or token == "gameover":
                     self.wait_for_state(UsiEngineState.WaitCommand)
 
-                self.proc.stdin.write(message + "\n")
-                self.proc.stdin.flush()
+                # "bestmove"を受信したときのsample_usage(True)と対にするので、"go"を送信する前に計測しておく。
+                if self.resource_accounting and token == "go":
+                    self.sample_usage(False)
+
+                # エンジンがすぐに応答すると、read_worker()の方が先に記録してしまうので、送信する前に記録する。
+                # (traceも同様。"bestmove"で閉じる"go"の区間を、送信したあとに開始すると閉じられずに残る)
+                if self.tracer is not None:
+                    if token == "position" or token == "go":
+                        self.trace_span(token, {"command": message})
+                    elif self.trace_span_name != "go":
+                        # "go"～"bestmove"の間に送った"stop"などでは思考区間を閉じない。
+                        self.trace_span(None)
+                if self.transcript is not None:
+                    self.transcript.write("<", message)
+                self.transport.write(message)
                 if self.debug_print:
                     self.print("[{0}:<] {1}".format(self.instance_id, message))
 
@@ -742,8 +1783,7 @@ class UsiEngine:
                     # 終了コマンドを送信したなら自発的にこのスレッドを終了させる。
                     break
 
-                retcode = self.proc.poll()
-                if retcode is not None:
+                if not self.transport.is_alive():
                     break
 
         except:
@@ -775,8 +1815,69 @@ class UsiEngine:
             self.engine_state = state
             self.state_changed_cv.notify_all()
 
+    # エンジンのプロセスのCPU時間とRSSを読み取り、self.usageに反映させる。
+    # bestmove : "bestmove"受信時ならTrue。"go"送信時ならFalse。
+    def sample_usage(self, bestmove: bool):
+        now = time.time()
+        pid = self.pid()
+        usage = ProcessUsage.read(pid) if pid is not None else None
+        if usage is None:
+            return
+
+        self.usage.last_rss = usage.rss
+        self.usage.max_rss = max(self.usage.max_rss, usage.rss)
+
+        if not bestmove:
+            self.go_time = now
+            self.go_cpu_time = usage.cpu_time
+        elif self.go_cpu_time is not None:
+            self.usage.think_count += 1
+            self.usage.think_time += now - self.go_time
+            self.usage.cpu_time += usage.cpu_time - self.go_cpu_time
+            self.go_cpu_time = None
+
+    # tracerに記録中の区間を閉じて、nameの区間を開始する。nameがNoneなら閉じるだけ。
+    # 区間は以下の3種類。
+    #  "position" : "position"送信～"go"送信
+    #  "go"       : "go"送信～"bestmove"受信(エンジンの思考時間)
+    #  "wait"     : "bestmove"受信～次のコマンド送信(python側の処理をエンジンが待っている時間)
+    def trace_span(self, name: Optional[str], args: Optional[dict] = None):
+        tracer = cast(ChromeTracer, self.tracer)
+        now = tracer.now()
+        tid = self.instance_id + 1  # tid = 0 は、AyaneruServerの対局レーンに使うので+1しておく。
+
+        with self.trace_lock_object:
+            if self.trace_named_pid != self.trace_pid:
+                self.trace_named_pid = self.trace_pid
+                tracer.set_thread_name(
+                    self.trace_pid,
+                    tid,
+                    "engine {0} : {1}".format(self.instance_id, self.engine_path),
+                )
+
+            if self.trace_span_name is not None:
+                span_args = self.trace_span_args
+                if self.trace_span_name == "go" and self.think_result is not None:
+                    span_args = dict(span_args or {})
+                    span_args["bestmove"] = self.think_result.bestmove
+                tracer.complete(
+                    self.trace_span_name,
+                    self.trace_span_start,
+                    now,
+                    self.trace_pid,
+                    tid,
+                    "engine",
+                    span_args,
+                )
+
+            self.trace_span_name = name
+            self.trace_span_start = now
+            self.trace_span_args = args
+
     # エンジン側から送られてきたメッセージを解釈する。
     def dispatch_message(self, message: str):
+        self.received_lines += 1
+
         # デバッグ用に受け取ったメッセージを出力するのか？
         if self.debug_print or (self.error_print and message.find("Error") > -1):
             self.print("[{0}:>] {1}".format(self.instance_id, message))
@@ -799,17 +1900,28 @@ class UsiEngine:
             return
         # "isready"に対する応答
         elif token == "readyok":
+            # shell経由で起動したエンジンのプロセスや、"isready"で生成された探索スレッドにも適用されるように再度適用しておく。
+            self.apply_cpu_affinity()
             self.change_state(UsiEngineState.WaitCommand)
         # "go"に対する応答
         elif token == "bestmove":
             self.handle_bestmove(message)
+            if self.resource_accounting:
+                self.sample_usage(True)
+            if self.tracer is not None:
+                self.trace_span("wait")
             self.change_state(UsiEngineState.WaitCommand)
         # エンジンの読み筋に対する応答
         elif token == "info":
-            self.handle_info(message)
+            if self.profiler is None:
+                self.handle_info(message)
+            else:
+                self.profiler.measure("UsiEngine.handle_info", self.handle_info, message)
         # 詰め将棋エンジンに対する応答
         elif token=="checkmate":
             self.handle_checkmate(message)
+            if self.tracer is not None:
+                self.trace_span("wait")
             self.change_state(UsiEngineState.WaitCommand)
 
     # エンジンから送られてきた"bestmove"を処理する。
@@ -903,6 +2015,9 @@ class UsiEngine:
                 )
 
         if multipv >= 1:
+            if self.pv_recorder is not None:
+                self.pv_recorder.record(pv, multipv)
+
             # 配列の要素数が足りないなら、追加しておく。
             while len(self.think_result.pvs) < multipv:
                 self.think_result.pvs.append(None)
@@ -916,7 +2031,520 @@ class UsiEngine:
         self.disconnect()
 
 
-# ゲームの終局状態を示す
+# ローカルのエンジンをsocketで公開するサーバー。接続してきたUsiEngine(UsiSocketTransport)ごとにエンジンを起動して、
+# socketとエンジンの標準入出力の間で1行ずつ中継する。接続が切れたらエンジンに"quit"を送って終了させる。
+#
+# 使い方)
+#   server = UsiEngineServer("exe/YaneuraOu.exe", "tcp://0.0.0.0:5001")
+#   server.serve()  # stop()されるまで戻ってこない。
+# 接続する側では、usi.connect("tcp://このマシンのアドレス:5001")とすれば良い。
+class UsiEngineServer:
+    def __init__(self, engine_path: str, address: str):
+
+        # --- public members ---
+
+        # 同時に接続できる数。0なら無制限。これを超えた接続はすぐに切る。
+        self.max_connections = 0
+
+        # --- public readonly members ---
+
+        # 公開するエンジンのpath
+        self.engine_path = engine_path
+
+        # 待ち受けるアドレス。"tcp://ホスト:ポート番号"か"unix://socketのpath"
+        # ポート番号に0を指定したときは、listen()のあと、実際に待ち受けているポート番号に書き換わる。
+        self.address = address
+
+        # 現在の接続数
+        self.connections = 0
+
+        # --- private members ---
+
+        self.listen_socket: Optional[socket.socket] = None
+        self.stop_flag = False
+        self.lock = threading.Lock()
+
+    # 待ち受けを開始する。(serve()から呼び出されるが、ポート番号を先に知りたいときは先に呼び出しても良い)
+    def listen(self):
+        family, sockaddr = UsiSocketTransport.parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif os.path.exists(sockaddr):
+            # 前回終了したときのsocketのファイルが残っている。
+            os.remove(sockaddr)
+        sock.bind(sockaddr)
+        sock.listen()
+        # stop()されたかを確認するために、1秒ごとにaccept()から戻ってくるようにしておく。
+        sock.settimeout(1.0)
+        if family == socket.AF_INET:
+            self.address = "tcp://{0}:{1}".format(sockaddr[0], sock.getsockname()[1])
+        self.listen_socket = sock
+
+    # 接続を待ち受けて、接続ごとにスレッドを作ってエンジンと中継する。stop()されるまで戻ってこない。
+    def serve(self):
+        if self.listen_socket is None:
+            self.listen()
+        sock = cast(socket.socket, self.listen_socket)
+        threads = []
+        while not self.stop_flag:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            with self.lock:
+                if self.max_connections != 0 and self.connections >= self.max_connections:
+                    conn.close()
+                    continue
+                self.connections += 1
+            thread = threading.Thread(target=self.relay, args=(conn,))
+            thread.start()
+            threads.append(thread)
+        sock.close()
+        for thread in threads:
+            thread.join()
+
+    # serve()を終了させる。(中継中の接続は、切れるまで待つ)
+    def stop(self):
+        self.stop_flag = True
+
+    # 接続connとエンジンの間で中継する。
+    def relay(self, conn: socket.socket):
+        if conn.family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = UsiSocketTransport(conn)
+        engine_fullpath = os.path.join(os.getcwd(), self.engine_path)
+        try:
+            engine = UsiProcessTransport(engine_fullpath, os.path.dirname(engine_fullpath))
+        except OSError:
+            client.close()
+            with self.lock:
+                self.connections -= 1
+            return
+
+        # エンジン → socket は別スレッドで。エンジンが終了したらsocketも閉じる。
+        thread = threading.Thread(target=UsiEngineServer.pipe, args=(engine, client, True))
+        thread.start()
+        UsiEngineServer.pipe(client, engine, False)
+
+        # 接続が切れたなら、エンジンを終了させる。
+        try:
+            engine.write("quit")
+        except (OSError, ValueError):
+            pass
+        thread.join()
+        engine.close()
+        client.close()
+        with self.lock:
+            self.connections -= 1
+
+    # sourceから受信した行をdestinationに送信する。sourceかdestinationの接続が切れたら戻る。
+    # close : 戻るときにdestinationを閉じるか
+    @staticmethod
+    def pipe(source, destination, close: bool):
+        while True:
+            line = source.readline()
+            if not line:
+                break
+            try:
+                destination.write(line.rstrip("\r\n"))
+            except (OSError, ValueError):
+                break
+        if close:
+            destination.close()
+
+
+# 思考せずに、それらしい応答だけを返すUSIエンジン。
+# 対局サーバーなどのpython側のオーバーヘッドの計測(ayaneru-benchmark.py)や、本物のエンジンなしでのテストに用いる。
+# 以下のエンジンオプション("setoption")で挙動を変えられる。
+#   FakeThinkTime : "go"から"bestmove"までの時間[ms]。(デフォルト:0) "go infinite"のときは"stop"まで。
+#   FakeInfoLines : "go"1回あたりに出力する読み筋の数。(MultiPVの各PVごと)(デフォルト:5) FakeThinkTimeの間に均等に出力する。
+#   FakeResignPly : 局面の手数がこれを超えたら"bestmove resign"を返す。0なら投了しない。(デフォルト:100)
+#   FakeSeed      : 指し手や評価値を選ぶ乱数のseed。
+#   MultiPV       : 1回に出力する読み筋の数。(デフォルト:1)
+# 指し手は合法手ではなく、それらしい文字列をランダムに選んだもの。"moves"も同じものを返す。
+#
+# 使い方)
+#   FakeUsiEngine().run(sys.stdin, sys.stdout)               # ayaneru-fake-engine.py
+#   usi.connect_transport(FakeUsiEngine.start_transport())  # プロセスを起動せずに、このプロセス内のスレッドで動かす。
+class FakeUsiEngine:
+    def __init__(self):
+
+        # --- public members ---
+
+        # エンジンオプションの値。(setoptionで変更される)
+        self.think_time = 0
+        self.info_lines = 5
+        self.resign_ply = 100
+        self.multipv = 1
+
+        # 指し手や評価値を選ぶ乱数
+        self.random = random.Random()
+
+        # --- public readonly members ---
+
+        # 受信した行数、送信した行数
+        self.received_lines = 0
+        self.sent_lines = 0
+
+        # --- private members ---
+
+        # 出力先と、そのlock (思考スレッドからも出力する)
+        self.output = None
+        self.output_lock = threading.Lock()
+
+        # "position"で設定された局面の手数と、手番が先手か
+        self.ply = 1
+        self.black_to_move = True
+
+        # 思考スレッドと、その停止用
+        self.think_thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    # それらしい指し手の集合
+    fake_moves = (
+        "7g7f 3c3d 2g2f 8c8d 6i7h 4a3b 2f2e 8d8e 3i4h 7a7b 5i6h 5a4b "
+        "4i5h 6a5b 9g9f 1c1d 3g3f 7c7d 2h2f 8b8d P*2d B*5e 8h2b+ 3a2b"
+    ).split()
+
+    # inputから1行ずつコマンドを読み込んで、応答をoutputに書き出す。"quit"か入力の終わりで戻る。
+    # input , output : テキストのストリーム(sys.stdin , sys.stdoutなど)
+    def run(self, input, output):
+        self.output = output
+        for line in input:
+            self.received_lines += 1
+            if not self.handle(line.strip()):
+                break
+        self.stop_thinking()
+
+    # 1行のコマンドを処理する。"quit"ならFalseを返す。
+    def handle(self, command: str) -> bool:
+        tokens = command.split()
+        if not tokens:
+            return True
+        token = tokens[0]
+
+        if token == "usi":
+            self.write("id name FakeUsiEngine")
+            self.write("id author Ayane")
+            for name, default in [
+                ("FakeThinkTime", 0),
+                ("FakeInfoLines", 5),
+                ("FakeResignPly", 100),
+                ("FakeSeed", 0),
+                ("MultiPV", 1),
+            ]:
+                self.write(
+                    "option name {0} type spin default {1} min 0 max 1000000".format(name, default)
+                )
+            self.write("usiok")
+        elif token == "isready":
+            self.write("readyok")
+        elif token == "setoption":
+            self.set_option(tokens)
+        elif token == "position":
+            self.stop_thinking()
+            self.set_position(tokens)
+        elif token == "go":
+            self.stop_thinking()
+            self.stop_event.clear()
+            self.think_thread = threading.Thread(
+                target=self.think, args=("infinite" in tokens,)
+            )
+            self.think_thread.start()
+        elif token == "stop":
+            self.stop_event.set()
+        elif token == "moves":
+            self.write(" ".join(FakeUsiEngine.fake_moves))
+        elif token == "side":
+            self.write("black" if self.black_to_move else "white")
+        elif token == "quit":
+            return False
+        # "usinewgame" , "gameover"などは何もしない。
+        return True
+
+    # "setoption name X value Y"
+    def set_option(self, tokens: List[str]):
+        if "name" not in tokens or "value" not in tokens:
+            return
+        name = tokens[tokens.index("name") + 1]
+        value = tokens[tokens.index("value") + 1]
+        try:
+            if name == "FakeThinkTime":
+                self.think_time = int(value)
+            elif name == "FakeInfoLines":
+                self.info_lines = int(value)
+            elif name == "FakeResignPly":
+                self.resign_ply = int(value)
+            elif name == "FakeSeed":
+                self.random.seed(int(value))
+            elif name == "MultiPV":
+                self.multipv = max(int(value), 1)
+        except ValueError:
+            self.write("info string Error! : illegal option value {0}".format(value))
+
+    # "position startpos moves ..." , "position sfen ... b - 1 moves ..."
+    def set_position(self, tokens: List[str]):
+        moves = len(tokens) - tokens.index("moves") - 1 if "moves" in tokens else 0
+        if len(tokens) >= 2 and tokens[1] == "sfen" and len(tokens) >= 6:
+            black = tokens[3] == "b"
+            ply = int(tokens[5]) if tokens[5].isdigit() else 1
+        else:
+            black = True
+            ply = 1
+        self.ply = ply + moves
+        self.black_to_move = black == (moves % 2 == 0)
+
+    # 思考スレッド。info_lines回に分けて読み筋を出力して、bestmoveを返す。
+    def think(self, infinite: bool):
+        start_time = time.time()
+        interval = self.think_time / 1000 / max(self.info_lines, 1)
+        bestmove = None
+        for depth in range(1, self.info_lines + 1):
+            if interval > 0 and self.stop_event.wait(interval):
+                break
+            elapsed = int((time.time() - start_time) * 1000)
+            nodes = depth * 10000
+            for pv in range(1, self.multipv + 1):
+                moves = self.random.sample(FakeUsiEngine.fake_moves, 3)
+                if pv == 1:
+                    bestmove = moves[0]
+                self.write(
+                    "info depth {0} seldepth {1} multipv {2} score cp {3} nodes {4} nps {5} time {6} hashfull {7} pv {8}".format(
+                        depth,
+                        depth + 2,
+                        pv,
+                        self.random.randint(-300, 300),
+                        nodes,
+                        nodes * 1000 // max(elapsed, 1),
+                        elapsed,
+                        min(depth * 10, 1000),
+                        " ".join(moves),
+                    )
+                )
+
+        # "go infinite"なら"stop"まで待つ。
+        if infinite:
+            self.stop_event.wait()
+        else:
+            rest = self.think_time / 1000 - (time.time() - start_time)
+            if rest > 0:
+                self.stop_event.wait(rest)
+
+        if self.resign_ply != 0 and self.ply > self.resign_ply:
+            bestmove = "resign"
+        elif bestmove is None:
+            bestmove = self.random.choice(FakeUsiEngine.fake_moves)
+        self.write("bestmove " + bestmove)
+
+    # 思考中なら停止させて、bestmoveを返し終わるまで待つ。
+    def stop_thinking(self):
+        if self.think_thread is not None:
+            self.stop_event.set()
+            self.think_thread.join()
+            self.think_thread = None
+
+    # 1行出力する。
+    def write(self, line: str):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+            self.sent_lines += 1
+
+    # socket.socketpair()の片側でFakeUsiEngineをスレッドとして動かし、もう片側のUsiSocketTransportを返す。
+    # UsiEngine.connect_transport()に渡せば、プロセスを起動せずに対局させられる。
+    @staticmethod
+    def start_transport():  # -> UsiSocketTransport
+        return UsiSocketTransport.start_engine_thread(FakeUsiEngine())
+
+
+# UsiEngine.transcript_pathで記録したやりとりを再生するUSIエンジン。
+# コマンドを受け取ると、transcriptのなかで次に出てくる同じ種類(先頭のtokenが同じ)のコマンドを探して、
+# それに対してエンジンが返した応答を、記録したときと同じタイミング(self.speed倍速)で返す。
+# transcriptの末尾まで行ったら先頭に戻るので、短いtranscriptでも繰り返し負荷をかけられる。
+# 本物のエンジンなしで、記録したときと同じ量とタイミングの"info"を流して、python側の処理を計測するために用いる。
+#
+# 使い方)
+#   engine = ReplayUsiEngine("engine0.txt")
+#   engine.run(sys.stdin, sys.stdout)
+# エンジンとして起動する場合は、ayaneru-replay-engine.pyを用いるか、
+# setoptionで"ReplayTranscript"(transcriptのpath)と"ReplaySpeed"(再生速度)を指定する。
+class ReplayUsiEngine:
+    def __init__(self, transcript_path: Optional[str] = None):
+
+        # --- public members ---
+
+        # 再生速度。2なら記録したときの2倍の速さで応答する。0なら待たずにすぐに応答する。
+        self.speed = 1.0
+
+        # --- public readonly members ---
+
+        # 受信した行数、送信した行数
+        self.received_lines = 0
+        self.sent_lines = 0
+
+        # transcriptのなかに同じ種類のコマンドが見つからなかった回数
+        self.unmatched_commands = 0
+
+        # --- private members ---
+
+        # transcriptを、(コマンドの先頭のtoken , [(コマンドからの経過時間[s] , 応答)...])のlistにしたもの
+        self.exchanges: List[Tuple[str, List[Tuple[float, str]]]] = []
+
+        # 次に探し始めるself.exchangesのindex
+        self.cursor = 0
+
+        # 出力先と、そのlock (応答スレッドからも出力する)
+        self.output = None
+        self.output_lock = threading.Lock()
+
+        # "go"に対する応答を返すスレッドと、その停止用
+        self.reply_thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+        if transcript_path is not None:
+            self.load(transcript_path)
+
+    # transcriptを読み込む。
+    def load(self, transcript_path: str):
+        exchanges = []
+        command_time = 0.0
+        for elapsed, direction, message in UsiTranscript.read(transcript_path):
+            if direction == "<":
+                exchanges.append((message.split(" ", 1)[0], []))
+                command_time = elapsed
+            elif exchanges:
+                exchanges[-1][1].append((elapsed - command_time, message))
+        self.exchanges = exchanges
+        self.cursor = 0
+
+    # inputから1行ずつコマンドを読み込んで、応答をoutputに書き出す。"quit"か入力の終わりで戻る。
+    # input , output : テキストのストリーム(sys.stdin , sys.stdoutなど)
+    def run(self, input, output):
+        self.output = output
+        for line in input:
+            self.received_lines += 1
+            if not self.handle(line.strip()):
+                break
+        self.stop_replying()
+
+    # 1行のコマンドを処理する。"quit"ならFalseを返す。
+    def handle(self, command: str) -> bool:
+        tokens = command.split()
+        if not tokens:
+            return True
+        token = tokens[0]
+
+        if token == "setoption" and self.set_option(tokens):
+            return True
+        if token == "stop":
+            self.stop_event.set()
+            return True
+
+        self.stop_replying()
+        if token == "quit":
+            return False
+
+        responses = self.find(token)
+        if responses is None:
+            self.unmatched_commands += 1
+            self.reply_default(token)
+        elif token == "go":
+            self.stop_event.clear()
+            self.reply_thread = threading.Thread(
+                target=self.reply, args=(responses, "infinite" in tokens)
+            )
+            self.reply_thread.start()
+        else:
+            self.reply(responses, False)
+        return True
+
+    # "setoption name ReplayTranscript value ..." , "setoption name ReplaySpeed value ..."を処理したならTrueを返す。
+    # それ以外のオプションは、記録したときのエンジンに送ったsetoptionとして扱う。
+    def set_option(self, tokens: List[str]) -> bool:
+        if "name" not in tokens or "value" not in tokens:
+            return False
+        name = tokens[tokens.index("name") + 1]
+        value = " ".join(tokens[tokens.index("value") + 1 :])
+        try:
+            if name == "ReplayTranscript":
+                self.load(value)
+            elif name == "ReplaySpeed":
+                self.speed = float(value)
+            else:
+                return False
+        except (OSError, ValueError):
+            self.write("info string Error! : can't set {0} to {1}".format(name, value))
+        return True
+
+    # self.cursor以降で、先頭のtokenがtokenであるコマンドを探して、それに対する応答を返す。見つからなければNone。
+    def find(self, token: str) -> Optional[List[Tuple[float, str]]]:
+        n = len(self.exchanges)
+        for i in range(n):
+            index = (self.cursor + i) % n
+            if self.exchanges[index][0] == token:
+                self.cursor = index + 1
+                return self.exchanges[index][1]
+        return None
+
+    # transcriptに対応するコマンドがなかったときの応答。
+    def reply_default(self, token: str):
+        if token == "usi":
+            self.write("id name ReplayUsiEngine")
+            self.write("id author Ayane")
+            self.write("option name ReplayTranscript type string default <empty>")
+            self.write("option name ReplaySpeed type string default 1")
+            self.write("usiok")
+        elif token == "isready":
+            self.write("readyok")
+        # 1行返ってくるのを待っているので、何か返す。
+        elif token == "side":
+            self.write("black")
+        elif token == "moves":
+            self.write("")
+        elif token == "go":
+            self.write("info string Error! : no transcript for go")
+            self.write("bestmove resign")
+
+    # responsesを記録したときのタイミングで出力する。
+    # "stop"を受信したら、残りは待たずに出力する。
+    # infinite : "go infinite"に対する応答なら、"stop"を受信するまでbestmoveを返さない。
+    def reply(self, responses: List[Tuple[float, str]], infinite: bool):
+        start_time = time.perf_counter()
+        for elapsed, message in responses:
+            if infinite and message.startswith("bestmove"):
+                self.stop_event.wait()
+            elif self.speed > 0 and not self.stop_event.is_set():
+                rest = start_time + elapsed / self.speed - time.perf_counter()
+                if rest > 0:
+                    self.stop_event.wait(rest)
+            self.write(message)
+
+    # "go"に対する応答を返している途中なら、残りを待たずに出力させて、終わるまで待つ。
+    def stop_replying(self):
+        if self.reply_thread is not None:
+            self.stop_event.set()
+            self.reply_thread.join()
+            self.reply_thread = None
+
+    # 1行出力する。
+    def write(self, line: str):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+            self.sent_lines += 1
+
+    # socket.socketpair()の片側でReplayUsiEngineをスレッドとして動かし、もう片側のUsiSocketTransportを返す。
+    # UsiEngine.connect_transport()に渡せば、プロセスを起動せずに再生できる。
+    @staticmethod
+    def start_transport(transcript_path: Optional[str] = None, speed: float = 1.0):  # -> UsiSocketTransport
+        engine = ReplayUsiEngine(transcript_path)
+        engine.speed = speed
+        return UsiSocketTransport.start_engine_thread(engine)
+
+
+# ゲームの終局状態を示す
 class GameResult(IntEnum):
     BLACK_WIN = 0  # 先手勝ち
     WHITE_WIN = 1  # 後手勝ち
@@ -983,6 +2611,36 @@ class AyaneruServer:
         # これをgame_start()呼び出し前にTrueにしておくと、エンジンから"Error xxx"と送られてきたときにその内容が標準出力に出力される。
         self.error_print = False
 
+        # これをgame_start()呼び出し前に設定しておくと、対局区間と、各エンジンの思考区間などが記録される。
+        self.tracer: Optional[ChromeTracer] = None
+
+        # これを設定しておくと、game_workerと各エンジンのhandle_infoの時間を集計する。
+        # (エンジンのread_worker , write_workerも集計するには、connect()の前にUsiEngine.profilerにも設定しておくこと)
+        self.profiler: Optional[Profiler] = None
+
+        # この対局サーバーの番号。tracerに記録するときのpidとして用いる。
+        # (MultiAyaneruServerから使う場合は、init_server()で設定される)
+        self.server_id = 0
+
+        # これを設定しておくと、定跡にある局面ではエンジンに思考させずに、ここから指し手を選ぶ。
+        # (MultiAyaneruServerから使う場合は、MultiAyaneruServer.bookを設定すれば良い)
+        self.book: Optional[SharedBook] = None
+
+        # MultiAyaneruServer.paired_openings == Trueのとき、この対局の、先後入れ替えた対局とのペアの番号。
+        self.pair_id: Optional[int] = None
+
+        # MultiAyaneruServerから使う場合の、この対局の開始局面のstart_sfens上のindex。
+        self.opening_index: Optional[int] = None
+
+        # これを設定しておくと、対局が終局するごとに(対局スレッドから)このサーバーを引数に呼び出される。
+        # 終局したサーバーをpollingせずに、すぐに次の対局を開始するのに用いる。(STOP_GAMEのときは呼び出されない)
+        self.game_over_callback: Optional[Callable[["AyaneruServer"], None]] = None
+
+        # この対局サーバーのエンジンを実行するCPU番号のlistと、メモリを確保するNUMAノード番号。
+        # MultiAyaneruServer.cpu_affinity == Trueのとき、init_server()で設定され、init_engine()で両エンジンに適用される。
+        self.cpu_affinity: Optional[List[int]] = None
+        self.numa_node: Optional[int] = None
+
         # --- publc readonly members
 
         # 現在の手番側
@@ -991,6 +2649,13 @@ class AyaneruServer:
         # 現在の局面のsfen("startpos moves ..."や、"sfen ... move ..."の形)
         self.sfen = "startpos"
 
+        # 現在の対局の開始局面(start_gameplyで打ち切ったあとのもの)
+        self.start_sfen = "startpos"
+
+        # 現在の対局の開始時刻と終了時刻(time.time()の値)
+        self.game_start_time = 0.0
+        self.game_end_time = 0.0
+
         # 初期局面からの手数
         self.game_ply = 1
 
@@ -998,6 +2663,22 @@ class AyaneruServer:
         # ゲームが終了したら、game_result.is_gameover() == Trueになる。
         self.game_result = GameResult.INIT
 
+        # 現在の対局で、self.bookから指した手数
+        self.book_ply = 0
+
+        # 現在の対局の1手ごとの評価値などを記録していく棋譜。game_kifu()で、そのほかの項目を設定して返す。
+        self.kifu = GameKifu()
+
+        # 現在の対局で時間切れが発生したか
+        self.timeup = False
+
+        # 現在の対局で、思考時間が持ち時間 + 秒読みを超過した量の最大値[ms]。(マイナスなら超過していない)
+        self.max_time_excess = -sys.maxsize
+
+        # 現在の対局で、エンジンが最後に出力した読み筋のnpsの合計と、その数
+        self.nps_total = 0
+        self.nps_count = 0
+
         # --- private memebers ---
 
         # 持ち時間残り [1P側 , 2P側] 単位はms。
@@ -1013,6 +2694,13 @@ class AyaneruServer:
         # 対局用スレッドの強制停止フラグ
         self.stop_thread: threading.Thread = False
 
+        # このサーバーで開始した対局の数
+        self.game_count = 0
+
+        # tracerに記録する、現在の対局の開始時刻と、前回の対局の終了時刻
+        self.trace_game_start_time = 0.0
+        self.trace_game_end_time: Optional[float] = None
+
     # turn側のplayer番号を取得する。(flip_turnを考慮する。)
     # 返し値
     # 0 : 1P側
@@ -1119,16 +2807,39 @@ class AyaneruServer:
             sfen = " ".join(sp[0 : index + 1])
 
         self.sfen = sfen
+        self.start_sfen = sfen
 
         for engine in self.engines:
             if not engine.is_connected():
                 raise ValueError("engine is not connected.")
             engine.debug_print = self.debug_print
             engine.error_print = self.error_print
+            engine.tracer = self.tracer
+            engine.trace_pid = self.server_id
+            engine.profiler = self.profiler
+
+        self.game_count += 1
+        if self.tracer is not None:
+            now = self.tracer.now()
+            # 前回の対局終了からこの対局開始までの区間(次の対局を開始するまでのpython側の待ち時間)
+            if self.trace_game_end_time is not None:
+                self.tracer.complete(
+                    "restart", self.trace_game_end_time, now, self.server_id, 0, "server"
+                )
+            else:
+                self.tracer.set_thread_name(self.server_id, 0, "games")
+            self.trace_game_start_time = now
 
         # 1P側のエンジンを使って、現局面の手番を得る。
         self.side_to_move = self.engines[0].get_side_to_move()
         self.game_ply = 1
+        self.book_ply = 0
+        self.kifu = GameKifu()
+        self.timeup = False
+        self.game_start_time = time.time()
+        self.max_time_excess = -sys.maxsize
+        self.nps_total = 0
+        self.nps_count = 0
         self.game_result = GameResult.PLAYING
 
         for engine in self.engines:
@@ -1141,13 +2852,34 @@ class AyaneruServer:
         ]
 
         # 対局用のスレッドを作成するのがお手軽か..
-        self.game_thread = threading.Thread(target=self.game_worker)
+        game_worker = self.game_worker
+        if self.profiler is not None:
+            game_worker = self.profiler.wrap("AyaneruServer.game_worker", game_worker)
+        self.game_thread = threading.Thread(target=game_worker)
         self.game_thread.start()
 
     # 対局スレッド
     def game_worker(self):
 
+        # 定跡から外れたか。(一度外れたら、以降は定跡を引かない)
+        out_of_book = self.book is None
+
         while self.game_ply < self.moves_to_draw:
+            # 定跡にある局面なら、エンジンに思考させずに定跡の指し手を指す。(持ち時間は消費しない)
+            if not out_of_book:
+                bookmove = cast(SharedBook, self.book).probe(self.sfen)
+                if bookmove is not None:
+                    self.sfen = self.sfen + " " + bookmove
+                    self.kifu.add_ply(None, None)
+                    self.game_ply += 1
+                    self.book_ply += 1
+                    self.side_to_move = self.side_to_move.flip()
+                    if self.stop_thread:
+                        self.game_result = GameResult.STOP_GAME
+                        return
+                    continue
+                out_of_book = True
+
             # 手番側に属するエンジンを取得する
             # ※　flip_turn == Trueのときは相手番のほうのエンジンを取得するので注意。
             engine = self.engine(self.side_to_move)
@@ -1185,10 +2917,28 @@ class AyaneruServer:
 
             # 現在の手番を数値化したもの。1P側=0 , 2P側=1
             int_turn = self.player_number(self.side_to_move)
+
+            # 持ち時間 + 秒読みに対して、実際に何[ms]超過したか。(並列対局数の調整に用いる)
+            time_excess = int(
+                (end_time - start_time) * 1000
+                - (self.rest_time[int_turn] + self.time_setting[byoyomi_str])
+            )
+            self.max_time_excess = max(self.max_time_excess, time_excess)
+
+            # 手番側のエンジンが最後に出力した読み筋のnps
+            last_pv = None
+            if len(engine.think_result.pvs) >= 1 and engine.think_result.pvs[0] is not None:
+                last_pv = engine.think_result.pvs[0]
+                nps = last_pv.nps
+                if nps is not None:
+                    self.nps_total += int(nps)
+                    self.nps_count += 1
+
             self.rest_time[int_turn] -= int(elapsed_time)
             if (
                 self.rest_time[int_turn] + self.time_setting[byoyomi_str] < -2000
             ):  # 秒読み含めて-2秒より減っていたら。0.1秒対局とかもあるので1秒繰り上げで引いていくとおかしくなる。
+                self.timeup = True
                 self.game_result = GameResult.from_win_turn(self.side_to_move.flip())
                 self.game_over()
                 # 本来、自己対局では時間切れになってはならない。(計測が不確かになる)
@@ -1213,6 +2963,7 @@ class AyaneruServer:
                 return
 
             self.sfen = self.sfen + " " + bestmove
+            self.kifu.add_ply(last_pv, int((end_time - start_time) * 1000))
             self.game_ply += 1
 
             # inctime分、時間を加算
@@ -1234,6 +2985,21 @@ class AyaneruServer:
     # エンジンに対してゲームオーバーのメッセージを送信する。
     def game_over(self):
         result = self.game_result
+        self.game_end_time = time.time()
+
+        if self.tracer is not None:
+            now = self.tracer.now()
+            self.tracer.complete(
+                "game",
+                self.trace_game_start_time,
+                now,
+                self.server_id,
+                0,
+                "server",
+                {"game": self.game_count, "result": result.name, "ply": self.game_ply},
+            )
+            self.trace_game_end_time = now
+
         if result.is_draw():
             for engine in self.engines:
                 engine.send_command("gameover draw")
@@ -1245,10 +3011,27 @@ class AyaneruServer:
             # それ以外サポートしてない
             raise ValueError("illegal result")
 
+        if self.game_over_callback is not None:
+            self.game_over_callback(self)
+
+    # 終局した対局の棋譜と付随情報をGameKifuにして返す。
+    def game_kifu(self) -> "GameKifu":
+        kifu = self.kifu
+        kifu.sfen = self.sfen
+        kifu.flip_turn = self.flip_turn
+        kifu.game_result = self.game_result
+        kifu.pair_id = self.pair_id
+        kifu.start_sfen = self.start_sfen
+        kifu.start_time = self.game_start_time
+        kifu.end_time = self.game_end_time
+        return kifu
+
     # エンジンを終了させるなどの後処理を行う
     def terminate(self):
         self.stop_thread = True
-        self.game_thread.join()
+        # 一度も対局を開始していないならgame_threadはNone。
+        if self.game_thread is not None:
+            self.game_thread.join()
         for engine in self.engines:
             engine.disconnect()
 
@@ -1257,6 +3040,689 @@ class AyaneruServer:
         self.terminate()
 
 
+# 定跡ファイル(1行に"startpos moves ..."や"sfen ... moves ..."が1つ書かれたもの)を扱うクラス。
+# ファイルをmmapで開いて各行の開始位置のindexだけをメモリに持つので、数百万行の定跡ファイルでも
+# 起動時間とメモリ使用量がほとんど増えない。indexは定跡ファイルと同じフォルダに"(定跡ファイル名).idx"として保存しておき、
+# 次回からはそれを読み込む。(定跡ファイルのサイズか更新日時が変わっていたら作り直す)
+#
+# 使い方)
+#   book = OpeningBook("book/records2016_10818.sfen")
+#   server.start_sfens = book.start_sfens(24)  # 24手目の局面で打ち切った開始局面(重複は除去済み)
+#   server.start_gameply = 0                   # 打ち切り済みなのでAyaneruServer側では打ち切らない。
+class OpeningBook:
+    def __init__(self, path: str):
+
+        # --- public readonly members ---
+
+        # 定跡ファイルのpath
+        self.path = path
+
+        # 各行の開始位置と長さ[byte]。(空行は除く)
+        self.line_offsets = array("q")
+        self.line_lengths = array("q")
+
+        # --- private members ---
+
+        # 定跡ファイルのサイズと更新日時(indexが古くなっていないかの判定に用いる)
+        stat = os.stat(path)
+        self.file_stamp = [stat.st_size, stat.st_mtime_ns]
+
+        self.file = open(path, "rb")
+        # サイズ0のファイルはmmapできない。
+        self.mmap = (
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if stat.st_size != 0
+            else b""
+        )
+
+        index = self.load_index(path + ".idx", 2)
+        if index is not None:
+            self.line_offsets, self.line_lengths = index
+        else:
+            self.build_line_index()
+            self.save_index(path + ".idx", [self.line_offsets, self.line_lengths])
+
+    # 定跡ファイルの行数(空行は除く)
+    def __len__(self) -> int:
+        return len(self.line_offsets)
+
+    # i行目(空行は除く)を末尾の改行を取り除いて返す。
+    def __getitem__(self, i: int) -> str:
+        offset = self.line_offsets[i]
+        return self.mmap[offset : offset + self.line_lengths[i]].decode("utf-8")
+
+    # 各行をstart_gameply手目の局面で打ち切って、重複を取り除いた開始局面の集合を返す。
+    # 返し値はlistのように使えるので、そのままMultiAyaneruServer.start_sfensに設定できる。
+    # (このときMultiAyaneruServer.start_gamplyは0にしておくこと)
+    # start_gameplyの意味はAyaneruServer.game_start()と同じ。0なら打ち切らない。
+    # 結果も"(定跡ファイル名).ply(start_gameply).idx"として保存しておき、次回からはそれを読み込む。
+    def start_sfens(self, start_gameply: int):  # -> OpeningBookView
+        path = "{0}.ply{1}.idx".format(self.path, start_gameply)
+        index = self.load_index(path, 2)
+        if index is None:
+            index = self.build_truncated_index(start_gameply)
+            self.save_index(path, index)
+        return OpeningBookView(self, index[0], index[1])
+
+    # 定跡ファイルを閉じる。
+    def close(self):
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+        self.file.close()
+
+    # 各行の開始位置と長さのindexを作る。
+    def build_line_index(self):
+        data = self.mmap
+        size = len(data)
+        offset = 0
+        while offset < size:
+            end = data.find(b"\n", offset)
+            if end == -1:
+                end = size
+            # 前後の空白(Windowsの改行の\rなど)は含めない。
+            line = data[offset:end]
+            stripped = line.strip()
+            if stripped:
+                self.line_offsets.append(offset + line.index(stripped))
+                self.line_lengths.append(len(stripped))
+            offset = end + 1
+
+    # 各行をstart_gameply手目で打ち切った部分の開始位置と長さのうち、重複を除いたものを返す。
+    def build_truncated_index(self, start_gameply: int) -> List[array]:
+        offsets = array("q")
+        lengths = array("q")
+        seen = set()
+        data = self.mmap
+        for offset, length in zip(self.line_offsets, self.line_lengths):
+            line = data[offset : offset + length]
+            if start_gameply != 0:
+                # AyaneruServer.game_start()と同じ打ち切り方をする。
+                # "moves"がない行は、そのあとに指し手がないのでそのまま。
+                tokens = line.split()
+                if b"moves" in tokens:
+                    index = min(tokens.index(b"moves") + start_gameply - 1, len(tokens) - 1)
+                    # 打ち切る位置までのtokenを探して、その末尾までの長さにする。
+                    for i, match in enumerate(re.finditer(rb"\S+", line)):
+                        if i == index:
+                            line = line[: match.end()]
+                            break
+                    # "startpos moves"と"startpos"は同じ局面なので、末尾の"moves"は取り除いておく。
+                    if line.endswith(b" moves"):
+                        line = line[: -len(b" moves")]
+            key = hash(line)
+            if key in seen:
+                continue
+            seen.add(key)
+            offsets.append(offset)
+            lengths.append(len(line))
+        return [offsets, lengths]
+
+    # indexファイルを読み込む。定跡ファイルのサイズか更新日時が変わっていたり、読み込めなかったらNoneを返す。
+    # ファイルの中身は、[バージョン , 定跡ファイルのサイズ , 更新日時 , 要素数]のあとに、num個のarray("q")が続く。
+    def load_index(self, path: str, num: int) -> Optional[List[array]]:
+        try:
+            with open(path, "rb") as f:
+                header = array("q")
+                header.fromfile(f, 4)
+                if (
+                    header[0] != OpeningBook.index_version
+                    or list(header[1:3]) != self.file_stamp
+                ):
+                    return None
+                arrays = []
+                for _ in range(num):
+                    a = array("q")
+                    a.fromfile(f, header[3])
+                    arrays.append(a)
+                return arrays
+        except (OSError, EOFError):
+            return None
+
+    # indexファイルを書き出す。書き込めないフォルダなら何もしない。
+    def save_index(self, path: str, arrays: List[array]):
+        try:
+            with open(path + ".tmp", "wb") as f:
+                array(
+                    "q", [OpeningBook.index_version] + self.file_stamp + [len(arrays[0])]
+                ).tofile(f)
+                for a in arrays:
+                    a.tofile(f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+    def __del__(self):
+        if hasattr(self, "file"):
+            self.close()
+
+    # --- private static members ---
+
+    # indexファイルの形式のバージョン
+    index_version = 1
+
+
+# 対局中の定跡の指し手をpython側で返すためのクラス。
+# 棋譜ファイル(1行に"startpos moves ..."や"sfen ... moves ..."が1つ書かれたもの)を読み込み、
+# 開始局面からの指し手の手順 → 次の指し手とその出現回数 のtableを作っておく。
+# AyaneruServer.bookに設定すると、定跡にある局面ではエンジンに思考させずにこのtableから出現回数に比例した確率で指し手を選ぶ。
+# 1つのinstanceをすべての対局サーバーで共有すれば、定跡の読み込みは1回で済み、エンジンごとに定跡を読み込む必要がなくなる。
+# (エンジン側は"BookFile"を"no_book"にしておけば良い)
+# ※　局面ではなく開始局面からの手順で引くので、手順前後で同じ局面になったものは別の局面として扱われる。
+class SharedBook:
+    def __init__(self):
+
+        # --- public members ---
+
+        # 出現回数がこれ未満の指し手は選ばない。
+        self.min_count = 1
+
+        # --- public readonly members ---
+
+        # 登録されている局面の数
+        self.positions = 0
+
+        # --- private members ---
+
+        # 手順のhash値 → [(指し手 , 出現回数) , ...]
+        self.table: Dict[int, List[Tuple[str, int]]] = {}
+
+    # 棋譜ファイルを読み込んで、各棋譜の開始局面からmax_ply手目までをtableに登録する。
+    # 複数回呼び出せば、複数のファイルの内容が合算される。
+    def load(self, path: str, max_ply: int):
+        counts: Dict[int, Dict[str, int]] = {}
+        for key, entries in self.table.items():
+            counts[key] = dict(entries)
+
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                key, moves = SharedBook.parse(line)
+                if key is None:
+                    continue
+                for move in moves[:max_ply]:
+                    move = sys.intern(move)
+                    entry = counts.setdefault(key, {})
+                    entry[move] = entry.get(move, 0) + 1
+                    key = hash((key, move))
+
+        self.table = {key: list(entry.items()) for key, entry in counts.items()}
+        self.positions = len(self.table)
+
+    # "startpos moves ..."や"sfen ... moves ..."の形の局面に対して、定跡の指し手を1つ返す。
+    # 定跡にない局面ならNoneを返す。
+    def probe(self, sfen: str) -> Optional[str]:
+        key, moves = SharedBook.parse(sfen)
+        if key is None:
+            return None
+        for move in moves:
+            key = hash((key, move))
+
+        entries = self.table.get(key)
+        if entries is None:
+            return None
+        entries = [(move, count) for move, count in entries if count >= self.min_count]
+        if not entries:
+            return None
+        return random.choices(
+            [move for move, _ in entries], [count for _, count in entries]
+        )[0]
+
+    # "startpos moves ..."のような文字列を、開始局面のhash値と、指し手のlistに分解する。
+    # 空行ならkeyはNoneになる。
+    @staticmethod
+    def parse(sfen: str) -> Tuple[Optional[int], List[str]]:
+        tokens = sfen.split()
+        if not tokens:
+            return None, []
+        if "moves" in tokens:
+            index = tokens.index("moves")
+            return hash(" ".join(tokens[:index])), tokens[index + 1 :]
+        return hash(" ".join(tokens)), []
+
+
+# OpeningBook.start_sfens()の返し値。start_gameply手目で打ち切った開始局面の集合を、listのように参照できる。
+class OpeningBookView:
+    def __init__(self, book: OpeningBook, offsets: array, lengths: array):
+        self.book = book
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, i: int) -> str:
+        offset = self.offsets[i]
+        return self.book.mmap[offset : offset + self.lengths[i]].decode("utf-8")
+
+
+# 複数のエンジンを並列に動かして、局面の集合を固定の探索条件で評価するクラス。
+# 評価値はcache_pathのファイルに1局面評価するごとに追記していくので、中断しても続きから再開できる。
+# 定跡ファイルの開始局面のうち、互角に近いものだけを選ぶのに用いる。
+class PositionEvaluator:
+    def __init__(self):
+
+        # --- public members ---
+
+        # エンジンの実行ファイルのpath
+        self.engine_path = None  # str
+
+        # エンジンオプション
+        self.options: Dict[str, str] = {}
+
+        # 並列に動かすエンジンの数
+        self.parallel = 1
+
+        # 各局面に対して送る"go"コマンドのパラメーター
+        self.go_options = "depth 10"
+
+        # 評価値のcacheファイルのpath。Noneならcacheしない。
+        # 1行に"評価値<TAB>局面"の形で書かれる。評価値は手番側から見た値。
+        # go_optionsやエンジンが異なれば別のファイルにすること。
+        self.cache_path = None  # str
+
+        # エンジンとのやりとりを標準出力に出力する(デバッグ用)
+        self.debug_print = False
+
+        # --- public readonly members ---
+
+        # 局面 → 評価値(手番側から見た値)
+        # 評価値が得られなかった局面はUsiEvalSpecialValue.ValueNone
+        self.scores: Dict[str, int] = {}
+
+        # 今回のevaluate()でエンジンに評価させた局面の数
+        self.evaluated = 0
+
+        # --- private members ---
+
+        self.lock = threading.Lock()
+
+        # workerで発生した例外。evaluate()の最後に投げ直す。
+        self.error: Optional[Exception] = None
+
+    # sfensの各局面を評価して、self.scoresに格納する。
+    # cacheファイルにすでに評価値があるものは評価しない。
+    # progress : 局面を1つ評価するごとに(評価済みの数, 全体の数)を引数に呼び出される。
+    # エンジンが起動できなかったり、評価中に落ちたりしたら、残りの局面は評価せずにそのときの例外を投げる。
+    # (それまでに評価した局面はcacheファイルに書き出されている)
+    def evaluate(self, sfens, progress=None):
+        self.load_cache()
+        self.error = None
+
+        queue: Queue = Queue()
+        total = 0
+        for sfen in sfens:
+            total += 1
+            if sfen not in self.scores:
+                queue.put(sfen)
+        self.evaluated = 0
+        done = total - queue.qsize()
+
+        cache = (
+            open(self.cache_path, "a", encoding="utf-8")
+            if self.cache_path is not None
+            else None
+        )
+
+        def worker():
+            nonlocal done
+            engine = UsiEngine()
+            engine.debug_print = self.debug_print
+            engine.set_engine_options(self.options)
+            try:
+                engine.connect(self.engine_path)
+                while self.error is None:
+                    try:
+                        sfen = queue.get_nowait()
+                    except Empty:
+                        break
+                    engine.usi_position(sfen)
+                    engine.usi_go_and_wait_bestmove(self.go_options, True)
+                    score = PositionEvaluator.score_of(engine.think_result)
+                    with self.lock:
+                        self.scores[sfen] = score
+                        self.evaluated += 1
+                        done += 1
+                        if cache is not None:
+                            cache.write("{0}\t{1}\n".format(score, sfen))
+                            cache.flush()
+                        if progress is not None:
+                            progress(done, total)
+            except Exception as e:
+                # 最初の例外だけを覚えておく。他のworkerは、いま評価している局面を終えたら止まる。
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                engine.disconnect()
+
+        threads = [
+            threading.Thread(target=worker)
+            for _ in range(max(min(self.parallel, queue.qsize()), 0))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if cache is not None:
+            cache.close()
+
+        if self.error is not None:
+            raise self.error
+
+    # 評価値の絶対値がmargin以下の局面だけをsfensの順番のまま返す。
+    # evaluate()のあとに呼び出すこと。
+    def balanced(self, sfens, margin: int) -> List[str]:
+        return [
+            sfen
+            for sfen in sfens
+            if abs(self.scores.get(sfen, UsiEvalSpecialValue.ValueNone)) <= margin
+        ]
+
+    # cacheファイルから評価値を読み込む。
+    def load_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        with open(self.cache_path, "r", encoding="utf-8") as f:
+            for line in f:
+                tokens = line.rstrip("\n").split("\t", 1)
+                # 書き込み途中で中断された行は無視する。
+                if len(tokens) != 2 or not tokens[1]:
+                    continue
+                try:
+                    self.scores[tokens[1]] = int(tokens[0])
+                except ValueError:
+                    pass
+
+    # 思考結果から手番側から見た評価値を取り出す。
+    # 投了・宣言勝ちなら詰みのスコア、評価値が得られなければUsiEvalSpecialValue.ValueNoneを返す。
+    @staticmethod
+    def score_of(think_result: UsiThinkResult) -> int:
+        if think_result.bestmove == "resign":
+            return int(UsiEvalSpecialValue.ValueMated)
+        if think_result.bestmove == "win":
+            return int(UsiEvalSpecialValue.ValueMate)
+        if not think_result.pvs or think_result.pvs[0].eval is None:
+            return int(UsiEvalSpecialValue.ValueNone)
+        return int(think_result.pvs[0].eval)
+
+
+# 棋譜の集合を、複数のエンジンで並列に解析するクラス。
+# 各棋譜の各局面に対して固定の探索条件で思考させて、その結果(bestmove、MultiPVの評価値・深さ・読み筋)を
+# output_pathのファイルに1局面ごとに1行のJSONで追記していく。中断しても、同じ棋譜と同じoutput_pathで呼び出せば続きから再開できる。
+#
+# 使い方)
+#   analyzer = KifuAnalyzer()
+#   analyzer.engine_path = "exe/YaneuraOu.exe"
+#   analyzer.parallel = 8
+#   analyzer.output_path = "kifu.analysis.jsonl"
+#   with open("kifu.sfen") as f:
+#       analyzer.analyze(f)
+#
+# 棋譜は1行に1局、"startpos moves 7g7f ..."や"sfen ... moves ..."の形式。(先頭の"position "はあってもなくても良い)
+# 出力の1行は以下の形式。gameは入力の何行目の棋譜か(0 origin)、plyは開始局面から何手進めた局面か、moveはその局面で棋譜で指された指し手。
+#   {"game": 0, "ply": 2, "move": "2g2f", "bestmove": "2g2f", "ponder": "8d8e",
+#    "pvs": [{"multipv": 1, "eval": 52, "depth": 10, "seldepth": 12, "nodes": 18234, "time": 12, "pv": "2g2f 8d8e"}]}
+# 出力の順番は解析が終わった順なので、棋譜の順番にはならない。
+class KifuAnalyzer:
+    def __init__(self):
+
+        # --- public members ---
+
+        # エンジンの実行ファイルのpath
+        self.engine_path = None  # str
+
+        # エンジンオプション
+        self.options: Dict[str, str] = {}
+
+        # 並列に動かすエンジンの数
+        self.parallel = 1
+
+        # 各局面に対して送る"go"コマンドのパラメーター
+        self.go_options = "depth 10"
+
+        # 1局面あたりに出力する読み筋の数。2以上ならエンジンオプションの"MultiPV"として設定する。
+        self.multipv = 1
+
+        # 解析する局面の手数の範囲。start_ply手目からend_ply手目(含む)までを解析する。
+        # end_plyがNoneなら棋譜の最後の局面まで。
+        self.start_ply = 0
+        self.end_ply = None  # int
+
+        # 解析結果を追記していくファイルのpath。Noneなら書き出さない。(result_callbackで受け取る)
+        self.output_path = None  # str
+
+        # 1局面解析するごとに、その結果(出力の1行と同じ内容のdict)を引数に呼び出される。
+        self.result_callback = None  # Callable[[dict], None]
+
+        # エンジンに接続する関数。Noneならengine_pathのエンジンを起動する。
+        # 例) analyzer.connect_engine = lambda engine: engine.connect("tcp://192.168.0.2:5001")
+        self.connect_engine = None  # Callable[[UsiEngine], None]
+
+        # エンジンとのやりとりを標準出力に出力する(デバッグ用)
+        self.debug_print = False
+
+        # --- public readonly members ---
+
+        # 今回のanalyze()で、棋譜から読み込んだ局面の数(解析済みで飛ばしたものも含む)
+        self.read = 0
+
+        # 今回のanalyze()で、出力済みだったので飛ばした局面の数
+        self.skipped = 0
+
+        # 今回のanalyze()でエンジンに解析させた局面の数
+        self.analyzed = 0
+
+        # --- private members ---
+
+        self.lock = threading.Lock()
+
+        # stop()が呼び出されたか
+        self.stopped = False
+
+        # 棋譜を読み込むスレッドで発生した例外
+        self.error = None  # Exception
+
+    # gamesの各棋譜の各局面を解析する。すべての局面を解析し終わるか、stop()が呼び出されるまで戻ってこない。
+    # エンジンが起動できなかったり、解析中に落ちたりしたら、すべてのエンジンを止めてそのときの例外を投げる。
+    # games    : 棋譜(1局1行)のiterable。ファイルオブジェクトをそのまま渡しても良い。先頭から順に少しずつ読み込む。
+    # progress : 局面を1つ解析するごとに(解析済みの数, 全体の数)を引数に呼び出される。
+    #            解析済みの数には、output_pathに出力済みで飛ばした局面の数も含む。
+    # total    : 全体の局面の数。count_positions()で求めたものを渡す。
+    #            Noneなら、その時点までに棋譜から読み込んだ局面の数をprogressに渡す。
+    def analyze(self, games, progress=None, total: Optional[int] = None):
+        done_plies = self.load_output()
+
+        # 各エンジンはこのqueueから空いたときに次の局面を取ってくるので、速いエンジンほど多くの局面を処理する。
+        # 棋譜を全部メモリに読み込まなくて済むように、queueの大きさは制限しておく。
+        queue: Queue = Queue(maxsize=max(self.parallel, 1) * 16)
+        self.read = 0
+        self.skipped = 0
+        self.analyzed = 0
+        self.stopped = False
+        self.error = None
+        reading = True
+
+        output = None
+        if self.output_path is not None:
+            output = open(self.output_path, "a", encoding="utf-8")
+            # 書き込み途中で中断された行があれば、その行のあとに続けて書かないように改行しておく。
+            if output.tell() > 0:
+                with open(self.output_path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        output.write("\n")
+
+        def report():
+            if progress is not None:
+                progress(self.skipped + self.analyzed, self.read if total is None else total)
+
+        # 棋譜を読み込んで、解析済みでない局面をqueueに積んでいくスレッド
+        def reader():
+            nonlocal reading
+            try:
+                for game, line in enumerate(games):
+                    if line.strip() == "":
+                        continue
+                    done = done_plies.get(game, 0)
+                    for ply, position, move in self.positions_of(line):
+                        with self.lock:
+                            self.read += 1
+                            if done >> ply & 1:
+                                self.skipped += 1
+                                report()
+                                continue
+                        item = (game, ply, position, move)
+                        while not self.stopped:
+                            try:
+                                queue.put(item, timeout=0.1)
+                                break
+                            except Full:
+                                pass
+                        if self.stopped:
+                            return
+            except Exception as e:
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+                self.stop()
+            finally:
+                reading = False
+
+        def worker():
+            engine = UsiEngine()
+            engine.debug_print = self.debug_print
+            options = dict(self.options)
+            if self.multipv >= 2:
+                options["MultiPV"] = str(self.multipv)
+            engine.set_engine_options(options)
+            try:
+                if self.connect_engine is not None:
+                    self.connect_engine(engine)
+                else:
+                    engine.connect(self.engine_path)
+                while not self.stopped:
+                    try:
+                        game, ply, position, move = queue.get(timeout=0.1)
+                    except Empty:
+                        if not reading:
+                            break
+                        continue
+                    engine.usi_position(position)
+                    engine.usi_go_and_wait_bestmove(self.go_options, True)
+                    result = KifuAnalyzer.result_of(game, ply, move, engine.think_result)
+                    with self.lock:
+                        self.analyzed += 1
+                        if output is not None:
+                            output.write(json.dumps(result) + "\n")
+                            output.flush()
+                        if self.result_callback is not None:
+                            self.result_callback(result)
+                        report()
+            except Exception as e:
+                # エンジンが起動できないか、落ちた。すべて止めてanalyze()から例外を投げる。
+                # 解析中だった局面は出力されていないので、再開したときに解析し直される。
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+                self.stop()
+            finally:
+                engine.disconnect()
+
+        threads = [threading.Thread(target=reader)] + [
+            threading.Thread(target=worker) for _ in range(max(self.parallel, 1))
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            # Ctrl+Cで中断されたら、各エンジンが解析中の局面を書き出すのを待ってから抜ける。
+            self.stop()
+            for thread in threads:
+                thread.join()
+            raise
+        finally:
+            if output is not None:
+                output.close()
+
+        if self.error is not None:
+            raise self.error
+
+    # analyze()を中断する。各エンジンは解析中の局面を書き出してから終了する。
+    def stop(self):
+        self.stopped = True
+
+    # 棋譜1局から、解析する局面を(手数, "position"コマンドで送る局面, 棋譜でその局面で指された指し手)のlistにして返す。
+    # 棋譜の最後の局面の指し手はNone。
+    def positions_of(self, game: str) -> List[Tuple[int, str, Optional[str]]]:
+        tokens = game.split()
+        if tokens and tokens[0] == "position":
+            tokens = tokens[1:]
+        if not tokens or tokens[0] not in ("startpos", "sfen"):
+            raise ValueError("invalid kifu : {0}".format(game.strip()))
+        if "moves" in tokens:
+            index = tokens.index("moves")
+            base, moves = " ".join(tokens[:index]), tokens[index + 1 :]
+        else:
+            base, moves = " ".join(tokens), []
+
+        end_ply = len(moves) if self.end_ply is None else min(self.end_ply, len(moves))
+        positions = []
+        for ply in range(self.start_ply, end_ply + 1):
+            position = base + " moves " + " ".join(moves[:ply]) if ply > 0 else base
+            positions.append((ply, position, moves[ply] if ply < len(moves) else None))
+        return positions
+
+    # gamesを解析したときの全体の局面の数を返す。(analyze()のtotalに渡す)
+    def count_positions(self, games) -> int:
+        return sum(len(self.positions_of(line)) for line in games if line.strip() != "")
+
+    # output_pathのファイルから解析済みの局面を読み込む。
+    # 棋譜の番号 → 解析済みの手数のbit(ply手目が解析済みなら1 << ply)を返す。
+    def load_output(self) -> Dict[int, int]:
+        done_plies: Dict[int, int] = {}
+        if self.output_path is None or not os.path.exists(self.output_path):
+            return done_plies
+        with open(self.output_path, "r", encoding="utf-8") as f:
+            for line in f:
+                # 書き込み途中で中断された行は無視する。
+                try:
+                    result = json.loads(line)
+                    game, ply = int(result["game"]), int(result["ply"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                done_plies[game] = done_plies.get(game, 0) | 1 << ply
+        return done_plies
+
+    # 思考結果を、出力の1行の内容のdictにする。
+    @staticmethod
+    def result_of(game: int, ply: int, move: Optional[str], think_result: UsiThinkResult) -> dict:
+        pvs = []
+        for i, pv in enumerate(think_result.pvs):
+            if pv is None:
+                continue
+            pvs.append(
+                {
+                    "multipv": i + 1,
+                    "eval": int(pv.eval) if pv.eval is not None else None,
+                    "depth": int(pv.depth) if pv.depth is not None else None,
+                    "seldepth": int(pv.seldepth) if pv.seldepth is not None else None,
+                    "nodes": int(pv.nodes) if pv.nodes is not None else None,
+                    "time": int(pv.time) if pv.time is not None else None,
+                    "pv": pv.pv,
+                }
+            )
+        return {
+            "game": game,
+            "ply": ply,
+            "move": move,
+            "bestmove": think_result.bestmove,
+            "ponder": think_result.ponder,
+            "pvs": pvs,
+        }
+
+
 # 対局棋譜、付随情報つき。
 class GameKifu:
     def __init__(self):
@@ -1271,6 +3737,86 @@ class GameKifu:
         # 試合結果
         self.game_result = None  # GameResult
 
+        # MultiAyaneruServer.paired_openings == Trueのとき、同じ開始局面を先後入れ替えて指した2局につけられるペアの番号
+        self.pair_id = None  # int
+
+        # 開始局面(AyaneruServer.game_start()でstart_gameplyで打ち切ったあとのもの)
+        self.start_sfen = None  # str
+
+        # 対局の開始時刻と終了時刻(time.time()の値)
+        self.start_time = 0.0
+        self.end_time = 0.0
+
+        # 開始局面(start_sfen)以降の1手ごとに、指した側のエンジンが最後に出力した読み筋の
+        # 評価値、深さ、ノード数、nps、hashfull、time[ms](エンジンの報告した思考時間)と、
+        # "go"を送ってから"bestmove"を受け取るまでの時間[ms](think_times)。
+        # 値がなかったもの(定跡の指し手、エンジンが出力しなかった項目)はGameKifu.NO_VALUE。
+        self.evals = array("i")
+        self.depths = array("i")
+        self.nodes = array("q")
+        self.nps = array("q")
+        self.hashfulls = array("i")
+        self.times = array("q")
+        self.think_times = array("q")
+
+    # 値がないことを表す値
+    NO_VALUE = -(2 ** 31)
+
+    # 1手ごとの値の列名と、arrayの型
+    series_typecodes = {
+        "evals": "i",
+        "depths": "i",
+        "nodes": "q",
+        "nps": "q",
+        "hashfulls": "i",
+        "times": "q",
+        "think_times": "q",
+    }
+
+    # 1手分の値を追加する。
+    # pv : 指した側のエンジンが最後に出力した読み筋(UsiThinkResult.pvs[0])。定跡の指し手ならNone。
+    # think_time : "go"を送ってから"bestmove"を受け取るまでの時間[ms]。定跡の指し手ならNone。
+    def add_ply(self, pv: Optional[UsiThinkPV], think_time: Optional[int]):
+        no_value = GameKifu.NO_VALUE
+        if pv is None:
+            pv = UsiThinkPV()
+        self.evals.append(int(pv.eval) if pv.eval is not None else no_value)
+        self.depths.append(int(pv.depth) if pv.depth is not None else no_value)
+        self.nodes.append(int(pv.nodes) if pv.nodes is not None else no_value)
+        self.nps.append(int(pv.nps) if pv.nps is not None else no_value)
+        self.hashfulls.append(int(pv.hashfull) if pv.hashfull is not None else no_value)
+        self.times.append(int(pv.time) if pv.time is not None else no_value)
+        self.think_times.append(think_time if think_time is not None else no_value)
+
+    # ply手目(開始局面以降の0から数えた手数)の{列名 : 値}を返す。値がないものと、記録されていない手はNone。
+    def ply_values(self, ply: int) -> Dict[str, Optional[int]]:
+        values = {}
+        for name in GameKifu.series_typecodes:
+            series = getattr(self, name)
+            value = series[ply] if ply < len(series) else GameKifu.NO_VALUE
+            values[name] = value if value != GameKifu.NO_VALUE else None
+        return values
+
+    # JSONに書き出せる形にして返す。
+    def to_dict(self) -> dict:
+        d = dict(vars(self))
+        d["game_result"] = int(self.game_result) if self.game_result is not None else None
+        for name in GameKifu.series_typecodes:
+            d[name] = d[name].tolist()
+        return d
+
+    # to_dict()で書き出したものから復元する。
+    @staticmethod
+    def from_dict(d: dict):  # -> GameKifu
+        kifu = GameKifu()
+        for key, value in d.items():
+            if key in GameKifu.series_typecodes:
+                value = array(GameKifu.series_typecodes[key], value)
+            setattr(kifu, key, value)
+        if kifu.game_result is not None:
+            kifu.game_result = GameResult(kifu.game_result)
+        return kifu
+
 
 class EloRating:
     def __init__(self):
@@ -1292,6 +3838,11 @@ class EloRating:
         # 引き分けの回数
         self.draw_games = 0
 
+        # 同じ開始局面を先後入れ替えて指した2局をペアとして、そのペアの1P側の勝ち点の合計(0,0.5,1,1.5,2)ごとの回数。
+        # (pentanomial) これを設定しておくと、ペア単位の勝ち点の平均と分散からもレーティング差と信頼区間を計算する。
+        # 開始局面の有利不利がペアのなかで相殺されるので、1局ごとの結果から計算するより信頼区間が狭くなる。
+        self.pentanomial: Optional[List[int]] = None
+
         # --- public readonly members ---
 
         # 勝率1P側
@@ -1308,6 +3859,12 @@ class EloRating:
         self.rating_lowerbound = 0
         self.rating_upperbound = 0
 
+        # pentanomialから計算した、1P側の勝ち点の平均と、レーティング差、その95%信頼区間の下限,上限
+        self.pentanomial_score = 0.0
+        self.pentanomial_rating = 0.0
+        self.pentanomial_lowerbound = 0.0
+        self.pentanomial_upperbound = 0.0
+
         # レーティング差についてユーザーに見やすい形での文字列
         self.pretty_string = ""
 
@@ -1365,6 +3922,42 @@ class EloRating:
             + "%"
         )
 
+        if self.pentanomial is not None and sum(self.pentanomial) != 0:
+            self.calc_pentanomial()
+            self.pretty_string += " ptnml {0} R{1}[{2},{3}]".format(
+                self.pentanomial,
+                round(self.pentanomial_rating, 2),
+                round(self.pentanomial_lowerbound, 2),
+                round(self.pentanomial_upperbound, 2),
+            )
+
+    # pentanomialから、レーティング差とその95%信頼区間を計算する。
+    def calc_pentanomial(self):
+        pentanomial = cast(List[int], self.pentanomial)
+        score, var = EloRating.pentanomial_score_var(pentanomial)
+        # ペアの数をnとして、1局あたりの勝ち点の平均の標準誤差
+        stderr = math.sqrt(var / sum(pentanomial))
+
+        self.pentanomial_score = score
+        self.pentanomial_rating = EloRating.calc_rating(score)
+        self.pentanomial_lowerbound = EloRating.calc_rating(
+            min(max(score - 1.959964 * stderr, 0), 1)
+        )
+        self.pentanomial_upperbound = EloRating.calc_rating(
+            min(max(score + 1.959964 * stderr, 0), 1)
+        )
+
+    # pentanomialから、1局あたりの勝ち点の平均と、ペアごとの(1局あたりの)勝ち点の分散を返す。
+    @staticmethod
+    def pentanomial_score_var(pentanomial: List[int]) -> Tuple[float, float]:
+        n = sum(pentanomial)
+        if n == 0:
+            return 0.0, 0.0
+        # pentanomial[i]は、ペアの勝ち点の合計がi/2 , つまり1局あたりi/4の勝ち点であるペアの数。
+        score = sum(count * i / 4 for i, count in enumerate(pentanomial)) / n
+        var = sum(count * (i / 4 - score) ** 2 for i, count in enumerate(pentanomial)) / n
+        return score, var
+
     # cf. http://tadaoyamaoka.hatenablog.com/entry/2017/06/14/203529
     # ここで、rは勝率、nは対局数で、棄却域Rは、有意水準α=0.05とするとR>1.644854となる。
 
@@ -1409,82 +4002,1200 @@ class EloRating:
         return -EloRating.calc_rating(p0)
 
 
-# 並列自己対局のためのクラス
-class MultiAyaneruServer:
-    def __init__(self):
+# 逐次確率比検定(SPRT)を行うクラス。
+# 「1P側は2P側よりelo0だけ強い(H0)」と「1P側は2P側よりelo1だけ強い(H1)」のどちらであるかを、
+# 1局終わるごとに対数尤度比(LLR)を計算して判定する。決着がついた時点で対局を打ち切れるので、
+# 対局数を固定する場合に比べて、必要な対局数が大幅に減る。
+# LLRは、引き分けを含めた勝ち点の平均と分散を用いた近似(GSPRT)で計算する。
+# cf. http://hardy.uhasselt.be/Fishtest/support_MLE_multinomial.pdf
+class Sprt:
+    def __init__(
+        self,
+        elo0: float = 0,
+        elo1: float = 5,
+        alpha: float = 0.05,
+        beta: float = 0.05,
+    ):
 
         # --- public members ---
 
-        # 定跡(= 開始局面の集合 , このなかからランダムに1つ選ばれる)
-        self.start_sfens = ["startpos"]  # List[str]
-
-        # 定跡の開始手数。この手数の局面から開始する。
-        # 0を指定すると末尾の局面から。
-        self.start_gameply = 1
+        # 帰無仮説(H0)、対立仮説(H1)のレーティング差
+        self.elo0 = elo0
+        self.elo1 = elo1
 
-        # 1ゲームごとに手番を入れ替える。
-        self.flip_turn_every_game = True
+        # 第1種の過誤(H0が正しいのにH1を採択する)、第2種の過誤(H1が正しいのにH0を採択する)の確率
+        self.alpha = alpha
+        self.beta = beta
 
-        # これをinit_server()呼び出し前にTrueにしておくと、エンジンの通信内容が標準出力に出力される。
-        self.debug_print = False
+        # 1P側の勝ち、引き分け、1P側の負けの回数
+        self.win = 0
+        self.draw = 0
+        self.lose = 0
 
-        # これをinit_server()呼び出し前にTrueにしておくと、エンジンから"Error xxx"と送られてきたときにその内容が標準出力に出力される。
-        self.error_print = False
+        # 先後入れ替えたペアごとの勝ち点の分布。(EloRating.pentanomialと同じ)
+        # これを設定しておくと、win,draw,loseの代わりにこちらからLLRを計算する。
+        self.pentanomial: Optional[List[int]] = None
 
         # --- public readonly members ---
 
-        # 対局サーバー群
-        self.servers = []  # List[AyaneruServer]
+        # 対数尤度比
+        self.llr = 0.0
 
-        # 対局棋譜
-        self.game_kifus = []  # List[GameKifu]
+        # llrがこの範囲を出たら判定が確定する。
+        self.lower_bound = 0.0
+        self.upper_bound = 0.0
 
-        # 終了した試合数。
-        self.total_games = 0
+        # 判定結果
+        # "H1" : H1を採択(1P側はelo1だけ強い) , "H0" : H0を採択(1P側はelo0だけ強い) , None : まだ判定できない
+        self.result: Optional[str] = None
 
-        # player1が勝利したゲーム数
-        self.player1_win = 0
-        # player2が勝利したゲーム数
-        self.player2_win = 0
+        # ユーザーに見やすい形での文字列
+        self.pretty_string = ""
 
-        # 先手の勝利したゲーム数
-        self.black_win = 0
-        # 後手の勝利したゲーム数
-        self.white_win = 0
+    # このクラスのpublic membersのところを設定して、このcalc()を呼び出すと、
+    # LLRと判定結果が計算されて、public readonly membersのところに反映される。
+    def calc(self):
+        self.lower_bound = math.log(self.beta / (1 - self.alpha))
+        self.upper_bound = math.log((1 - self.beta) / self.alpha)
+        if self.pentanomial is not None:
+            score, var = EloRating.pentanomial_score_var(self.pentanomial)
+            self.llr = Sprt.calc_llr_normal(
+                sum(self.pentanomial), score, var, self.elo0, self.elo1
+            )
+        else:
+            self.llr = Sprt.calc_llr(
+                self.win, self.draw, self.lose, self.elo0, self.elo1
+            )
 
-        # 引き分けたゲーム数
-        self.draw_games = 0
+        if self.llr >= self.upper_bound:
+            self.result = "H1"
+        elif self.llr <= self.lower_bound:
+            self.result = "H0"
+        else:
+            self.result = None
+
+        self.pretty_string = "SPRT elo0 = {0} , elo1 = {1} : LLR {2:.2f} [{3:.2f},{4:.2f}]{5}".format(
+            self.elo0,
+            self.elo1,
+            self.llr,
+            self.lower_bound,
+            self.upper_bound,
+            "" if self.result is None else " " + self.result + " accepted",
+        )
 
-        # --- private members ---
+    # 勝ち、引き分け、負けの回数から、elo0に対するelo1の対数尤度比を返す。
+    @staticmethod
+    def calc_llr(win: int, draw: int, lose: int, elo0: float, elo1: float) -> float:
+        n = win + draw + lose
+        if n == 0:
+            return 0.0
+
+        # 勝ち点(勝ち=1 , 引き分け=0.5 , 負け=0)の平均と分散
+        score = (win + draw * 0.5) / n
+        var = (
+            win * (1 - score) ** 2 + draw * (0.5 - score) ** 2 + lose * score ** 2
+        ) / n
+        return Sprt.calc_llr_normal(n, score, var, elo0, elo1)
+
+    # 平均score,分散varの勝ち点がn個得られたときの、elo0に対するelo1の対数尤度比を返す。(正規分布近似)
+    @staticmethod
+    def calc_llr_normal(n: int, score: float, var: float, elo0: float, elo1: float) -> float:
+        if var == 0:
+            return 0.0
+        score0 = Sprt.elo_to_score(elo0)
+        score1 = Sprt.elo_to_score(elo1)
+        return n * (score1 - score0) * (2 * score - score0 - score1) / (2 * var)
+
+    # レーティング差から、期待される勝ち点(勝率)を返す。EloRating.calc_rating()の逆関数。
+    @staticmethod
+    def elo_to_score(elo: float) -> float:
+        return 1 / (1 + 10 ** (-elo / 400))
+
+
+# 複数のエンジンの全対局結果から、Bradley-Terryモデル(Eloレーティングの勝率の式)の最尤推定で、
+# 全エンジンのレーティングとその95%信頼区間を求めるクラス。
+# ペアリングごとにレーティング差を移動させていくのと違い、対局した順番に依存せず、
+# 直接対局していない組み合わせの結果も他のエンジンを経由して反映されるので、同じ対局数でもより正確になる。
+# 対局結果はエンジンの組み合わせごとに集計して持つので、対局数が増えても計算量は増えない。
+# add_result()で対局結果を追加して、calc()を呼び出すと前回の結果から反復を再開するので、数回の反復で収束する。
+#
+# 使い方)
+#   bt = BradleyTerryRating()
+#   bt.fix("D", 1900)                 # レーティングを固定するエンジン(基準ソフト)
+#   bt.add_result("A", "B", 60, 3, 37) # Aから見た勝ち - 引き分け - 負け
+#   bt.calc()
+#   bt.ratings["A"] , bt.lowerbounds["A"] , bt.upperbounds["A"]
+class BradleyTerryRating:
+    def __init__(self):
 
-        # game_start()のあとこれをTrueにするとすべての対局が停止する。
+        # --- public members ---
+
+        # 対局したエンジンの組み合わせごとに加える仮想的な引き分けの数。
+        # 全勝・全敗の組み合わせがあると最尤推定値が無限大に発散するので、それを防ぐ。
+        self.prior_draws = 1.0
+
+        # レーティングを固定するエンジンがないとき、レーティングの平均をこの値にする。
+        self.base_rating = 1500.0
+
+        # 1局も対局していないエンジンのレーティングの分散とみなす値。(information()で用いる)
+        self.prior_variance = 350.0 ** 2
+
+        # --- public readonly members ---
+
+        # エンジン名 → レーティング
+        self.ratings: Dict[str, float] = {}
+
+        # エンジン名 → レーティングの95%信頼区間の下限,上限
+        # (固定したエンジンは幅0。1局も対局していないエンジンは含まれない)
+        self.lowerbounds: Dict[str, float] = {}
+        self.upperbounds: Dict[str, float] = {}
+
+        # calc()で収束までに要した反復回数
+        self.iterations = 0
+
+        # --- private members ---
+
+        # エンジン名 → 固定するレーティング
+        self.fixed: Dict[str, float] = {}
+
+        # (エンジン名1 , エンジン名2) → [エンジン1の勝ち , 引き分け , エンジン1の負け]。エンジン名1 < エンジン名2
+        self.results: Dict[Tuple[str, str], List[int]] = {}
+
+    # エンジンnameのレーティングをratingに固定する。
+    def fix(self, name: str, rating: float):
+        self.fixed[name] = float(rating)
+        self.ratings[name] = float(rating)
+
+    # calc()の反復の初期値を設定する。(前回の実行結果のレーティングなど)
+    def set_initial_rating(self, name: str, rating: float):
+        if name not in self.fixed:
+            self.ratings[name] = float(rating)
+
+    # 追加した対局結果をすべて消去する。(レーティングは次のcalc()の反復の初期値として残る)
+    def clear_results(self):
+        self.results = {}
+
+    # 対局結果を追加する。win , draw , lose はplayer1から見た数。
+    def add_result(self, player1: str, player2: str, win: int, draw: int, lose: int):
+        if player1 > player2:
+            player1, player2 = player2, player1
+            win, lose = lose, win
+        result = self.results.setdefault((player1, player2), [0, 0, 0])
+        result[0] += win
+        result[1] += draw
+        result[2] += lose
+
+    # 全対局結果からレーティングと信頼区間を計算して、public readonly membersに反映させる。
+    # Newton法で対数尤度を最大化し、信頼区間は最尤推定値でのFisher情報行列の逆行列から求める。
+    def calc(self, max_iterations: int = 100, epsilon: float = 1e-6):
+        # 1局以上対局したエンジンのうち、固定していないものを推定する。
+        names = sorted({name for pair in self.results for name in pair})
+        free = [name for name in names if name not in self.fixed]
+        index = {name: i for i, name in enumerate(free)}
+        n = len(free)
+        anchored = any(name in self.fixed for name in names)
+
+        # Eloレーティングの差dに対する勝率は 1 / (1 + 10^(-d/400))
+        k = math.log(10) / 400
+
+        for name in free:
+            self.ratings.setdefault(name, self.base_rating)
+
+        hessian: List[List[float]] = []
+        self.iterations = 0
+        for self.iterations in range(1, max_iterations + 1):
+            # 対数尤度の勾配と、符号を反転したヘッセ行列(Fisher情報行列)
+            gradient = [0.0] * n
+            hessian = [[0.0] * n for _ in range(n)]
+            for (player1, player2), (win, draw, lose) in self.results.items():
+                games = win + draw + lose + self.prior_draws
+                score = win + (draw + self.prior_draws) / 2
+                p = 1 / (1 + 10 ** ((self.ratings[player2] - self.ratings[player1]) / 400))
+                g = k * (score - games * p)
+                h = k * k * games * p * (1 - p)
+                i1 = index.get(player1)
+                i2 = index.get(player2)
+                if i1 is not None:
+                    gradient[i1] += g
+                    hessian[i1][i1] += h
+                if i2 is not None:
+                    gradient[i2] -= g
+                    hessian[i2][i2] += h
+                if i1 is not None and i2 is not None:
+                    hessian[i1][i2] -= h
+                    hessian[i2][i1] -= h
+
+            step = BradleyTerryRating.solve(
+                BradleyTerryRating.regularize(hessian, anchored), gradient
+            )
+            for name, i in index.items():
+                self.ratings[name] += step[i]
+
+            # 固定したエンジンがなければ、平均をbase_ratingにする。(レーティング差だけが意味を持つので)
+            if not anchored and n != 0:
+                shift = self.base_rating - sum(self.ratings[name] for name in free) / n
+                for name in free:
+                    self.ratings[name] += shift
+
+            if max((abs(x) for x in step), default=0.0) < epsilon:
+                break
+
+        # 信頼区間
+        inverse = BradleyTerryRating.inverse(
+            BradleyTerryRating.regularize(hessian, anchored)
+        )
+        if not anchored and n != 0:
+            # 平均を固定したときの分散にするため、正則化で足した分を引く。
+            c = BradleyTerryRating.regularization(hessian)
+            inverse = [[x - 1 / (c * n * n) for x in row] for row in inverse]
+
+        self.lowerbounds = {}
+        self.upperbounds = {}
+        for name in names:
+            rating = self.ratings[name]
+            if name in index:
+                i = index[name]
+                stderr = math.sqrt(max(inverse[i][i], 0.0))
+            else:
+                stderr = 0.0
+            self.lowerbounds[name] = rating - 1.959964 * stderr
+            self.upperbounds[name] = rating + 1.959964 * stderr
+
+    # エンジンnameのレーティングの分散。(calc()で求めた信頼区間から)
+    def variance(self, name: str) -> float:
+        if name in self.fixed:
+            return 0.0
+        if name not in self.lowerbounds:
+            return self.prior_variance
+        stderr = (self.upperbounds[name] - self.lowerbounds[name]) / (2 * 1.959964)
+        return stderr * stderr
+
+    # player1とplayer2を1局対局させたときに得られる情報量の目安。
+    # 1局の結果がレーティング差について持つFisher情報量はp(1-p)に比例するので(pは期待勝率)、
+    # それに2つのエンジンのレーティングの分散の和を掛けたもの。
+    # レーティングが近く(pが0.5に近く)、レーティングが不確かなエンジン同士ほど大きい。
+    def information(self, player1: str, player2: str) -> float:
+        rating1 = self.ratings.get(player1, self.base_rating)
+        rating2 = self.ratings.get(player2, self.base_rating)
+        p = 1 / (1 + 10 ** ((rating2 - rating1) / 400))
+        return p * (1 - p) * (self.variance(player1) + self.variance(player2))
+
+    # candidates(エンジン名の組のlist)のうち、information()が最大のものを返す。
+    def most_informative(self, candidates: List[Tuple[str, str]]) -> Tuple[str, str]:
+        return max(candidates, key=lambda pair: self.information(pair[0], pair[1]))
+
+    # エンジンごとのレーティングと信頼区間を、レーティングの高い順に文字列化して返す。
+    def to_string(self) -> str:
+        names = sorted(self.lowerbounds, key=lambda name: -self.ratings[name])
+        return "\n".join(
+            "{0} : R{1}[{2},{3}]{4}".format(
+                name,
+                round(self.ratings[name], 2),
+                round(self.lowerbounds[name], 2),
+                round(self.upperbounds[name], 2),
+                " (fixed)" if name in self.fixed else "",
+            )
+            for name in names
+        )
+
+    # 対局結果をファイルに保存する。
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                [[p1, p2] + result for (p1, p2), result in sorted(self.results.items())],
+                f,
+            )
+
+    # save()で保存した対局結果を読み込んで追加する。ファイルがなければ何もしない。
+    def load(self, path: str):
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for player1, player2, win, draw, lose in json.load(f):
+                self.add_result(player1, player2, win, draw, lose)
+
+    # 固定したエンジンがないときは、ヘッセ行列がレーティングの平行移動の方向に退化しているので、
+    # c * 1 1^T を足して正則にする。(勾配はその方向の成分を持たないので、解は変わらない)
+    # 固定したエンジンとつながっていないエンジンがあるときのために、どちらの場合も対角にごく小さい値を足しておく。
+    @staticmethod
+    def regularize(hessian: List[List[float]], anchored: bool) -> List[List[float]]:
+        n = len(hessian)
+        c = BradleyTerryRating.regularization(hessian)
+        return [
+            [
+                hessian[i][j]
+                + (0.0 if anchored else c)
+                + (c * 1e-9 if i == j else 0.0)
+                for j in range(n)
+            ]
+            for i in range(n)
+        ]
+
+    # regularize()で足す値。(ヘッセ行列の対角の平均程度の大きさ)
+    @staticmethod
+    def regularization(hessian: List[List[float]]) -> float:
+        n = len(hessian)
+        if n == 0:
+            return 1.0
+        return max(sum(hessian[i][i] for i in range(n)) / n, 1e-12)
+
+    # 連立一次方程式 a x = b を解く。(部分pivot選択付きのGaussの消去法)
+    @staticmethod
+    def solve(a: List[List[float]], b: List[float]) -> List[float]:
+        n = len(b)
+        m = [row[:] + [b[i]] for i, row in enumerate(a)]
+        for col in range(n):
+            pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+            m[col], m[pivot] = m[pivot], m[col]
+            if m[col][col] == 0:
+                continue
+            for r in range(col + 1, n):
+                f = m[r][col] / m[col][col]
+                if f != 0:
+                    for c in range(col, n + 1):
+                        m[r][c] -= f * m[col][c]
+        x = [0.0] * n
+        for i in range(n - 1, -1, -1):
+            if m[i][i] != 0:
+                x[i] = (m[i][n] - sum(m[i][j] * x[j] for j in range(i + 1, n))) / m[i][i]
+        return x
+
+    # 逆行列を返す。
+    @staticmethod
+    def inverse(a: List[List[float]]) -> List[List[float]]:
+        n = len(a)
+        columns = [
+            BradleyTerryRating.solve(a, [1.0 if i == j else 0.0 for i in range(n)])
+            for j in range(n)
+        ]
+        return [[columns[j][i] for j in range(n)] for i in range(n)]
+
+
+# 対局結果をSQLiteのデータベースに書き込むクラス。
+# 1局ごとに、対局者、エンジンオプション、持ち時間、開始局面、結果、手数、対局時間と、その指し手を記録する。
+# 指し手には、指した側のエンジンが最後に出力した評価値、深さ、ノード数などと思考時間も記録する。(GameKifu.evalsなど)
+# 書き込みは専用のスレッドでまとめて(batch_size局か、flush_interval秒ごとに1つのトランザクションで)行うので、
+# 対局を管理するスレッドを待たせない。WALモードで開くので、書き込み中でも別のプロセスから読み出せる。
+# 複数回の実行の結果を同じファイルに追記していけば、game_rating()やpair_results()、あるいは任意のSQLで
+# 実行をまたいで集計できる。
+#
+# 使い方)
+#   store = ResultStore("results.db")
+#   store.start_run("ayaneru-colosseum.py", vars(args))
+#   server.result_store = store
+#   ...
+#   store.close()
+class ResultStore:
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        run_id TEXT PRIMARY KEY,
+        script TEXT,
+        args TEXT,
+        start_time REAL
+    );
+    CREATE TABLE IF NOT EXISTS games (
+        game_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_id TEXT,
+        player1 TEXT,
+        player2 TEXT,
+        options1 TEXT,
+        options2 TEXT,
+        time_setting TEXT,
+        start_sfen TEXT,
+        flip_turn INTEGER,
+        result INTEGER,
+        player1_score REAL,
+        plies INTEGER,
+        pair_id INTEGER,
+        start_time REAL,
+        end_time REAL,
+        sfen TEXT
+    );
+    CREATE INDEX IF NOT EXISTS games_players ON games (player1, player2);
+    CREATE TABLE IF NOT EXISTS moves (
+        game_id INTEGER,
+        ply INTEGER,
+        move TEXT,
+        eval INTEGER,
+        depth INTEGER,
+        nodes INTEGER,
+        nps INTEGER,
+        hashfull INTEGER,
+        time INTEGER,
+        think_time INTEGER,
+        PRIMARY KEY (game_id, ply)
+    ) WITHOUT ROWID;
+    """
+
+    # SCHEMAのバージョン。データベースのPRAGMA user_versionに記録しておき、古いものは開いたときに更新する。
+    SCHEMA_VERSION = 1
+
+    # バージョンnから、n+1に更新するSQL
+    MIGRATIONS = {
+        # movesに1手ごとの評価値などを追加した。(GameKifu.evalsなど)
+        0: [
+            "ALTER TABLE moves ADD COLUMN {0} INTEGER".format(column)
+            for column in ["eval", "depth", "nodes", "nps", "hashfull", "time", "think_time"]
+        ],
+    }
+
+    def __init__(self, path: str):
+
+        # --- public members ---
+
+        # 1つのトランザクションで書き込む最大の局数
+        self.batch_size = 256
+
+        # 書き込みを待たせる最大の時間[s]
+        self.flush_interval = 1.0
+
+        # --- public readonly members ---
+
+        # データベースファイルのpath
+        self.path = path
+
+        # start_run()で開始した実行のid
+        self.run_id: Optional[str] = None
+
+        # --- private members ---
+
+        # 書き込むもの。("run" , 行) か ("game" , (行 , 指し手とその評価値などのtupleのlist))。Noneで書き込みスレッドが終了する。
+        self.queue: Queue = Queue()
+
+        # 書き込みスレッドで発生した例外。flush()かclose()で投げ直す。
+        self.error: Optional[Exception] = None
+
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        ResultStore.migrate(connection)
+        connection.close()
+
+        # close()を呼び忘れてもプロセスが終了できるようにdaemonにしておく。
+        # (その場合、書き込まれていない結果は失われるので、終了する前にclose()を呼び出すこと)
+        self.write_thread = threading.Thread(target=self.write_worker, daemon=True)
+        self.write_thread.start()
+
+    # テーブルを作成する。古いバージョンのテーブルがあれば、SCHEMA_VERSIONまで更新する。
+    @staticmethod
+    def migrate(connection: sqlite3.Connection):
+        exists = (
+            connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'games'"
+            ).fetchone()
+            is not None
+        )
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        with connection:
+            if exists:
+                for v in range(version, ResultStore.SCHEMA_VERSION):
+                    for sql in ResultStore.MIGRATIONS[v]:
+                        connection.execute(sql)
+        connection.executescript(ResultStore.SCHEMA)
+        connection.execute("PRAGMA user_version = {0}".format(ResultStore.SCHEMA_VERSION))
+
+    # 実行の開始を記録する。以降のadd_game()はこの実行のものとして記録される。
+    # args : コマンドライン引数など
+    def start_run(self, script: str, args: dict) -> str:
+        self.run_id = "{0}-{1}".format(
+            datetime.now().strftime("%Y%m%d%H%M%S"), os.getpid()
+        )
+        self.queue.put(
+            ("run", (self.run_id, script, json.dumps(args, default=str), time.time()))
+        )
+        return self.run_id
+
+    # 1局の結果を記録する。(書き込みは非同期に行われる)
+    # players : [1P側の対局者名 , 2P側の対局者名]
+    # options : [1P側のエンジンオプション , 2P側のエンジンオプション]
+    def add_game(
+        self, kifu: GameKifu, players: List[str], options: List[dict], time_setting: str
+    ):
+        result = cast(GameResult, kifu.game_result)
+        if result.is_black_or_white_win():
+            score = 1.0 if result.is_player1_win(kifu.flip_turn) else 0.0
+        else:
+            score = 0.5
+
+        # 開始局面以降の指し手と、その評価値など
+        moves = cast(str, kifu.sfen).split()
+        start = cast(str, kifu.start_sfen).split()
+        if "moves" in moves:
+            moves = moves[max(moves.index("moves") + 1, len(start)) :]
+        else:
+            moves = []
+        move_rows = [
+            (move,) + tuple(kifu.ply_values(ply).values()) for ply, move in enumerate(moves)
+        ]
+
+        row = (
+            self.run_id,
+            players[0],
+            players[1],
+            json.dumps(options[0], sort_keys=True),
+            json.dumps(options[1], sort_keys=True),
+            time_setting,
+            kifu.start_sfen,
+            int(kifu.flip_turn),
+            int(result),
+            score,
+            len(moves),
+            kifu.pair_id,
+            kifu.start_time,
+            kifu.end_time,
+            kifu.sfen,
+        )
+        self.queue.put(("game", (row, move_rows)))
+
+    # それまでにadd_game()したものがすべて書き込まれるのを待つ。
+    # 書き込みに失敗したものがあれば、そのときの例外(sqlite3.Errorなど)を投げる。
+    def flush(self):
+        self.queue.join()
+        self.raise_error()
+
+    # すべて書き込んで、書き込みスレッドを終了させる。
+    # 書き込みに失敗したものがあれば、そのときの例外(sqlite3.Errorなど)を投げる。
+    def close(self):
+        if self.write_thread is not None:
+            self.queue.put(None)
+            self.write_thread.join()
+            self.write_thread = None
+        self.raise_error()
+
+    # player1とplayer2の対局結果(player1から見たもの)をEloRatingにして返す。
+    # run_idを指定すると、その実行のものだけを集計する。
+    def game_rating(
+        self, player1: str, player2: str, run_id: Optional[str] = None
+    ) -> EloRating:
+        elo = EloRating()
+        sql = "SELECT player1 , flip_turn , result FROM games WHERE ((player1 = ? AND player2 = ?) OR (player1 = ? AND player2 = ?))"
+        params = [player1, player2, player2, player1]
+        if run_id is not None:
+            sql += " AND run_id = ?"
+            params.append(run_id)
+        for row_player1, flip_turn, result in self.query(sql, params):
+            result = GameResult(result)
+            if result.is_black_or_white_win():
+                # player1が2P側で対局していたなら、勝ち負けを入れ替える。
+                if result.is_player1_win(bool(flip_turn)) == (row_player1 == player1):
+                    elo.player1_win += 1
+                else:
+                    elo.player2_win += 1
+                if result == GameResult.BLACK_WIN:
+                    elo.black_win += 1
+                else:
+                    elo.white_win += 1
+            else:
+                elo.draw_games += 1
+        elo.calc()
+        return elo
+
+    # 対局者の組み合わせごとの(対局者1 , 対局者2 , 対局者1の勝ち , 引き分け , 対局者1の負け)のlistを返す。
+    # BradleyTerryRating.add_result()にそのまま渡せる。
+    def pair_results(self, run_id: Optional[str] = None) -> List[Tuple[str, str, int, int, int]]:
+        sql = "SELECT player1 , player2 , SUM(player1_score = 1) , SUM(player1_score = 0.5) , SUM(player1_score = 0) FROM games"
+        params = []
+        if run_id is not None:
+            sql += " WHERE run_id = ?"
+            params.append(run_id)
+        sql += " GROUP BY player1 , player2"
+        return [tuple(row) for row in self.query(sql, params)]
+
+    # 読み出し用のSQLを実行して、結果の行のlistを返す。
+    def query(self, sql: str, params=()) -> list:
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+    # 書き込みスレッドで発生した例外があれば投げる。(一度投げたものは消える)
+    def raise_error(self):
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    # 書き込みスレッド
+    def write_worker(self):
+        connection = None
+        closing = False
+        while not closing:
+            # 最初の1つが来たら、flush_interval秒以内に来たものをまとめて書き込む。
+            batch = [self.queue.get()]
+            deadline = time.time() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except Empty:
+                    break
+            # Noneは必ず末尾にある。
+            closing = batch[-1] is None
+
+            try:
+                if connection is None:
+                    connection = sqlite3.connect(self.path)
+                    connection.execute("PRAGMA synchronous=NORMAL")
+                self.write_batch(connection, batch)
+            except Exception as e:
+                # このbatchはrollbackされる。スレッドは止めずに、最初の例外をflush()かclose()で投げ直す。
+                if self.error is None:
+                    self.error = e
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+        if connection is not None:
+            connection.close()
+
+    # batchを1つのトランザクションで書き込む。
+    def write_batch(self, connection: sqlite3.Connection, batch: list):
+        with connection:
+            for item in batch:
+                if item is None:
+                    continue
+                kind, data = item
+                if kind == "run":
+                    connection.execute(
+                        "INSERT OR REPLACE INTO runs VALUES (?,?,?,?)", data
+                    )
+                else:
+                    row, move_rows = data
+                    cursor = connection.execute(
+                        "INSERT INTO games VALUES (NULL,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                        row,
+                    )
+                    game_id = cursor.lastrowid
+                    connection.executemany(
+                        "INSERT INTO moves VALUES (?,?,?,?,?,?,?,?,?,?)",
+                        [(game_id, ply) + r for ply, r in enumerate(move_rows)],
+                    )
+
+    def __del__(self):
+        self.close()
+
+
+# 長時間の対局の途中経過をファイルに保存して、プロセスが落ちても続きから再開できるようにするための補助クラス。
+# MultiAyaneruServer.checkpoint() , TournamentScheduler.checkpoint()の返し値などをJSONで保存する。
+# 書き込みは一時ファイルに書いてから置き換えるので、書き込み中に落ちても前回のものが残る。
+# 終局した対局の棋譜のように増え続けるものは、毎回書き直さなくて済むように別のファイルに1行ずつ追記していき(append_line())、
+# checkpointにはそのファイルのどこまでが有効かだけを記録する。(sync_offset() , read_lines())
+class Checkpoint:
+
+    # stateをpathに保存する。
+    @staticmethod
+    def save(path: str, state: dict):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    # save()で保存したものを読み込む。ファイルがなければNone。
+    @staticmethod
+    def load(path: str) -> Optional[dict]:
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    # objを1行のJSONにしてpathのファイルに追記する。
+    @staticmethod
+    def append_line(path: str, obj: dict):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(obj) + "\n")
+
+    # append_line()で追記したファイルをディスクに書き込んで、その大きさを返す。(checkpointに記録する)
+    @staticmethod
+    def sync_offset(path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        with open(path, "ab") as f:
+            os.fsync(f.fileno())
+            return f.tell()
+
+    # append_line()で追記したファイルを、sync_offset()の返したoffsetまでに切り詰めて、各行を読み込んで返す。
+    # offsetより後ろは、checkpointを保存したあとに追記されたもの(再開後に指し直す対局)なので捨てる。
+    @staticmethod
+    def read_lines(path: str, offset: int) -> List[dict]:
+        if not os.path.exists(path):
+            return []
+        if os.path.getsize(path) > offset:
+            os.truncate(path, offset)
+        with open(path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    # 乱数の状態をJSONに書き出せる形で返す。
+    @staticmethod
+    def random_state() -> list:
+        version, state, gauss = random.getstate()
+        return [version, list(state), gauss]
+
+    # random_state()で書き出したものから乱数の状態を復元する。
+    @staticmethod
+    def set_random_state(state: list):
+        random.setstate((state[0], tuple(state[1]), state[2]))
+
+
+# MultiAyaneruServerで、同時に対局させる対局サーバーの数を、対局の結果から調整するクラス。
+# MultiAyaneruServer.concurrency_controllerに設定して使う。
+# 1局終わるごとに、その対局での思考時間の超過、システムのload average、エンジンの報告するnpsを見て、
+# 次の対局を開始する対局サーバーの数(self.active_servers)を増減させる。
+#  ・時間切れ、もしくはmax_time_excess[ms]以上の時間超過があれば、すぐに1つ減らし、以降はその数以上には増やさない。
+#  ・window_games局、問題なく終わったら、load averageが論理CPU数未満であり、
+#    かつ、1エンジンあたりのnpsが最初の並列数のときのnps_ratio倍以上を保っているなら1つ増やす。
+#    npsがそれを下回っているなら1つ減らし、以降はその数以上には増やさない。
+class ConcurrencyController:
+    def __init__(self, min_servers: int = 1, max_servers: int = 0):
+
+        # --- public members ---
+
+        # 対局サーバー数の下限
+        self.min_servers = min_servers
+
+        # 対局サーバー数の上限。0ならMultiAyaneruServer.init_server()で用意した数。
+        self.max_servers = max_servers
+
+        # 開始時の対局サーバー数。0ならmax_servers。
+        self.initial_servers = 0
+
+        # 何局ごとに増やすかどうかを判断するのか
+        self.window_games = 10
+
+        # 思考時間が持ち時間 + 秒読みをこれ[ms]以上超過したら減らす。
+        self.max_time_excess = 200
+
+        # 1エンジンあたりのnpsがこの割合より下がったら、CPUを奪い合っているとみなして減らす。
+        self.nps_ratio = 0.9
+
+        # load averageの上限。0なら論理CPU数。
+        self.max_load = 0.0
+
+        # --- public readonly members ---
+
+        # 現在、対局を開始する対局サーバーの数
+        self.active_servers = 0
+
+        # これ以上は増やさない対局サーバー数。(時間超過などが起きた数 - 1)
+        self.ceiling = 0
+
+        # 対局サーバー数を変更したときの理由を記録したもの。
+        self.history: List[str] = []
+
+        # --- private members ---
+
+        # 現在の対局サーバー数になってから終わった対局数と、その間に報告されたnpsの合計、その数
+        self.window_count = 0
+        self.window_nps_total = 0
+        self.window_nps_count = 0
+
+        # 開始時の対局サーバー数での1エンジンあたりのnps
+        self.base_nps = 0.0
+
+    # 対局を開始するときに呼び出される。開始時の対局サーバー数を返す。
+    # num : 用意されている対局サーバーの数
+    def start(self, num: int) -> int:
+        max_servers = num if self.max_servers == 0 else min(self.max_servers, num)
+        self.ceiling = max_servers if self.ceiling == 0 else min(self.ceiling, max_servers)
+        initial = self.initial_servers if self.initial_servers != 0 else max_servers
+        self.active_servers = min(max(initial, self.min_servers), self.ceiling)
+        self.reset_window()
+        self.base_nps = 0.0
+        return self.active_servers
+
+    # 1局終わるごとに呼び出される。次に対局を開始する対局サーバーの数を返す。
+    def on_game_end(self, server: AyaneruServer) -> int:
+        if server.timeup or server.max_time_excess >= self.max_time_excess:
+            self.change(
+                self.active_servers - 1,
+                "time excess {0}ms".format(server.max_time_excess),
+                True,
+            )
+            return self.active_servers
+
+        self.window_count += 1
+        self.window_nps_total += server.nps_total
+        self.window_nps_count += server.nps_count
+        if self.window_count < self.window_games:
+            return self.active_servers
+
+        nps = self.window_nps_total / max(self.window_nps_count, 1)
+        if self.base_nps == 0:
+            self.base_nps = nps
+
+        if self.base_nps != 0 and nps < self.base_nps * self.nps_ratio:
+            self.change(
+                self.active_servers - 1,
+                "nps {0:.0f} < base nps {1:.0f}".format(nps, self.base_nps),
+                True,
+            )
+            return self.active_servers
+
+        max_load = self.max_load if self.max_load != 0 else float(os.cpu_count() or 1)
+        load = os.getloadavg()[0] if hasattr(os, "getloadavg") else 0.0
+        if load < max_load and self.active_servers < self.ceiling:
+            self.change(
+                self.active_servers + 1,
+                "load {0:.2f} , nps {1:.0f}".format(load, nps),
+                False,
+            )
+        else:
+            self.reset_window()
+
+        return self.active_servers
+
+    # 対局サーバー数をnumに変更する。
+    # set_ceiling : Trueなら以降、numより多くは増やさない。
+    def change(self, num: int, reason: str, set_ceiling: bool):
+        num = max(num, self.min_servers)
+        if set_ceiling:
+            self.ceiling = max(min(self.ceiling, num), self.min_servers)
+        if num != self.active_servers:
+            self.history.append(
+                "active servers {0} -> {1} : {2}".format(self.active_servers, num, reason)
+            )
+            self.active_servers = num
+        self.reset_window()
+
+    # 判断用の集計をリセットする。
+    def reset_window(self):
+        self.window_count = 0
+        self.window_nps_total = 0
+        self.window_nps_count = 0
+
+
+# 並列自己対局のためのクラス
+class MultiAyaneruServer:
+    def __init__(self):
+
+        # --- public members ---
+
+        # 定跡(= 開始局面の集合 , このなかからランダムに1つ選ばれる)
+        self.start_sfens = ["startpos"]  # List[str]
+
+        # 定跡の開始手数。この手数の局面から開始する。
+        # 0を指定すると末尾の局面から。
+        self.start_gameply = 1
+
+        # 1ゲームごとに手番を入れ替える。
+        self.flip_turn_every_game = True
+
+        # これを設定しておくと、すべての対局サーバーで共有して、定跡にある局面ではエンジンに思考させずにここから指し手を選ぶ。
+        self.book: Optional[SharedBook] = None
+
+        # これをgame_start()呼び出し前にTrueにしておくと、start_sfensから重複なしに(すべて使い切るまで)選んだ開始局面を
+        # 先後入れ替えて2局ずつ対局させる。その2局の結果をペアとして、pentanomialでレーティング差を計算する。
+        # このときflip_turn_every_gameは無視される。
+        self.paired_openings = False
+
+        # これをinit_server()呼び出し前にTrueにしておくと、エンジンの通信内容が標準出力に出力される。
+        self.debug_print = False
+
+        # これをinit_server()呼び出し前にTrueにしておくと、エンジンから"Error xxx"と送られてきたときにその内容が標準出力に出力される。
+        self.error_print = False
+
+        # これをinit_server()呼び出し前に設定しておくと、各対局サーバーの対局区間とエンジンの思考区間などが記録される。
+        # 対局終了後にself.tracer.write()でファイルに書き出せる。
+        self.tracer: Optional[ChromeTracer] = None
+
+        # これをinit_server()呼び出し前に設定しておくと、各エンジンのread_worker , write_worker , handle_info、
+        # 各対局サーバーとこのクラスのgame_workerの時間と、メモリの増加量を集計する。
+        # game_stop()のあと、self.profiler.write()でファイルに書き出せる。
+        self.profiler: Optional[Profiler] = None
+
+        # これをinit_server()呼び出し前にTrueにしておくと、CPUのトポロジーを調べて、各対局サーバーに重複しないCPUの集合
+        # (なるべく同じNUMAノード内のもの)を割り当て、1対局の両エンジンを同じCPUの集合で実行する。(Linuxのみ)
+        self.cpu_affinity = False
+
+        # これをinit_server()呼び出し前に設定しておくと、cpu_affinity == Trueのとき、CPUのトポロジーを調べる代わりに
+        # このCPUの集合を各対局サーバーに割り当てる。(複数のプロセスで、重複しないCPUの集合を分担するときに用いる)
+        # [(CPU番号のlist , NUMAノード番号) , ...] の形。(CpuTopology.allocate()の返し値と同じ)
+        self.cpu_sets: Optional[List[Tuple[List[int], Optional[int]]]] = None
+
+        # これをgame_start()呼び出し前に設定しておくと、対局が終わるごとに、同時に対局させる対局サーバーの数を
+        # init_server()で用意した数の範囲で調整する。
+        self.concurrency_controller: Optional[ConcurrencyController] = None
+
+        # init_server()にenginesを渡したときに、エンジンが空きメモリに収まらないとわかったときの対処。
+        #  "cap"        : 収まる数まで対局サーバーの数を減らす。
+        #  "scale_hash" : 対局サーバーの数はそのままに、Hashを減らす。(Hashを1MBにしても足りなければ対局サーバーの数も減らす)
+        #  "refuse"     : 例外を出す。
+        self.memory_policy = "cap"
+
+        # メモリの見積もりのとき、エンジン以外のために空けておくメモリ[MB]
+        self.memory_reserve = 1024
+
+        # メモリの見積もりのとき、1エンジンあたりに余分に見込んでおくメモリ[MB]
+        # (計測時以降に確保されるスタックや探索用のメモリなど)
+        self.memory_overhead = 64
+
+        # これをgame_start()呼び出し前に設定しておくと、1局終わるごとにSPRTを行い、判定が確定したら
+        # 新しい対局を開始しなくなる。(判定が確定したあとに終わった対局は集計しない)
+        # 判定が確定したかはself.sprt_finished()で、判定結果はself.sprt.resultで取得できる。
+        self.sprt: Optional[Sprt] = None
+
+        # これをgame_start()呼び出し前に設定しておくと、checkpoint_interval局終わるごとに、
+        # self.checkpoint()にcheckpoint_extraを加えたものをこのファイルに保存する。(Checkpoint.save())
+        # 次回、それを読み込んでgame_start()の前にself.restore()に渡せば、続きから対局できる。
+        self.checkpoint_path: Optional[str] = None
+        self.checkpoint_interval = 10
+        self.checkpoint_extra: dict = {}
+
+        # これをgame_start()呼び出し前に設定しておくと、1局集計するごとに、その棋譜(GameKifu.to_dict())をこのファイルに1行のJSONで追記する。
+        # checkpointには棋譜は含めず、このファイルのどこまで書いたかだけを記録するので、restore()したときは
+        # 同じファイルを設定しておくこと。restore()しないでgame_start()したときは、このファイルは空にされる。
+        self.kifu_path: Optional[str] = None
+
+        # これをgame_start()呼び出し前に設定しておくと、1局終わるごとにその対局の情報を書き込む。
+        # 対局者名はself.player_namesが用いられる。
+        self.result_store: Optional[ResultStore] = None
+
+        # result_storeに書き込む1P側、2P側の対局者名。init_engine()でエンジンのpathが設定されるので、必要ならそのあと変更する。
+        self.player_names = ["", ""]
+
+        # これをinit_engine()呼び出し前にTrueにしておくと、各エンジンの消費したCPU時間とRSSを集計する。
+        # 集計結果は、self.resource_usage() , self.resource_info()で取得できる。(Linuxのみ)
+        self.resource_accounting = False
+
+        # これをinit_engine()呼び出し前に設定しておくと、各エンジンとのやりとりをこのフォルダに
+        # "server{対局サーバーの番号}-engine{0 or 1}.txt"として記録する。(UsiEngine.transcript_path)
+        self.transcript_dir: Optional[str] = None
+
+        # --- public readonly members ---
+
+        # 対局サーバー群
+        self.servers = []  # List[AyaneruServer]
+
+        # init_server()にenginesを渡したときの、メモリ使用量の見積もりとその結果
+        self.memory_plan = ""
+
+        # init_engine()で設定された1P側、2P側のエンジンオプションと、set_time_setting()で設定された持ち時間設定
+        self.engine_options: List[dict] = [{}, {}]
+        self.time_setting = ""
+
+        # 対局棋譜
+        self.game_kifus = []  # List[GameKifu]
+
+        # 終了した試合数。
+        self.total_games = 0
+
+        # player1が勝利したゲーム数
+        self.player1_win = 0
+        # player2が勝利したゲーム数
+        self.player2_win = 0
+
+        # 先手の勝利したゲーム数
+        self.black_win = 0
+        # 後手の勝利したゲーム数
+        self.white_win = 0
+
+        # 引き分けたゲーム数
+        self.draw_games = 0
+
+        # paired_openings == Trueのとき、先後入れ替えたペアの1P側の勝ち点の合計(0,0.5,1,1.5,2)ごとの回数
+        self.pentanomial = [0] * 5
+
+        # --- private members ---
+
+        # paired_openings == Trueのときの、開始局面のstart_sfens上のindexをシャッフルしたものと、次に使うその位置。
+        self.opening_order = array("q")
+        self.opening_position = 0
+
+        # paired_openings == Trueのときの、まだ開始していないペアの2局目。(ペアの番号 , 開始局面のindex , flip_turn)のlist
+        self.pending_pair_games: List[Tuple[int, int, bool]] = []
+
+        # 次に割り当てるペアの番号
+        self.next_pair_id = 0
+
+        # 1局目だけ終わったペアの、1局目の1P側の勝ち点。ペアの番号 → 勝ち点
+        self.pair_scores: Dict[int, float] = {}
+
+        # 開始局面の順番をシャッフルする直前の乱数の状態。(checkpointから同じ順番を復元するのに用いる)
+        self.opening_shuffle_state: Optional[list] = None
+
+        # restore()で渡された、game_start()で復元する状態
+        self.restore_state: Optional[dict] = None
+
+        # 前回checkpointを保存してから終わった対局数
+        self.games_since_checkpoint = 0
+
+        # game_start()のあとこれをTrueにするとすべての対局が停止する。
         self.game_stop_flag = False
 
+        # 終局した対局サーバー(各対局サーバーのgame_over_callbackで、対局スレッドから追加される)
+        self.finished_servers: Queue = Queue()
+
         # 対局監視用のスレッド
         self.game_thread: threading.Thread = None
 
     # 対局サーバーを初期化する
     # num = 用意する対局サーバーの数(この数だけ並列対局する)
-    def init_server(self, num: int):
+    # engines = [(1P側のengine_path , engine_options) , (2P側のengine_path , engine_options)]
+    #   これを渡すと、エンジンを起動する前に、2×num個のエンジンが空きメモリに収まるかを調べて、
+    #   収まらないならself.memory_policyに従って対局サーバーの数を減らすかHashを減らす。
+    #   そのあと、init_engine()で1P側、2P側のエンジンの初期化まで行う。
+    #   結果の対局サーバーの数はlen(self.servers)、見積もりの内容はself.memory_planで確認できる。
+    def init_server(self, num: int, engines: Optional[List[Tuple[str, dict]]] = None):
+        if engines is not None:
+            num, engines = self.plan_memory(num, engines)
+
+        cpu_sets = None
+        if self.cpu_affinity:
+            cpu_sets = self.cpu_sets if self.cpu_sets is not None else CpuTopology().allocate(num)
+
         servers = []
-        for _ in range(num):
+        for i in range(num):
             server = AyaneruServer()
             server.debug_print = self.debug_print
             server.error_print = self.error_print
+            server.tracer = self.tracer
+            server.profiler = self.profiler
+            server.server_id = i
+            if cpu_sets is not None:
+                server.cpu_affinity, server.numa_node = cpu_sets[i]
+            if self.tracer is not None:
+                self.tracer.set_process_name(i, "server {0}".format(i))
             servers.append(server)
         self.servers = servers
 
+        if engines is not None:
+            for player, (engine_path, engine_options) in enumerate(engines):
+                self.init_engine(player, engine_path, engine_options)
+
+    # num個の対局サーバーで、enginesの2つのエンジンを起動したときのメモリ使用量を見積もり、
+    # 空きメモリに収まるように、self.memory_policyに従って対局サーバーの数かHashを調整して返す。
+    # 1エンジンあたりのメモリ使用量 = Hash + (Hashを1MBにして起動したエンジンのRSS : 評価関数など) + self.memory_overhead
+    # 返し値 : (対局サーバーの数 , Hashを調整したengines)
+    def plan_memory(
+        self, num: int, engines: List[Tuple[str, dict]]
+    ) -> Tuple[int, List[Tuple[str, dict]]]:
+        mb = 1024 * 1024
+        available = MultiAyaneruServer.available_memory()
+        if available is None:
+            self.memory_plan = "memory plan : /proc/meminfo not found. skipped."
+            return num, engines
+
+        # Hash以外の部分のメモリ使用量を、Hashを1MBにしたエンジンを1つずつ起動して計測する。
+        hashes = []
+        base_sizes = []
+        for engine_path, engine_options in engines:
+            # socketで接続するエンジンは、このマシンのメモリを使わない。
+            if UsiSocketTransport.find_address(engine_path) is not None:
+                hashes.append(0)
+                base_sizes.append(0)
+                continue
+            hashes.append(int(engine_options.get("Hash", 0)) * mb)
+            base_sizes.append(
+                MultiAyaneruServer.measure_engine_memory(engine_path, engine_options)
+                + self.memory_overhead * mb
+            )
+
+        budget = available - self.memory_reserve * mb
+        game_size = sum(hashes) + sum(base_sizes)
+        if game_size == 0:
+            self.memory_plan = "memory plan : all engines are remote. skipped."
+            return num, engines
+        fit = int(budget // game_size) if budget > 0 else 0
+
+        plan = "memory plan : available {0}MB , reserve {1}MB , {2}MB per game (hash {3}MB + engine {4}MB) x {5} servers".format(
+            available // mb,
+            self.memory_reserve,
+            game_size // mb,
+            sum(hashes) // mb,
+            sum(base_sizes) // mb,
+            num,
+        )
+
+        if num > fit:
+            if self.memory_policy == "refuse":
+                raise ValueError(
+                    plan + " : out of memory , only {0} servers fit.".format(fit)
+                )
+
+            # 対局サーバーの数はそのままに、Hashを同じ比率で縮める。最低でも1MBにはする。
+            if self.memory_policy == "scale_hash" and sum(hashes) != 0:
+                scale = (budget / num - sum(base_sizes)) / sum(hashes)
+                if scale > 0:
+                    scaled = []
+                    for (engine_path, engine_options), hash_size in zip(engines, hashes):
+                        engine_options = dict(engine_options)
+                        if hash_size != 0:
+                            engine_options["Hash"] = str(max(int(hash_size * scale / mb), 1))
+                        scaled.append((engine_path, engine_options))
+                    engines = scaled
+                    plan += " -> Hash {0}".format(
+                        " , ".join(options.get("Hash", "-") for _, options in engines)
+                    )
+                    # 1MBまで縮めても収まらないなら、対局サーバーの数も減らす。
+                    game_size = sum(base_sizes) + sum(
+                        int(options.get("Hash", 0)) * mb for _, options in engines
+                    )
+                    fit = int(budget // game_size) if budget > 0 else 0
+
+            if num > fit:
+                if fit < 1:
+                    raise ValueError(plan + " : out of memory.")
+                num = fit
+                plan += " -> {0} servers".format(num)
+
+        self.memory_plan = plan
+        return num, engines
+
+    # 空きメモリ(/proc/meminfoのMemAvailable)を[byte]で返す。取得できなければNone。
+    @staticmethod
+    def available_memory() -> Optional[int]:
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        # "MemAvailable:   12345678 kB"の形
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    # Hashを1MBにしてエンジンを起動し、"readyok"が返ってきた時点のRSS[byte]を返す。(評価関数などの分)
+    # RSSが取得できない環境では0を返す。
+    @staticmethod
+    def measure_engine_memory(engine_path: str, engine_options: dict) -> int:
+        engine = UsiEngine()
+        options = dict(engine_options)
+        if "Hash" in options:
+            options["Hash"] = "1"
+        engine.set_engine_options(options)
+        engine.connect(engine_path)
+        try:
+            engine.wait_for_state(UsiEngineState.WaitCommand)
+            pid = engine.pid()
+            usage = ProcessUsage.read(pid) if pid is not None else None
+        finally:
+            engine.disconnect()
+        return usage.rss if usage is not None else 0
+
     # init_serverのあと、1P側、2P側のエンジンを初期化する。
     # player : 0なら1P側、1なら2P側
     def init_engine(self, player: int, engine_path: str, engine_options: dict):
-        for server in self.servers:
+        self.player_names[player] = engine_path
+        self.engine_options[player] = engine_options
+        if self.transcript_dir is not None:
+            os.makedirs(self.transcript_dir, exist_ok=True)
+        for i, server in enumerate(self.servers):
             engine = server.engines[player]
             engine.set_engine_options(engine_options)
+            engine.resource_accounting = self.resource_accounting
+            engine.profiler = self.profiler
+            if self.transcript_dir is not None:
+                engine.transcript_path = os.path.join(
+                    self.transcript_dir, "server{0}-engine{1}.txt".format(i, player)
+                )
+            engine.cpu_affinity = server.cpu_affinity
+            engine.numa_node = server.numa_node
             engine.connect(engine_path)
 
     # すべてのあやねるサーバーに持ち時間設定を行う。
     # AyaneruServer.set_time_setting()と設定の仕方は同じ。
     def set_time_setting(self, time_setting: str):
+        self.time_setting = time_setting
         for server in self.servers:
             server.set_time_setting(time_setting)
 
@@ -1493,14 +5204,17 @@ class MultiAyaneruServer:
         if len(self.servers) == 0:
             raise ValueError("No Servers. Must call init_server()")
 
-        self.total_games = 0
-        self.player1_win = 0
-        self.player2_win = 0
-        self.black_win = 0
-        self.white_win = 0
-        self.draw_games = 0
+        self.init_results()
 
-        self.game_stop_flag = False
+        # 最初に対局を開始する対局サーバーの数
+        active = len(self.servers)
+        if self.concurrency_controller is not None:
+            active = self.concurrency_controller.start(active)
+
+        # 終局したらすぐに次の対局を開始できるように、終局の通知を受け取る。
+        self.finished_servers = Queue()
+        for server in self.servers:
+            server.game_over_callback = self.finished_servers.put
 
         flip = False
         # それぞれの対局、1個ごとに先後逆でスタートしておく。
@@ -1509,12 +5223,63 @@ class MultiAyaneruServer:
             if self.flip_turn_every_game:
                 flip ^= True
             # 対局を開始する
-            self.start_server(server)
+            if server.server_id < active:
+                self.start_server(server)
 
         # 対局用のスレッドを作成するのがお手軽か..
-        self.game_thread = threading.Thread(target=self.game_worker)
+        self.start_profiler()
+        game_worker = self.game_worker
+        if self.profiler is not None:
+            game_worker = self.profiler.wrap("MultiAyaneruServer.game_worker", game_worker)
+        self.game_thread = threading.Thread(target=game_worker)
         self.game_thread.start()
 
+    # profilerが設定されていれば、メモリの計測を開始する。
+    # 保持し続けるもの(棋譜、traceのイベント)の数を一緒に記録して、増え続けているものがわかるようにしておく。
+    def start_profiler(self):
+        if self.profiler is None:
+            return
+        self.profiler.gauges["game_kifus"] = lambda: len(self.game_kifus)
+        if self.tracer is not None:
+            tracer = self.tracer
+            self.profiler.gauges["tracer.events"] = lambda: len(tracer.events)
+        self.profiler.start()
+
+    # 対局の開始前に、集計結果と開始局面の順番を初期化する。restore()されていればその状態を復元する。
+    def init_results(self):
+        self.total_games = 0
+        self.player1_win = 0
+        self.player2_win = 0
+        self.black_win = 0
+        self.white_win = 0
+        self.draw_games = 0
+        self.pentanomial = [0] * 5
+
+        self.opening_order = array("q")
+        self.opening_position = 0
+        self.pending_pair_games = []
+        self.next_pair_id = 0
+        self.pair_scores = {}
+
+        self.game_stop_flag = False
+
+        self.opening_shuffle_state = None
+        self.games_since_checkpoint = 0
+        if self.restore_state is not None:
+            self.apply_restore_state(self.restore_state)
+            self.restore_state = None
+        elif self.kifu_path is not None:
+            # 最初から対局するので、前回の棋譜は消しておく。
+            open(self.kifu_path, "w").close()
+
+        if self.sprt is not None:
+            self.sprt.win = self.player1_win
+            self.sprt.draw = self.draw_games
+            self.sprt.lose = self.player2_win
+            if self.paired_openings:
+                self.sprt.pentanomial = list(self.pentanomial)
+            self.sprt.calc()
+
     # game_start()で開始したすべての対局を停止させる。
     def game_stop(self):
         if self.game_thread is None:
@@ -1522,12 +5287,21 @@ class MultiAyaneruServer:
         self.game_stop_flag = True
         self.game_thread.join()
         self.game_thread = None
+        if self.profiler is not None:
+            self.profiler.stop()
 
     # 対局結果("70-3-50"みたいな1P勝利数 - 引き分け - 2P勝利数　と、その勝率から計算されるレーティング差を文字列化して返す)
+    # SPRTを行っているなら、そのLLRも付与する。
     def game_info(self) -> str:
         elo = self.game_rating()
+        if self.sprt is not None:
+            return elo.pretty_string + " " + self.sprt.pretty_string
         return elo.pretty_string
 
+    # SPRTの判定が確定したか。(SPRTを行っていないならFalse)
+    def sprt_finished(self) -> bool:
+        return self.sprt is not None and self.sprt.result is not None
+
     # Eloレーティングを計算して返す。(EloRating型を)
     def game_rating(self) -> EloRating:
         elo = EloRating()
@@ -1536,18 +5310,44 @@ class MultiAyaneruServer:
         elo.black_win = self.black_win
         elo.white_win = self.white_win
         elo.draw_games = self.draw_games
+        if self.paired_openings:
+            elo.pentanomial = list(self.pentanomial)
         elo.calc()
         return elo
 
+    # player側(0なら1P側、1なら2P側)の全エンジンのCPU時間とRSSを合算したものを返す。
+    # max_rssは1エンジンあたりの最大値、last_rssは全エンジンの合計になる。
+    # resource_accounting == Trueにしてinit_engine()を呼び出していなければ、集計されていない。
+    def resource_usage(self, player: int) -> UsiEngineUsage:
+        usage = UsiEngineUsage()
+        for server in self.servers:
+            usage.add(server.engines[player].usage)
+        return usage
+
+    # 1P側、2P側のエンジンそれぞれのCPU時間とRSSの集計結果を文字列化して返す。
+    def resource_info(self) -> str:
+        return "\n".join(
+            "{0}p : {1} , total rss {2:.1f}MB".format(
+                player + 1,
+                usage.to_string(),
+                usage.last_rss / (1024 * 1024),
+            )
+            for player, usage in enumerate(
+                [self.resource_usage(0), self.resource_usage(1)]
+            )
+        )
+
     # ゲーム対局用のスレッド
     def game_worker(self):
 
         while not self.game_stop_flag:
-            for server in self.servers:
-                # 対局が終了しているサーバーがあるなら次のゲームを開始する。
-                if server.game_result.is_gameover():
-                    self.restart_server(server)
-            time.sleep(1)
+            # 対局が終了したサーバーがあるなら次のゲームを開始する。
+            # (game_stop()されたことに気づけるように、1秒ごとに待つのをやめる)
+            try:
+                server = self.finished_servers.get(timeout=1)
+            except Empty:
+                continue
+            self.restart_server(server)
 
         # serverの解体もしておく。
         for server in self.servers:
@@ -1556,11 +5356,15 @@ class MultiAyaneruServer:
 
     # 結果を集計、棋譜の保存
     def count_result(self, server: AyaneruServer):
-        result = server.game_result
+        self.count_game(server.game_kifu())
+
+    # 終局した対局の棋譜から結果を集計して、棋譜を保存する。
+    def count_game(self, kifu: GameKifu):
+        result = kifu.game_result
 
         # 終局内容に応じて戦績を加算
         if result.is_black_or_white_win():
-            if result.is_player1_win(server.flip_turn):
+            if result.is_player1_win(kifu.flip_turn):
                 self.player1_win += 1
             else:
                 self.player2_win += 1
@@ -1572,21 +5376,160 @@ class MultiAyaneruServer:
             self.draw_games += 1
         self.total_games += 1
 
+        # 先後入れ替えたペアの2局が終わったなら、pentanomialに加算
+        if kifu.pair_id is not None:
+            if result.is_black_or_white_win():
+                score = 1.0 if result.is_player1_win(kifu.flip_turn) else 0.0
+            else:
+                score = 0.5
+            if kifu.pair_id in self.pair_scores:
+                score += self.pair_scores.pop(kifu.pair_id)
+                self.pentanomial[int(score * 2)] += 1
+            else:
+                self.pair_scores[kifu.pair_id] = score
+
+        if self.sprt is not None:
+            self.sprt.win = self.player1_win
+            self.sprt.draw = self.draw_games
+            self.sprt.lose = self.player2_win
+            if self.paired_openings:
+                self.sprt.pentanomial = list(self.pentanomial)
+            self.sprt.calc()
+
         # 棋譜を保存しておく。
-        kifu = GameKifu()
-        kifu.sfen = server.sfen
-        kifu.flip_turn = server.flip_turn
-        kifu.game_result = server.game_result
         self.game_kifus.append(kifu)
+        if self.kifu_path is not None:
+            Checkpoint.append_line(self.kifu_path, kifu.to_dict())
+
+        if self.result_store is not None:
+            self.result_store.add_game(
+                kifu, self.player_names, self.engine_options, self.time_setting
+            )
+
+    # 対局の途中経過(集計結果、開始局面の順番、乱数の状態)をJSONに書き出せる形で返す。
+    # 棋譜は含めず、kifu_pathのファイルのどこまでが集計済みの棋譜かだけを含める。
+    # 対局中の対局と、終局したがまだ集計していない対局は含まれない。(再開後に指し直す)
+    def checkpoint(self) -> dict:
+        # 対局中か集計前だったペアの対局は、再開後に同じ開始局面・手番で指し直す。
+        pending = self.playing_pair_games()
+        return {
+            "total_games": self.total_games,
+            "player1_win": self.player1_win,
+            "player2_win": self.player2_win,
+            "black_win": self.black_win,
+            "white_win": self.white_win,
+            "draw_games": self.draw_games,
+            "pentanomial": self.pentanomial,
+            "kifu_offset": Checkpoint.sync_offset(self.kifu_path)
+            if self.kifu_path is not None
+            else None,
+            "opening_shuffle_state": self.opening_shuffle_state,
+            "opening_position": self.opening_position,
+            "pending_pair_games": pending + self.pending_pair_games,
+            "next_pair_id": self.next_pair_id,
+            "pair_scores": [[pair_id, score] for pair_id, score in self.pair_scores.items()],
+            "random": Checkpoint.random_state(),
+        }
+
+    # 対局中か、終局したがまだ集計していないペアの対局の(ペアの番号 , 開始局面のindex , flip_turn)のlist
+    # 集計したサーバーは、次の対局を開始するか休止(INIT)させてからcheckpointを保存するので、
+    # INIT以外のサーバーの対局はすべて集計されていない。(restart_server()を参照)
+    def playing_pair_games(self) -> List[Tuple[int, int, bool]]:
+        return [
+            (server.pair_id, server.opening_index, server.flip_turn)
+            for server in self.servers
+            if server.game_result != GameResult.INIT and server.pair_id is not None
+        ]
+
+    # checkpoint()で書き出したものを、次のgame_start()で復元させる。
+    def restore(self, state: dict):
+        self.restore_state = state
+
+    # game_start()のなかで、restore()で渡された状態を復元する。
+    def apply_restore_state(self, state: dict):
+        self.total_games = state["total_games"]
+        self.player1_win = state["player1_win"]
+        self.player2_win = state["player2_win"]
+        self.black_win = state["black_win"]
+        self.white_win = state["white_win"]
+        self.draw_games = state["draw_games"]
+        self.pentanomial = list(state["pentanomial"])
+        if state.get("kifu_offset") is not None and self.kifu_path is not None:
+            self.game_kifus = [
+                GameKifu.from_dict(d)
+                for d in Checkpoint.read_lines(self.kifu_path, state["kifu_offset"])
+            ]
+        else:
+            # 棋譜をcheckpointに含めていたころのものなら、それを読み込んでkifu_pathのファイルに書き直しておく。
+            if state.get("game_kifus") is not None:
+                self.game_kifus = [GameKifu.from_dict(d) for d in state["game_kifus"]]
+            if self.kifu_path is not None:
+                open(self.kifu_path, "w").close()
+                for kifu in self.game_kifus:
+                    Checkpoint.append_line(self.kifu_path, kifu.to_dict())
+
+        # シャッフルした直前の乱数の状態から、同じ順番をシャッフルし直す。
+        self.opening_shuffle_state = state["opening_shuffle_state"]
+        if self.opening_shuffle_state is not None:
+            Checkpoint.set_random_state(self.opening_shuffle_state)
+            self.opening_order = array("q", range(len(self.start_sfens)))
+            random.shuffle(self.opening_order)
+        self.opening_position = state["opening_position"]
+        self.pending_pair_games = [
+            (pair_id, index, flip_turn)
+            for pair_id, index, flip_turn in state["pending_pair_games"]
+        ]
+        self.next_pair_id = state["next_pair_id"]
+        self.pair_scores = {pair_id: score for pair_id, score in state["pair_scores"]}
+        Checkpoint.set_random_state(state["random"])
 
     # 対局サーバーを開始する。
     def start_server(self, server: AyaneruServer):
+        server.book = self.book
+        pair_id, index, flip_turn = self.next_game(server.flip_turn)
+        server.pair_id = pair_id
+        server.opening_index = index
+        server.flip_turn = flip_turn
+        server.game_start(self.start_sfens[index], self.start_gameply)
+
+    # 次に開始する対局の(ペアの番号 , 開始局面のindex , flip_turn)を返す。
+    # flip_turn : paired_openings == Falseのときの、その対局のflip_turn
+    def next_game(self, flip_turn: bool) -> Tuple[Optional[int], int, bool]:
+        if self.paired_openings:
+            # 先後入れ替えたペアの2局目があればそれを、なければ新しい開始局面で1局目を開始する。
+            return self.next_paired_game()
         # sfenをstart_sfensのなかから一つランダムに取得
-        sfen = self.start_sfens[random.randint(0, len(self.start_sfens) - 1)]
-        server.game_start(sfen, self.start_gameply)
+        return None, random.randint(0, len(self.start_sfens) - 1), flip_turn
+
+    # paired_openings == Trueのときに、次に開始する対局の(ペアの番号 , 開始局面のindex , flip_turn)を返す。
+    # 開始局面は、start_sfensをシャッフルした順に重複なしに選び、すべて使い切ったらシャッフルし直す。
+    def next_paired_game(self) -> Tuple[int, int, bool]:
+        if self.pending_pair_games:
+            return self.pending_pair_games.pop(0)
+
+        if self.opening_position >= len(self.opening_order):
+            # 巨大な定跡でもメモリを食わないようにarrayでシャッフルする。
+            self.opening_shuffle_state = Checkpoint.random_state()
+            self.opening_order = array("q", range(len(self.start_sfens)))
+            random.shuffle(self.opening_order)
+            self.opening_position = 0
+
+        index = self.opening_order[self.opening_position]
+        self.opening_position += 1
+        pair_id = self.next_pair_id
+        self.next_pair_id += 1
+
+        # 2局目は先後を入れ替えて、あとで開始する。
+        self.pending_pair_games.append((pair_id, index, True))
+        return pair_id, index, False
 
     # 対局結果を集計して、サーバーを再開(次の対局を開始)させる。
     def restart_server(self, server: AyaneruServer):
+        # SPRTの判定が確定しているなら、集計もせずに休止させる。
+        if self.sprt_finished():
+            server.game_result = GameResult.INIT
+            return
+
         # 対局結果の集計
         self.count_result(server)
 
@@ -1594,9 +5537,56 @@ class MultiAyaneruServer:
         if self.flip_turn_every_game:
             server.flip_turn ^= True
 
+        self.start_next_game(server)
+
+        # 途中経過の保存
+        # 集計した対局の結果が残ったままだと、checkpoint()で集計前の対局と区別できないので、
+        # 次の対局を開始する(か休止させる)まで待ってから保存する。
+        self.game_counted()
+
+    # 対局結果を集計したサーバーで次の対局を開始する。ConcurrencyControllerが対局サーバー数を減らしたなら休止させる。
+    def start_next_game(self, server: AyaneruServer):
+        if self.concurrency_controller is not None:
+            active = self.concurrency_controller.on_game_end(server)
+
+            # 対局サーバー数が増えたなら、休止していた対局サーバーで対局を開始する。
+            for s in self.servers[:active]:
+                if s.game_result == GameResult.INIT:
+                    self.start_server(s)
+
+            # 対局サーバー数が減ったなら、このサーバーは休止させる。(エンジンは接続したまま)
+            if server.server_id >= active:
+                server.game_result = GameResult.INIT
+                return
+
         # 終了していたので再開
         self.start_server(server)
 
+    # 1局集計するごとに呼び出す。checkpoint_interval局ごとに途中経過を保存する。
+    def game_counted(self):
+        self.games_since_checkpoint += 1
+        if (
+            self.checkpoint_path is not None
+            and self.games_since_checkpoint >= self.checkpoint_interval
+        ):
+            self.save_checkpoint()
+
+    # self.checkpoint()にself.checkpoint_extraを加えたものをself.checkpoint_pathに保存する。
+    # 集計の途中で呼び出さないように、対局を管理するスレッドから呼び出すこと。
+    def save_checkpoint(self):
+        self.games_since_checkpoint = 0
+        # checkpointで集計済みとした対局がデータベースに書き込まれていないと、再開したときにその対局が失われるので、先に書き込んでおく。
+        if self.result_store is not None:
+            self.result_store.flush()
+        Checkpoint.save(
+            cast(str, self.checkpoint_path),
+            {**self.checkpoint_extra, "server": self.checkpoint()},
+        )
+
+    # 現在、対局中の対局サーバーの数
+    def active_servers(self) -> int:
+        return sum(1 for server in self.servers if server.game_result == GameResult.PLAYING)
+
     # 内包しているすべてのあやねるサーバーを終了させる。
     def terminate(self):
         if self.game_thread is not None:
@@ -1606,6 +5596,1113 @@ class MultiAyaneruServer:
         self.terminate()
 
 
+# 複数のマシンで対局させるときに、対局の割り当てと結果の集計を行うコーディネーター。
+# 各マシンで動かしたMatchWorkerがTCPで接続してきて、1局ずつ対局を割り当ててもらい、終局したらその棋譜を送ってくる。
+# 開始局面の順番、集計結果、SPRT、checkpoint、result_storeは、MultiAyaneruServerのものをそのまま用いる。
+# init_server()は呼び出さずに、init_engine()でエンジンを設定する。エンジンは各MatchWorkerがそのマシンで起動する。
+# (エンジンの実行ファイルとエンジンオプションの"EvalDir"は、MatchWorker.home相対で解釈される)
+#
+# 通信は1行に1つのJSONで、MatchWorkerからの要求1つに対して応答を1つ返す。
+#   {"command": "hello", "name": 名前}                     → {"worker_id": .. , "config": エンジンと持ち時間などの設定}
+#   {"command": "assign", "worker_id": ..}                 → {"game": {"game_id": .. , "sfen": .. , "flip_turn": ..} or null , "finished": ..}
+#   {"command": "result", "worker_id": .. , "game_id": .. , "kifu": GameKifu.to_dict()} → {"accepted": .. , "finished": ..}
+#   {"command": "heartbeat", "worker_id": ..}              → {"finished": ..}
+# 接続が切れるか、heartbeat_timeout秒以上要求が来なかったMatchWorkerに割り当てていた対局は、ほかのMatchWorkerに割り当て直す。
+class MatchCoordinator(MultiAyaneruServer):
+    def __init__(self):
+        super().__init__()
+
+        # --- public members ---
+
+        # 待ち受けるアドレスとポート番号。(ポート番号を0にすると空いているものが選ばれ、game_start()のあとここに設定される)
+        self.host = "0.0.0.0"
+        self.port = 4091
+
+        # これ以上の秒数、要求(heartbeatを含む)が来なかったMatchWorkerは落ちたとみなして、その対局を割り当て直す。
+        self.heartbeat_timeout = 30.0
+
+        # 対局数の上限。これだけ集計したら、それ以上は対局を割り当てない。0なら無制限。
+        self.max_games = 0
+
+        # MatchWorkerがそのマシンで読み込む共有定跡のpath(MatchWorker.home相対)と手数。(MultiAyaneruServer.bookの代わり)
+        self.shared_book_path: Optional[str] = None
+        self.shared_book_ply = 16
+
+        # これをgame_start()呼び出し前に1以上にしておくと、待ち受けを開始したあと、このマシンでこの数の子プロセスを起動して、
+        # それぞれでMatchWorkerを動かす。local_slots個の対局サーバーをこれらの子プロセスで分担する。
+        # 対局サーバーのスレッドとエンジンとの通信が1つのプロセスのGILを奪い合わないようにするためのもの。
+        # 空きメモリの見積もり(memory_policy)と、CPUの集合の割り当て(cpu_affinity)は、local_slots個の全体に対してこのプロセスで行う。
+        self.local_processes = 0
+        self.local_slots = 1
+
+        # 子プロセスのMatchWorkerのhome。(MatchWorker.homeと同じ)
+        self.local_home = ""
+
+        # --- public readonly members ---
+
+        # init_engine()で設定された1P側、2P側のエンジンのpath
+        self.engine_paths = ["", ""]
+
+        # 接続しているMatchWorker。worker_id → {"name": 名前 , "address": 接続元 , "last_seen": 最後に要求が来た時刻 , "games": 集計した対局数}
+        self.workers: Dict[int, dict] = {}
+
+        # MatchWorkerの接続、切断などを記録したもの。
+        self.history: List[str] = []
+
+        # --- private members ---
+
+        # 割り当て中の対局。game_id → (worker_id , ペアの番号 , 開始局面のindex , flip_turn)
+        self.assignments: Dict[int, Tuple[int, Optional[int], int, bool]] = {}
+
+        # 落ちたMatchWorkerから回収した、次に割り当て直す対局。(ペアの番号 , 開始局面のindex , flip_turn)のlist
+        self.reassigned_games: List[Tuple[Optional[int], int, bool]] = []
+
+        # 次に割り当てるgame_id , worker_id
+        self.next_game_id = 0
+        self.next_worker_id = 0
+
+        # paired_openings == Falseのときに、次に割り当てる対局のflip_turn
+        self.next_flip_turn = False
+
+        # self.workersなどを複数の接続スレッドから触るので、そのlock
+        self.lock = threading.Lock()
+
+        # 待ち受け用のsocketとスレッド、接続ごとのsocketとスレッド
+        # (connectionsは接続中のものだけ。接続が切れたらその接続のスレッドが取り除く。self.lockで保護されている)
+        self.listen_socket: Optional[socket.socket] = None
+        self.accept_thread: Optional[threading.Thread] = None
+        self.connections: List[Tuple[socket.socket, threading.Thread]] = []
+
+        # local_processes個の子プロセス
+        self.local_workers: list = []  # List[multiprocessing.Process]
+
+    # 1P側、2P側のエンジンを設定する。(エンジンは起動しない)
+    # player : 0なら1P側、1なら2P側
+    # engine_path , engine_optionsの"EvalDir" : MatchWorker.home相対
+    def init_engine(self, player: int, engine_path: str, engine_options: dict):
+        super().init_engine(player, engine_path, engine_options)
+        self.engine_paths[player] = engine_path
+
+    # MatchWorkerの接続の待ち受けを開始する。
+    def game_start(self):
+        self.init_results()
+        self.workers = {}
+        self.assignments = {}
+        self.reassigned_games = []
+        self.next_flip_turn = False
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen()
+        # game_stop()されたかを確認するために、1秒ごとにaccept()から戻ってくるようにしておく。
+        sock.settimeout(1.0)
+        self.port = sock.getsockname()[1]
+        self.listen_socket = sock
+
+        self.start_profiler()
+        self.accept_thread = threading.Thread(target=self.accept_worker)
+        self.accept_thread.start()
+        game_worker = self.game_worker
+        if self.profiler is not None:
+            game_worker = self.profiler.wrap("MatchCoordinator.game_worker", game_worker)
+        self.game_thread = threading.Thread(target=game_worker)
+        self.game_thread.start()
+
+        if self.local_processes > 0:
+            self.start_local_workers()
+
+    # このマシンの子プロセスでMatchWorkerを起動して、local_slots個の対局サーバーを分担させる。
+    def start_local_workers(self):
+        engines = MatchWorker.resolve_engines(self.local_home, self.worker_config()["engines"])
+
+        # 子プロセスごとに見積もると、ほかの子プロセスの分のメモリを考慮できないので、全体をここで見積もっておく。
+        # Hashを減らしたなら、それを子プロセスに送る。
+        num, planned = self.plan_memory(self.local_slots, engines)
+        for player, (_, engine_options) in enumerate(planned):
+            if "Hash" in engine_options:
+                self.engine_options[player] = {
+                    **self.engine_options[player],
+                    "Hash": engine_options["Hash"],
+                }
+        cpu_sets = CpuTopology().allocate(num) if self.cpu_affinity else None
+
+        # 子プロセスはforkせずに新しく起動する。(このプロセスのスレッドの状態を引き継がないように)
+        context = multiprocessing.get_context("spawn")
+        processes = min(self.local_processes, num)
+        start = 0
+        for i in range(processes):
+            slots = num // processes + (1 if i < num % processes else 0)
+            process = context.Process(
+                target=MatchWorker.run_process,
+                args=(
+                    "127.0.0.1",
+                    self.port,
+                    self.local_home,
+                    slots,
+                    cpu_sets[start : start + slots] if cpu_sets is not None else None,
+                    "local{0}".format(i),
+                ),
+            )
+            process.start()
+            self.local_workers.append(process)
+            start += slots
+
+    # 現在、割り当て中の対局の数
+    def active_servers(self) -> int:
+        return len(self.assignments)
+
+    # 割り当て中のペアの対局と、割り当て直す予定のペアの対局の(ペアの番号 , 開始局面のindex , flip_turn)のlist
+    def playing_pair_games(self) -> List[Tuple[int, int, bool]]:
+        games = [
+            (pair_id, index, flip_turn)
+            for _, pair_id, index, flip_turn in self.assignments.values()
+        ] + self.reassigned_games
+        return [
+            (pair_id, index, flip_turn)
+            for pair_id, index, flip_turn in games
+            if pair_id is not None
+        ]
+
+    # これ以上対局を割り当てないか。(SPRTの判定が確定したか、max_games局集計したか、game_stop()されたか)
+    def games_finished(self) -> bool:
+        return (
+            self.game_stop_flag
+            or self.sprt_finished()
+            or (self.max_games != 0 and self.total_games >= self.max_games)
+        )
+
+    # 応答の送受信。1行に1つのJSON。
+    @staticmethod
+    def send_message(f, message: dict):
+        f.write((json.dumps(message) + "\n").encode("utf-8"))
+        f.flush()
+
+    # 接続が切れていたらNoneを返す。
+    @staticmethod
+    def recv_message(f) -> Optional[dict]:
+        line = f.readline()
+        if not line:
+            return None
+        return json.loads(line.decode("utf-8"))
+
+    # 落ちたMatchWorkerの監視用のスレッド
+    def game_worker(self):
+        while not self.game_stop_flag:
+            now = time.time()
+            with self.lock:
+                for worker_id, worker in list(self.workers.items()):
+                    if now - worker["last_seen"] > self.heartbeat_timeout:
+                        self.remove_worker(worker_id, "timeout")
+            time.sleep(1)
+
+        # 待ち受けと、すべての接続を終了させる。
+        self.accept_thread.join()
+        cast(socket.socket, self.listen_socket).close()
+        self.listen_socket = None
+        # 各接続のスレッドは終了するときにself.connectionsから自分を取り除くので、コピーしてから終了させる。
+        with self.lock:
+            connections = list(self.connections)
+        for conn, thread in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            thread.join()
+
+        # 子プロセスは、接続が切れたらエンジンを終了させて終了する。
+        for process in self.local_workers:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.local_workers = []
+
+    # 接続の待ち受け用のスレッド
+    def accept_worker(self):
+        sock = cast(socket.socket, self.listen_socket)
+        while not self.game_stop_flag:
+            try:
+                conn, address = sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(
+                target=self.connection_worker, args=(conn, "{0}:{1}".format(*address))
+            )
+            with self.lock:
+                self.connections.append((conn, thread))
+            thread.start()
+
+    # 1つの接続の要求を処理するスレッド
+    def connection_worker(self, conn: socket.socket, address: str):
+        f = conn.makefile("rwb")
+        worker_id = None
+        try:
+            while True:
+                request = MatchCoordinator.recv_message(f)
+                if request is None:
+                    break
+                with self.lock:
+                    reply = self.handle_request(request, address)
+                if request.get("command") == "hello":
+                    worker_id = reply["worker_id"]
+                MatchCoordinator.send_message(f, reply)
+        except (OSError, ValueError):
+            # 接続が切れたか、おかしな要求が来た。
+            pass
+        finally:
+            with self.lock:
+                if worker_id is not None:
+                    self.remove_worker(worker_id, "disconnected")
+                # 接続し直すMatchWorkerが多くても溜まっていかないように、切れた接続は取り除いておく。
+                self.connections = [c for c in self.connections if c[0] is not conn]
+            f.close()
+            conn.close()
+
+    # MatchWorkerからの要求requestを処理して、応答を返す。self.lockを確保してから呼び出すこと。
+    # address : 接続元(self.workersとself.historyに記録するだけ)
+    def handle_request(self, request: dict, address: str = "") -> dict:
+        command = request.get("command")
+        if command == "hello":
+            worker_id = self.next_worker_id
+            self.next_worker_id += 1
+            name = request.get("name", "")
+            self.workers[worker_id] = {
+                "name": name,
+                "address": address,
+                "last_seen": time.time(),
+                "games": 0,
+            }
+            self.history.append(
+                "worker {0} ({1} , {2}) connected.".format(worker_id, name, address)
+            )
+            return {"worker_id": worker_id, "config": self.worker_config()}
+
+        # 落ちたとみなして対局を割り当て直したMatchWorkerには、接続し直させる。
+        worker_id = request.get("worker_id")
+        if worker_id not in self.workers:
+            return {"error": "unknown worker"}
+        self.workers[worker_id]["last_seen"] = time.time()
+
+        if command == "assign":
+            return {"game": self.assign_game(worker_id), "finished": self.games_finished()}
+        if command == "result":
+            accepted = self.accept_result(worker_id, request["game_id"], request["kifu"])
+            return {"accepted": accepted, "finished": self.games_finished()}
+        if command == "heartbeat":
+            return {"finished": self.games_finished()}
+        raise ValueError("unknown command : {0}".format(command))
+
+    # MatchWorkerに渡す、エンジンと持ち時間などの設定
+    def worker_config(self) -> dict:
+        return {
+            "engines": [
+                [engine_path, engine_options]
+                for engine_path, engine_options in zip(self.engine_paths, self.engine_options)
+            ],
+            "time_setting": self.time_setting,
+            "start_gameply": self.start_gameply,
+            "shared_book": self.shared_book_path,
+            "shared_book_ply": self.shared_book_ply,
+        }
+
+    # worker_idのMatchWorkerに対局を1つ割り当てる。割り当てる対局がなければNone。
+    def assign_game(self, worker_id: int) -> Optional[dict]:
+        if self.games_finished():
+            return None
+        # 割り当て中の対局がすべて終われば上限に達するなら、それ以上は割り当てない。
+        if self.max_games != 0 and self.total_games + len(self.assignments) >= self.max_games:
+            return None
+
+        if self.reassigned_games:
+            pair_id, index, flip_turn = self.reassigned_games.pop(0)
+        else:
+            pair_id, index, flip_turn = self.next_game(self.next_flip_turn)
+            if self.flip_turn_every_game:
+                self.next_flip_turn ^= True
+
+        game_id = self.next_game_id
+        self.next_game_id += 1
+        self.assignments[game_id] = (worker_id, pair_id, index, flip_turn)
+        return {"game_id": game_id, "sfen": self.start_sfens[index], "flip_turn": flip_turn}
+
+    # worker_idのMatchWorkerから送られてきた、game_idの対局の棋譜を集計する。
+    # 割り当て直した対局の結果であれば集計せずにFalseを返す。
+    def accept_result(self, worker_id: int, game_id: int, kifu_dict: dict) -> bool:
+        assignment = self.assignments.get(game_id)
+        if assignment is None or assignment[0] != worker_id:
+            return False
+        del self.assignments[game_id]
+        _, pair_id, _, flip_turn = assignment
+
+        # SPRTの判定が確定しているなら集計しない。(MultiAyaneruServer.restart_server()と同じ)
+        if self.sprt_finished():
+            return True
+
+        # ペアの番号と手番は、割り当てたときのものを用いる。
+        kifu = GameKifu.from_dict(kifu_dict)
+        kifu.pair_id = pair_id
+        kifu.flip_turn = flip_turn
+        self.count_game(kifu)
+        self.workers[worker_id]["games"] += 1
+        self.game_counted()
+        return True
+
+    # worker_idのMatchWorkerを切り離して、割り当てていた対局を割り当て直す。
+    # reason : self.historyに記録する理由
+    def remove_worker(self, worker_id: int, reason: str):
+        worker = self.workers.pop(worker_id, None)
+        if worker is None:
+            return
+        games = [
+            game_id
+            for game_id, assignment in self.assignments.items()
+            if assignment[0] == worker_id
+        ]
+        for game_id in games:
+            _, pair_id, index, flip_turn = self.assignments.pop(game_id)
+            self.reassigned_games.append((pair_id, index, flip_turn))
+        self.history.append(
+            "worker {0} ({1}) {2} , {3} games reassigned.".format(
+                worker_id, worker["name"], reason, len(games)
+            )
+        )
+
+
+# MatchCoordinatorに接続して、割り当てられた対局をこのマシンで並列に対局させるワーカー。
+#
+# 使い方)
+#   worker = MatchWorker()
+#   worker.home = "/home/yane/shogi"
+#   worker.cores = 64
+#   worker.run("192.168.0.10", 4091)  # コーディネーターが対局の割り当てを終えるまで戻ってこない。
+class MatchWorker:
+    def __init__(self):
+
+        # --- public members ---
+
+        # エンジンの実行ファイル、エンジンオプションの"EvalDir"、共有定跡はこのフォルダ相対で解釈する。
+        self.home = ""
+
+        # コーディネーターに名乗る名前
+        self.name = socket.gethostname()
+
+        # このマシンのCPUのコア数。並列対局数は、2スレッド余らせて、エンジンの"Threads"の大きいほうで割ったものになる。
+        self.cores = 8
+
+        # 並列対局数。0ならself.coresから決める。
+        self.slots = 0
+
+        # この秒数、要求を送っていなければheartbeatを送る。(MatchCoordinator.heartbeat_timeoutより十分短くすること)
+        self.heartbeat_interval = 5.0
+
+        # 接続できないとき、接続が切れたときに接続し直す間隔[s]と回数。(コーディネーターを再起動する間、待つ)
+        self.retry_interval = 5.0
+        self.retry_count = 12
+
+        # 対局サーバーを用意するときに、空きメモリに収まるかを見積もるか。
+        # (MatchCoordinatorの子プロセスでは、コーディネーター側で全体を見積もっているのでFalseになる)
+        self.memory_check = True
+
+        # 対局に用いるマルチあやねるサーバー。cpu_affinity , memory_policyなどはrun()の前に設定しておく。
+        # (init_server() , init_engine() , set_time_setting()を行うのに用いるだけで、game_start()は呼び出さない)
+        self.server = MultiAyaneruServer()
+
+        # --- public readonly members ---
+
+        # このワーカーで終局した対局数
+        self.total_games = 0
+
+        # --- private members ---
+
+        # 終局した対局サーバー(対局スレッドから追加される)
+        self.finished_servers: Queue = Queue()
+
+        # 最後に要求を送った時刻
+        self.last_request_time = 0.0
+
+    # host:portのコーディネーターに接続して、割り当てられた対局をすべて終えるまで対局させる。
+    # 接続が切れたら、対局中の対局は破棄して、retry_interval秒ごとにretry_count回まで接続し直す。
+    def run(self, host: str, port: int):
+        retry = 0
+        while True:
+            try:
+                sock = socket.create_connection((host, port))
+            except OSError:
+                if retry >= self.retry_count:
+                    return
+                retry += 1
+                time.sleep(self.retry_interval)
+                continue
+            retry = 0
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            try:
+                if self.session(sock.makefile("rwb")):
+                    return
+            except (OSError, ValueError):
+                # 接続が切れたので、接続し直す。
+                pass
+            finally:
+                sock.close()
+                self.release_servers()
+
+    # 1回の接続での対局。コーディネーターが対局の割り当てを終えたらTrueを返す。
+    def session(self, f) -> bool:
+        reply = self.request(f, {"command": "hello", "name": self.name})
+        worker_id = reply["worker_id"]
+        config = reply["config"]
+        self.init_servers(config)
+
+        idle = list(self.server.servers)
+        # 対局中の対局サーバーのserver_id → game_id
+        playing: Dict[int, int] = {}
+        finished = False
+
+        while not finished:
+            # 空いている対局サーバーに対局を割り当ててもらう。
+            while idle and not finished:
+                reply = self.request(f, {"command": "assign", "worker_id": worker_id})
+                finished = reply["finished"]
+                game = reply["game"]
+                if game is None:
+                    break
+                server = idle.pop()
+                server.flip_turn = game["flip_turn"]
+                server.game_start(game["sfen"], config["start_gameply"])
+                playing[server.server_id] = game["game_id"]
+            if finished:
+                break
+
+            # 空いている対局サーバーがあるなら、1秒ごとに割り当てを要求し直す。
+            try:
+                server = self.finished_servers.get(
+                    timeout=1.0 if idle else self.heartbeat_interval
+                )
+            except Empty:
+                if time.time() - self.last_request_time >= self.heartbeat_interval:
+                    reply = self.request(f, {"command": "heartbeat", "worker_id": worker_id})
+                    finished = reply["finished"]
+                continue
+
+            reply = self.request(
+                f,
+                {
+                    "command": "result",
+                    "worker_id": worker_id,
+                    "game_id": playing.pop(server.server_id),
+                    "kifu": server.game_kifu().to_dict(),
+                },
+            )
+            finished = reply["finished"]
+            self.total_games += 1
+            idle.append(server)
+
+        return True
+
+    # コーディネーターに要求を送って、応答を返す。
+    def request(self, f, message: dict) -> dict:
+        MatchCoordinator.send_message(f, message)
+        self.last_request_time = time.time()
+        reply = MatchCoordinator.recv_message(f)
+        if reply is None:
+            raise ConnectionError("connection closed.")
+        if "error" in reply:
+            raise ValueError(reply["error"])
+        return reply
+
+    # MatchCoordinator.local_processesの子プロセスで実行される。
+    # cpu_sets : この子プロセスの対局サーバーに割り当てるCPUの集合。Noneならcpu_affinityを用いない。
+    @staticmethod
+    def run_process(
+        host: str,
+        port: int,
+        home: str,
+        slots: int,
+        cpu_sets: Optional[List[Tuple[List[int], Optional[int]]]],
+        name: str,
+    ):
+        worker = MatchWorker()
+        worker.home = home
+        worker.slots = slots
+        worker.name = name
+        # コーディネーターが終了したら、この子プロセスも終了する。
+        worker.retry_count = 0
+        worker.memory_check = False
+        worker.server.cpu_affinity = cpu_sets is not None
+        worker.server.cpu_sets = cpu_sets
+        worker.run(host, port)
+
+    # コーディネーターから送られてきたエンジンのpathと"EvalDir"を、home相対にしたものを返す。
+    @staticmethod
+    def resolve_engines(home: str, engines: list) -> List[Tuple[str, dict]]:
+        resolved = []
+        for engine_path, engine_options in engines:
+            engine_options = dict(engine_options)
+            if "EvalDir" in engine_options:
+                engine_options["EvalDir"] = os.path.join(home, engine_options["EvalDir"])
+            resolved.append((os.path.join(home, engine_path), engine_options))
+        return resolved
+
+    # コーディネーターから送られてきた設定で、対局サーバーを用意してエンジンを起動する。
+    def init_servers(self, config: dict):
+        engines = MatchWorker.resolve_engines(self.home, config["engines"])
+
+        slots = self.slots
+        if slots == 0:
+            # 先後、同時に思考しないので、1対局に要するスレッド数は大きいほう。
+            threads = max(int(options.get("Threads", 1)) for _, options in engines)
+            slots = max(int(max(self.cores - 2, 1) / threads), 1)
+
+        self.finished_servers = Queue()
+        if self.memory_check:
+            self.server.init_server(slots, engines)
+        else:
+            self.server.init_server(slots)
+            for player, (engine_path, engine_options) in enumerate(engines):
+                self.server.init_engine(player, engine_path, engine_options)
+        self.server.set_time_setting(config["time_setting"])
+
+        book = None
+        if config["shared_book"] is not None:
+            book = SharedBook()
+            book.load(os.path.join(self.home, config["shared_book"]), config["shared_book_ply"])
+        for server in self.server.servers:
+            server.book = book
+            server.game_over_callback = self.finished_servers.put
+
+    # 対局中の対局を止めて、エンジンを終了させる。
+    def release_servers(self):
+        for server in self.server.servers:
+            server.terminate()
+        self.server.servers = []
+
+
+# TournamentSchedulerで対局させる2つのエンジンの組み合わせと、その対局結果
+class TournamentPairing:
+    def __init__(self, player1: int, player2: int, games: int, threads: int):
+
+        # --- public readonly members ---
+
+        # TournamentScheduler.add_engine()の返し値のエンジン番号
+        self.player1 = player1
+        self.player2 = player2
+
+        # このペアリングで対局させる数
+        self.games = games
+
+        # 1対局に要するスレッド数(先後、同時に思考しないので2つのエンジンの大きいほう)
+        self.threads = threads
+
+        # 開始した対局の数
+        self.started_games = 0
+
+        # 終了した試合数。
+        self.total_games = 0
+
+        # player1 , player2 が勝利したゲーム数
+        self.player1_win = 0
+        self.player2_win = 0
+
+        # 先手 , 後手の勝利したゲーム数
+        self.black_win = 0
+        self.white_win = 0
+
+        # 引き分けたゲーム数
+        self.draw_games = 0
+
+        # 対局棋譜
+        self.game_kifus: List[GameKifu] = []
+
+        # --- private members ---
+
+        # このペアリング用に起動した対局サーバーと、そのうち対局していないもの
+        self.servers: List[AyaneruServer] = []
+        self.idle_servers: List[AyaneruServer] = []
+
+        # 次に開始する対局のflip_turn
+        self.next_flip_turn = False
+
+    # すべての対局が終わったか
+    def is_finished(self) -> bool:
+        return self.total_games >= self.games
+
+    # 集計結果をJSONに書き出せる形で返す。(対局中の対局は含まれない)
+    # 棋譜は含めない。(TournamentScheduler.kifu_pathのファイルに保存される)
+    def to_dict(self) -> dict:
+        return {
+            "player1": self.player1,
+            "player2": self.player2,
+            "games": self.games,
+            "threads": self.threads,
+            "total_games": self.total_games,
+            "player1_win": self.player1_win,
+            "player2_win": self.player2_win,
+            "black_win": self.black_win,
+            "white_win": self.white_win,
+            "draw_games": self.draw_games,
+            "next_flip_turn": self.next_flip_turn,
+        }
+
+    # to_dict()で書き出したものから復元する。対局中だった対局は、まだ開始していないものとして扱う。
+    @staticmethod
+    def from_dict(d: dict):  # -> TournamentPairing
+        pairing = TournamentPairing(d["player1"], d["player2"], d["games"], d["threads"])
+        pairing.total_games = pairing.started_games = d["total_games"]
+        pairing.player1_win = d["player1_win"]
+        pairing.player2_win = d["player2_win"]
+        pairing.black_win = d["black_win"]
+        pairing.white_win = d["white_win"]
+        pairing.draw_games = d["draw_games"]
+        # 棋譜をcheckpointに含めていたころのもの
+        pairing.game_kifus = [GameKifu.from_dict(kifu) for kifu in d.get("game_kifus", [])]
+        pairing.next_flip_turn = d["next_flip_turn"]
+        return pairing
+
+    # Eloレーティングを計算して返す。
+    def game_rating(self) -> EloRating:
+        elo = EloRating()
+        elo.player1_win = self.player1_win
+        elo.player2_win = self.player2_win
+        elo.black_win = self.black_win
+        elo.white_win = self.white_win
+        elo.draw_games = self.draw_games
+        elo.calc()
+        return elo
+
+    # 終局した対局サーバーの結果を集計して、棋譜を保存する。
+    def count_result(self, server: AyaneruServer):
+        result = server.game_result
+        if result.is_black_or_white_win():
+            if result.is_player1_win(server.flip_turn):
+                self.player1_win += 1
+            else:
+                self.player2_win += 1
+            if result == GameResult.BLACK_WIN:
+                self.black_win += 1
+            else:
+                self.white_win += 1
+        else:
+            self.draw_games += 1
+        self.total_games += 1
+
+        self.game_kifus.append(server.game_kifu())
+
+
+# 複数のエンジンの総当たり(roundrobin)、1つのエンジン対その他(gauntlet)、ランダムな組み合わせ(random)の対局を、
+# 1つのCPUコアの枠(cores)のなかで並列に行うクラス。
+# 対局サーバーはペアリングごとに起動して、そのペアリングの対局が残っている間は再利用する。
+# 対局が終局するたびに、空いたコアの数に収まる(スレッド数が最大のエンジンが収まる)ペアリングの対局を
+# self.pairingsの順に詰めて開始するので、ペアリングごとに全対局の終了を待つことなくコアが埋まり続ける。
+#
+# 使い方)
+#   scheduler = TournamentScheduler()
+#   scheduler.cores = 14
+#   a = scheduler.add_engine("engines/A/YaneuraOu.exe", {"Threads": "1"}, 1)
+#   b = scheduler.add_engine("engines/B/YaneuraOu.exe", {"Threads": "2"}, 2)
+#   ...
+#   scheduler.make_pairings("roundrobin", 2, 100)
+#   scheduler.game_start()
+#   while not scheduler.is_finished(): time.sleep(1)
+#   scheduler.game_stop()
+class TournamentScheduler:
+    def __init__(self):
+
+        # --- public members ---
+
+        # 同時に対局させる対局の、スレッド数の合計の上限
+        self.cores = 1
+
+        # 持ち時間設定(AyaneruServer.set_time_setting()と同じ)
+        self.time_setting = "byoyomi 100"
+
+        # 定跡(= 開始局面の集合 , このなかからランダムに1つ選ばれる)と、その開始手数
+        self.start_sfens = ["startpos"]  # List[str]
+        self.start_gameply = 1
+
+        # 1ゲームごとに手番を入れ替える。
+        self.flip_turn_every_game = True
+
+        # すべての対局サーバーで共有する定跡
+        self.book: Optional[SharedBook] = None
+
+        # 各対局サーバーの対局区間と、エンジンの思考区間などを記録する。
+        self.tracer: Optional[ChromeTracer] = None
+
+        # エンジンの通信内容 , "Error xxx"を標準出力に出力する。
+        self.debug_print = False
+        self.error_print = False
+
+        # これを設定しておくと、1局終わるごとにその対局の情報を書き込む。
+        self.result_store: Optional[ResultStore] = None
+
+        # これをgame_start()呼び出し前に設定しておくと、checkpoint_interval局終わるごとと、ペアリングの全対局が終わるごとに、
+        # self.checkpoint()にcheckpoint_extraを加えたものをこのファイルに保存する。(Checkpoint.save())
+        # 次回、make_pairings()のあとでそれをself.restore()に渡せば、続きから対局できる。
+        self.checkpoint_path: Optional[str] = None
+        self.checkpoint_interval = 10
+        self.checkpoint_extra: dict = {}
+
+        # これをgame_start()呼び出し前に設定しておくと、1局終わるごとに、その棋譜をこのファイルに
+        # {"pairing": self.pairingsのindex , "kifu": GameKifu.to_dict()}の1行のJSONで追記する。
+        # checkpointには棋譜は含めず、このファイルのどこまで書いたかだけを記録するので、restore()する前に
+        # 同じファイルを設定しておくこと。restore()しないでgame_start()したときは、このファイルは空にされる。
+        self.kifu_path: Optional[str] = None
+
+        # make_pairings()で"random"を指定したときに、次のペアリングを選ぶ関数。
+        # 候補((エンジン番号 , エンジン番号)のlist)を引数に、(対局を管理するスレッドから)ペアリングが必要になるたびに呼び出される。
+        # Noneならランダムに選ぶ。それまでの対局結果から、最も情報の得られる組み合わせを選ぶのに用いる。
+        self.pairing_selector: Optional[
+            Callable[[List[Tuple[int, int]]], Tuple[int, int]]
+        ] = None
+
+        # これを設定しておくと、ペアリングの全対局が終わるごとに(対局を管理するスレッドから)そのペアリングを引数に呼び出される。
+        self.pairing_finished_callback: Optional[
+            Callable[[TournamentPairing], None]
+        ] = None
+
+        # --- public readonly members ---
+
+        # add_engine()で追加したエンジン。(engine_path , engine_options , threads , rating_fix)のlist
+        self.engines: List[Tuple[str, dict, int, bool]] = []
+
+        # add_engine()で追加したエンジンの名前(result_storeに書き込む対局者名)
+        self.engine_names: List[str] = []
+
+        # make_pairings()で作られたペアリング
+        self.pairings: List[TournamentPairing] = []
+
+        # "random"のときの、まだ作っていないペアリングの数
+        self.pending_pairings = 0
+
+        # 空いているコアの数
+        self.free_cores = 0
+
+        # 終了した試合数。
+        self.total_games = 0
+
+        # --- private members ---
+
+        # 終局した対局サーバーが積まれる。self.cvで保護されている。
+        self.finished_servers: List[AyaneruServer] = []
+        self.cv = threading.Condition()
+
+        # 対局サーバー → そのペアリング
+        self.server_pairing: Dict[AyaneruServer, TournamentPairing] = {}
+
+        # "random"のときの、ペアリングの候補と、1つのペアリングで対局させる数
+        self.candidates: List[Tuple[int, int]] = []
+        self.games_per_pairing = 0
+
+        # 次に起動する対局サーバーの番号(tracerのpidに用いる)
+        self.next_server_id = 0
+
+        # 前回checkpointを保存してから終わった対局数
+        self.games_since_checkpoint = 0
+
+        # restore()されたか。(されていなければgame_start()でkifu_pathのファイルを空にする)
+        self.restored = False
+
+        # game_start()のあとこれをTrueにするとすべての対局が停止する。
+        self.game_stop_flag = False
+
+        # 対局管理用のスレッド
+        self.game_thread: Optional[threading.Thread] = None
+
+    # エンジンを追加して、そのエンジン番号を返す。
+    # threads    : このエンジンが1対局で用いるスレッド数
+    # rating_fix : Trueのエンジン同士は対局させない。(基準ソフト)
+    # name       : result_storeに書き込む対局者名。省略時はengine_path。
+    def add_engine(
+        self,
+        engine_path: str,
+        engine_options: dict,
+        threads: int,
+        rating_fix: bool = False,
+        name: Optional[str] = None,
+    ) -> int:
+        self.engines.append((engine_path, engine_options, threads, rating_fix))
+        self.engine_names.append(name if name is not None else engine_path)
+        return len(self.engines) - 1
+
+    # ペアリングを作る。
+    # mode :
+    #  "roundrobin" : すべてのエンジンの組み合わせをrounds回
+    #  "gauntlet"   : gauntlet_playerのエンジン対その他のすべてのエンジンをrounds回
+    #  "random"     : ランダムに選んだ2つのエンジンの組み合わせをrounds個
+    #                 (ペアリングは、コアが空いて対局させるペアリングがなくなるたびに1つずつ選ぶ。self.pairing_selectorを参照)
+    # いずれも、rating_fixのエンジン同士は対局させない。
+    # games : 1つのペアリングで対局させる数
+    def make_pairings(
+        self, mode: str, rounds: int, games: int, gauntlet_player: int = 0
+    ):
+        n = len(self.engines)
+        candidates = []
+        for p1 in range(n):
+            for p2 in range(p1 + 1, n):
+                if self.engines[p1][3] and self.engines[p2][3]:
+                    continue
+                if mode == "gauntlet" and gauntlet_player not in (p1, p2):
+                    continue
+                candidates.append((p1, p2))
+        if mode not in ("roundrobin", "gauntlet", "random"):
+            raise ValueError("invalid mode : " + mode)
+        if not candidates:
+            raise ValueError("no pairings.")
+
+        self.candidates = candidates
+        self.games_per_pairing = games
+        self.pairings = []
+        self.pending_pairings = 0
+        if mode == "random":
+            self.pending_pairings = rounds
+        else:
+            for _ in range(rounds):
+                for p1, p2 in candidates:
+                    self.add_pairing(p1, p2)
+
+    # p1とp2のペアリングを追加する。
+    def add_pairing(self, p1: int, p2: int) -> TournamentPairing:
+        # 全コアを使っても足りないエンジンも、全コアで1対局ずつは対局させる。
+        threads = min(max(self.engines[p1][2], self.engines[p2][2]), self.cores)
+        pairing = TournamentPairing(p1, p2, self.games_per_pairing, max(threads, 1))
+        self.pairings.append(pairing)
+        return pairing
+
+    # 途中経過(各ペアリングの集計結果、まだ作っていないペアリングの数、乱数の状態)をJSONに書き出せる形で返す。
+    # 棋譜は含めず、kifu_pathのファイルのどこまでが集計済みの棋譜かだけを含める。
+    # 対局中の対局は含まれない。(再開後に指し直す)
+    def checkpoint(self) -> dict:
+        return {
+            "pairings": [pairing.to_dict() for pairing in self.pairings],
+            "pending_pairings": self.pending_pairings,
+            "kifu_offset": Checkpoint.sync_offset(self.kifu_path)
+            if self.kifu_path is not None
+            else None,
+            "random": Checkpoint.random_state(),
+        }
+
+    # checkpoint()で書き出したものから復元する。make_pairings()のあと、game_start()の前に呼び出すこと。
+    def restore(self, state: dict):
+        self.pairings = [TournamentPairing.from_dict(d) for d in state["pairings"]]
+        self.pending_pairings = state["pending_pairings"]
+        if self.kifu_path is not None:
+            if state.get("kifu_offset") is not None:
+                for line in Checkpoint.read_lines(self.kifu_path, state["kifu_offset"]):
+                    self.pairings[line["pairing"]].game_kifus.append(GameKifu.from_dict(line["kifu"]))
+            else:
+                # 棋譜をcheckpointに含めていたころのものなら、kifu_pathのファイルに書き直しておく。
+                open(self.kifu_path, "w").close()
+                for i, pairing in enumerate(self.pairings):
+                    for kifu in pairing.game_kifus:
+                        self.append_kifu(i, kifu)
+        Checkpoint.set_random_state(state["random"])
+        self.restored = True
+
+    # kifu_pathのファイルに、self.pairings[index]の対局の棋譜を追記する。
+    def append_kifu(self, index: int, kifu: GameKifu):
+        Checkpoint.append_line(
+            cast(str, self.kifu_path), {"pairing": index, "kifu": kifu.to_dict()}
+        )
+
+    # self.checkpoint()にself.checkpoint_extraを加えたものをself.checkpoint_pathに保存する。
+    def save_checkpoint(self):
+        self.games_since_checkpoint = 0
+        # checkpointで集計済みとした対局がデータベースに書き込まれていないと、再開したときにその対局が失われるので、先に書き込んでおく。
+        if self.result_store is not None:
+            self.result_store.flush()
+        Checkpoint.save(
+            cast(str, self.checkpoint_path),
+            {**self.checkpoint_extra, "scheduler": self.checkpoint()},
+        )
+
+    # すべての対局を開始する
+    def game_start(self):
+        if not self.pairings and self.pending_pairings == 0:
+            raise ValueError("No pairings. Must call make_pairings()")
+
+        self.free_cores = self.cores
+        self.total_games = sum(pairing.total_games for pairing in self.pairings)
+        self.games_since_checkpoint = 0
+        if self.kifu_path is not None and not self.restored:
+            # 最初から対局するので、前回の棋譜は消しておく。
+            open(self.kifu_path, "w").close()
+        self.restored = False
+        self.finished_servers = []
+        self.server_pairing = {}
+        self.game_stop_flag = False
+
+        self.game_thread = threading.Thread(target=self.game_worker)
+        self.game_thread.start()
+
+    # game_start()で開始したすべての対局を停止させる。
+    def game_stop(self):
+        if self.game_thread is None:
+            raise ValueError("game thread is not running.")
+        with self.cv:
+            self.game_stop_flag = True
+            self.cv.notify()
+        self.game_thread.join()
+        self.game_thread = None
+
+    # すべてのペアリングの対局が終わったか
+    def is_finished(self) -> bool:
+        return self.pending_pairings == 0 and all(
+            pairing.is_finished() for pairing in self.pairings
+        )
+
+    # 現在、対局中の対局の数
+    def active_games(self) -> int:
+        return sum(
+            pairing.started_games - pairing.total_games for pairing in self.pairings
+        )
+
+    # 対局管理用のスレッド
+    def game_worker(self):
+        with self.cv:
+            while not self.game_stop_flag:
+                while self.finished_servers:
+                    self.on_game_end(self.finished_servers.pop(0))
+                if self.is_finished():
+                    break
+                self.fill_slots()
+                # 終局の通知があるまで待つ。(念のため1秒ごとに起きる)
+                self.cv.wait(1)
+
+        # serverの解体もしておく。
+        for pairing in self.pairings:
+            self.release_servers(pairing)
+
+    # 対局サーバーの終局の通知。(対局スレッドから呼び出される)
+    def notify_game_over(self, server: AyaneruServer):
+        with self.cv:
+            self.finished_servers.append(server)
+            self.cv.notify()
+
+    # 空いているコアに収まるペアリングの対局を、self.pairingsの順に開始する。
+    def fill_slots(self):
+        for pairing in self.pairings:
+            while (
+                pairing.started_games < pairing.games
+                and pairing.threads <= self.free_cores
+            ):
+                self.start_game(pairing)
+
+        # 開始していない対局がなくなったら、次のペアリングを選んで開始する。
+        # (直前までの対局結果を反映して選べるように、必要になるまで選ばない)
+        while self.pending_pairings > 0 and self.free_cores > 0:
+            if any(p.started_games < p.games for p in self.pairings):
+                break
+            if self.pairing_selector is not None:
+                p1, p2 = self.pairing_selector(self.candidates)
+            else:
+                p1, p2 = random.choice(self.candidates)
+            self.pending_pairings -= 1
+            pairing = self.add_pairing(p1, p2)
+            while (
+                pairing.started_games < pairing.games
+                and pairing.threads <= self.free_cores
+            ):
+                self.start_game(pairing)
+
+    # pairingの対局を1つ開始する。対局していない対局サーバーがなければ起動する。
+    def start_game(self, pairing: TournamentPairing):
+        if pairing.idle_servers:
+            server = pairing.idle_servers.pop()
+        else:
+            server = self.create_server(pairing)
+
+        server.flip_turn = pairing.next_flip_turn
+        if self.flip_turn_every_game:
+            pairing.next_flip_turn ^= True
+
+        pairing.started_games += 1
+        self.free_cores -= pairing.threads
+        sfen = self.start_sfens[random.randint(0, len(self.start_sfens) - 1)]
+        server.game_start(sfen, self.start_gameply)
+
+    # pairingの2つのエンジンに接続した対局サーバーを起動する。
+    def create_server(self, pairing: TournamentPairing) -> AyaneruServer:
+        server = AyaneruServer()
+        server.debug_print = self.debug_print
+        server.error_print = self.error_print
+        server.tracer = self.tracer
+        server.server_id = self.next_server_id
+        server.book = self.book
+        server.game_over_callback = self.notify_game_over
+        server.set_time_setting(self.time_setting)
+        self.next_server_id += 1
+        if self.tracer is not None:
+            self.tracer.set_process_name(
+                server.server_id,
+                "server {0} ({1} vs {2})".format(
+                    server.server_id, pairing.player1, pairing.player2
+                ),
+            )
+
+        for player, engine_number in enumerate([pairing.player1, pairing.player2]):
+            engine_path, engine_options, _, _ = self.engines[engine_number]
+            engine = server.engines[player]
+            engine.set_engine_options(engine_options)
+            engine.connect(engine_path)
+
+        pairing.servers.append(server)
+        self.server_pairing[server] = pairing
+        return server
+
+    # 終局した対局サーバーの結果を集計して、コアを空ける。
+    def on_game_end(self, server: AyaneruServer):
+        pairing = self.server_pairing[server]
+        pairing.count_result(server)
+        if self.kifu_path is not None:
+            self.append_kifu(self.pairings.index(pairing), pairing.game_kifus[-1])
+        if self.result_store is not None:
+            self.result_store.add_game(
+                pairing.game_kifus[-1],
+                [self.engine_names[pairing.player1], self.engine_names[pairing.player2]],
+                [self.engines[pairing.player1][1], self.engines[pairing.player2][1]],
+                self.time_setting,
+            )
+        self.total_games += 1
+        self.free_cores += pairing.threads
+
+        if pairing.started_games < pairing.games:
+            pairing.idle_servers.append(server)
+        elif pairing.is_finished():
+            # このペアリングではもう対局しないので、エンジンを終了させてメモリを空ける。
+            self.release_servers(pairing)
+            if self.pairing_finished_callback is not None:
+                self.pairing_finished_callback(pairing)
+            # ペアリングの結果を反映させたあとの状態を保存しておく。
+            self.games_since_checkpoint = self.checkpoint_interval
+
+        # 途中経過の保存
+        self.games_since_checkpoint += 1
+        if (
+            self.checkpoint_path is not None
+            and self.games_since_checkpoint >= self.checkpoint_interval
+        ):
+            self.save_checkpoint()
+
+    # pairingの対局サーバーをすべて終了させる。
+    def release_servers(self, pairing: TournamentPairing):
+        for server in pairing.servers:
+            server.terminate()
+            del self.server_pairing[server]
+        pairing.servers = []
+        pairing.idle_servers = []
+
+    # 内包しているすべての対局サーバーを終了させる。
+    def terminate(self):
+        if self.game_thread is not None:
+            self.game_stop()
+
+    def __del__(self):
+        self.terminate()
+
+
 if __name__ == "__main__":
     # 最低限のテスト用コード
     usi = UsiEngine()
@@ -1,6 +1,17 @@
 import unittest
+import unittest.mock
 import shogi.Ayane as ayane
 import time
+import math
+import random
+import os
+import tempfile
+import socket
+import threading
+import types
+import json
+import sqlite3
+import sys
 
 
 class TestAyane(unittest.TestCase):
@@ -274,6 +285,963 @@ class TestAyane(unittest.TestCase):
 
         server.terminate()
 
+    # SPRTのテスト(エンジンは使わない)
+    def test_ayane7(self):
+        print("test_ayane7 : ")
+
+        sprt = ayane.Sprt(elo0=0, elo1=5, alpha=0.05, beta=0.05)
+
+        # まだ対局数が少ないので判定できない。
+        sprt.win, sprt.draw, sprt.lose = 10, 5, 8
+        sprt.calc()
+        print(sprt.pretty_string)
+        self.assertIsNone(sprt.result)
+
+        # 1P側が明らかに強いのでH1が採択される。
+        sprt.win, sprt.draw, sprt.lose = 600, 300, 400
+        sprt.calc()
+        print(sprt.pretty_string)
+        self.assertEqual(sprt.result, "H1")
+
+        # 互角なのでH0が採択される。
+        sprt.win, sprt.draw, sprt.lose = 10000, 10000, 10000
+        sprt.calc()
+        print(sprt.pretty_string)
+        self.assertEqual(sprt.result, "H0")
+
+    # 先後入れ替えたペアの結果(pentanomial)からレーティング差を計算するテスト(エンジンは使わない)
+    def test_ayane8(self):
+        print("test_ayane8 : ")
+
+        elo = ayane.EloRating()
+        elo.player1_win, elo.draw_games, elo.player2_win = 110, 20, 70
+        # ペアの勝ち点の合計が 0 , 0.5 , 1 , 1.5 , 2 のペアの数
+        elo.pentanomial = [10, 5, 40, 15, 30]
+        elo.calc()
+        print(elo.pretty_string)
+
+        # 1局あたりの勝ち点の平均は (5*0.5 + 40*1 + 15*1.5 + 30*2) / 100 / 2 = 0.625
+        self.assertAlmostEqual(elo.pentanomial_score, 0.625)
+        self.assertTrue(
+            elo.pentanomial_lowerbound < elo.pentanomial_rating < elo.pentanomial_upperbound
+        )
+
+        # SPRTもpentanomialから計算できる。(同じ分布で200ペア)
+        sprt = ayane.Sprt(elo0=0, elo1=10)
+        sprt.pentanomial = [count * 2 for count in elo.pentanomial]
+        sprt.calc()
+        print(sprt.pretty_string)
+        self.assertEqual(sprt.result, "H1")
+
+    def test_ayane9(self):
+        print("test_ayane9 : ")
+
+        # 固定したD(1500)に75%勝つAは、1500 + 400 * log10(3)
+        bt = ayane.BradleyTerryRating()
+        bt.prior_draws = 0
+        bt.fix("D", 1500)
+        bt.add_result("A", "D", 60, 0, 20)
+        # AとBは互角
+        bt.add_result("B", "A", 30, 10, 30)
+        bt.calc()
+        print(bt.to_string())
+
+        self.assertAlmostEqual(bt.ratings["A"], 1500 + 400 * math.log10(3), places=3)
+        self.assertAlmostEqual(bt.ratings["A"], bt.ratings["B"], places=3)
+        self.assertEqual(bt.ratings["D"], 1500)
+        self.assertTrue(bt.lowerbounds["A"] < bt.ratings["A"] < bt.upperbounds["A"])
+        # Dと直接対局していないBのほうが信頼区間は広い。
+        self.assertTrue(
+            bt.upperbounds["B"] - bt.lowerbounds["B"]
+            > bt.upperbounds["A"] - bt.lowerbounds["A"]
+        )
+        # レーティングが近く、どちらも不確かなAとBの対局が最も情報が得られる。
+        self.assertEqual(
+            bt.most_informative([("A", "D"), ("B", "D"), ("A", "B")]), ("A", "B")
+        )
+
+    def test_ayane10(self):
+        print("test_ayane10 : ")
+
+        with tempfile.TemporaryDirectory() as folder:
+            store = ayane.ResultStore(os.path.join(folder, "results.db"))
+            store.start_run("unit_test1.py", {})
+
+            # Aの2勝1敗1分(1局目と3局目はAが後手)
+            results = [
+                (True, ayane.GameResult.WHITE_WIN),
+                (False, ayane.GameResult.BLACK_WIN),
+                (True, ayane.GameResult.BLACK_WIN),
+                (False, ayane.GameResult.MAX_MOVES),
+            ]
+            for flip_turn, result in results:
+                kifu = ayane.GameKifu()
+                kifu.start_sfen = "startpos moves 7g7f"
+                kifu.sfen = "startpos moves 7g7f 3c3d 2g2f"
+                kifu.flip_turn = flip_turn
+                kifu.game_result = result
+                store.add_game(kifu, ["A", "B"], [{}, {}], "byoyomi 100")
+            store.close()
+
+            elo = store.game_rating("A", "B")
+            print(elo.pretty_string)
+            self.assertEqual(
+                (elo.player1_win, elo.draw_games, elo.player2_win), (2, 1, 1)
+            )
+            # Bから見れば勝ち負けが逆になる。
+            self.assertEqual(store.game_rating("B", "A").player1_win, 1)
+            self.assertEqual(store.pair_results(), [("A", "B", 2, 1, 1)])
+            # 開始局面以降の指し手だけが記録される。
+            self.assertEqual(
+                store.query("SELECT move FROM moves WHERE game_id = 1"),
+                [("3c3d",), ("2g2f",)],
+            )
+
+    # MatchCoordinatorの対局の割り当てと、落ちたワーカーの対局の割り当て直しのテスト
+    # (socketは用いずに、handle_request()を直接呼び出す)
+    def test_ayane11(self):
+        print("test_ayane11 : ")
+
+        coordinator = ayane.MatchCoordinator()
+        coordinator.start_sfens = ["startpos", "startpos moves 7g7f"]
+        coordinator.paired_openings = True
+        coordinator.max_games = 4
+        coordinator.init_engine(0, "exe/A.exe", {"Threads": "1"})
+        coordinator.init_engine(1, "exe/B.exe", {"Threads": "1"})
+        coordinator.init_results()
+
+        w1 = coordinator.handle_request({"command": "hello", "name": "w1"})["worker_id"]
+        w2 = coordinator.handle_request({"command": "hello", "name": "w2"})["worker_id"]
+
+        # 1つ目のペアの1局目と2局目は、同じ開始局面を先後入れ替えたもの
+        game1 = coordinator.handle_request({"command": "assign", "worker_id": w1})["game"]
+        game2 = coordinator.handle_request({"command": "assign", "worker_id": w2})["game"]
+        self.assertEqual(game1["sfen"], game2["sfen"])
+        self.assertEqual((game1["flip_turn"], game2["flip_turn"]), (False, True))
+
+        # w2が落ちたら、その対局はw1に割り当て直される。落ちたw2からの結果は集計しない。
+        coordinator.remove_worker(w2, "timeout")
+        game3 = coordinator.handle_request({"command": "assign", "worker_id": w1})["game"]
+        self.assertEqual((game3["sfen"], game3["flip_turn"]), (game2["sfen"], True))
+
+        kifu = ayane.GameKifu()
+        kifu.sfen = game1["sfen"]
+        kifu.game_result = ayane.GameResult.BLACK_WIN
+        stale = {
+            "command": "result",
+            "worker_id": w2,
+            "game_id": game2["game_id"],
+            "kifu": kifu.to_dict(),
+        }
+        self.assertIn("error", coordinator.handle_request(stale))
+
+        # 1P側が2局とも先手で勝った
+        for game in [game1, game3]:
+            kifu.game_result = (
+                ayane.GameResult.WHITE_WIN if game["flip_turn"] else ayane.GameResult.BLACK_WIN
+            )
+            reply = coordinator.handle_request(
+                {
+                    "command": "result",
+                    "worker_id": w1,
+                    "game_id": game["game_id"],
+                    "kifu": kifu.to_dict(),
+                }
+            )
+            self.assertTrue(reply["accepted"])
+        self.assertEqual(coordinator.total_games, 2)
+        self.assertEqual(coordinator.pentanomial, [0, 0, 0, 0, 1])
+
+        # max_games局を超えて割り当てない。
+        coordinator.handle_request({"command": "assign", "worker_id": w1})
+        coordinator.handle_request({"command": "assign", "worker_id": w1})
+        reply = coordinator.handle_request({"command": "assign", "worker_id": w1})
+        self.assertIsNone(reply["game"])
+
+    # UsiSocketTransportを用いたUsiEngineのテスト
+    # (socket.socketpair()の片側でエンジンの代わりに応答する)
+    def test_ayane12(self):
+        print("test_ayane12 : ")
+
+        engine_side, harness_side = socket.socketpair()
+        received = []
+
+        def fake_engine():
+            f = engine_side.makefile("rw", encoding="utf-8", newline="\n")
+            for line in f:
+                command = line.strip()
+                received.append(command)
+                if command == "isready":
+                    f.write("readyok\n")
+                elif command.startswith("go"):
+                    f.write("info depth 1 score cp 42 pv 7g7f\nbestmove 7g7f\n")
+                elif command == "quit":
+                    break
+                f.flush()
+            f.close()
+            engine_side.close()
+
+        thread = threading.Thread(target=fake_engine)
+        thread.start()
+
+        usi = ayane.UsiEngine()
+        usi.set_engine_options({"Threads": "1"})
+        usi.connect_transport(ayane.UsiSocketTransport(harness_side))
+        usi.wait_for_state(ayane.UsiEngineState.WaitCommand)
+        usi.usi_position("startpos")
+        usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+        self.assertEqual(usi.think_result.bestmove, "7g7f")
+        self.assertEqual(usi.think_result.pvs[0].eval, 42)
+        self.assertIsNone(usi.pid())
+
+        usi.disconnect()
+        thread.join()
+        self.assertEqual(
+            received,
+            [
+                "setoption name Threads value 1",
+                "isready",
+                "position startpos",
+                "go btime 0 wtime 0 byoyomi 100",
+                "quit",
+            ],
+        )
+
+
+    def test_ayane13(self):
+        print("test_ayane13 : ")
+
+        # FakeUsiEngineと、スレッド内で対局させる。
+        server = ayane.AyaneruServer()
+        for engine in server.engines:
+            engine.set_engine_options({"FakeResignPly": "10", "FakeInfoLines": "2"})
+            engine.connect_transport(ayane.FakeUsiEngine.start_transport(), "FakeUsiEngine")
+        server.set_time_setting("byoyomi 100")
+        server.game_start()
+        while not server.game_result.is_gameover():
+            time.sleep(0.01)
+
+        # 10手指したあと、11手目を指す側が投了する。
+        self.assertEqual(server.game_ply, 11)
+        self.assertTrue(server.game_result.is_gameover())
+        self.assertGreater(server.engines[0].received_lines, 10)
+        # 1手ごとに、指した側のエンジンの最後の読み筋の深さなどが記録される。
+        kifu = server.game_kifu()
+        self.assertEqual(len(kifu.depths), 10)
+        self.assertEqual(kifu.depths[0], 2)
+        server.terminate()
+
+        # MultiAyaneruServerは、終局したらすぐに次の対局を開始する。(1秒ごとにpollingしない)
+        server = ayane.MultiAyaneruServer()
+        server.init_server(2)
+        for s in server.servers:
+            for engine in s.engines:
+                engine.set_engine_options({"FakeResignPly": "10", "FakeInfoLines": "2"})
+                engine.connect_transport(ayane.FakeUsiEngine.start_transport(), "FakeUsiEngine")
+        server.set_time_setting("byoyomi 100")
+        start_time = time.time()
+        server.game_start()
+        while server.total_games < 10 and time.time() - start_time < 10:
+            time.sleep(0.01)
+        elapsed = time.time() - start_time
+        server.game_stop()
+        self.assertGreaterEqual(server.total_games, 10)
+        self.assertLess(elapsed, 2)
+
+    def test_ayane14(self):
+        print("test_ayane14 : ")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # FakeUsiEngineとのやりとりを記録する。
+            path = os.path.join(tmp, "transcript.txt")
+            usi = ayane.UsiEngine()
+            usi.transcript_path = path
+            usi.set_engine_options({"FakeInfoLines": "3", "MultiPV": "2"})
+            usi.connect_transport(ayane.FakeUsiEngine.start_transport())
+            usi.wait_for_state(ayane.UsiEngineState.WaitCommand)
+            bestmoves = []
+            for _ in range(2):
+                usi.usi_position("startpos")
+                usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+                bestmoves.append(usi.think_result.bestmove)
+            usi.disconnect()
+
+            entries = ayane.UsiTranscript.read(path)
+            self.assertEqual(entries[0][1:], ("<", "setoption name FakeInfoLines value 3"))
+            self.assertEqual(len([e for e in entries if e[2].startswith("info")]), 2 * 3 * 2)
+
+            # 記録したとおりに再生される。末尾まで行ったら先頭に戻る。
+            usi.connect_transport(ayane.ReplayUsiEngine.start_transport(path, 0))
+            usi.wait_for_state(ayane.UsiEngineState.WaitCommand)
+            for i in range(3):
+                usi.usi_position("startpos")
+                usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+                self.assertEqual(usi.think_result.bestmove, bestmoves[i % 2])
+                self.assertEqual(len(usi.think_result.pvs), 2)
+            usi.disconnect()
+
+    def test_ayane15(self):
+        print("test_ayane15 : ")
+
+        with self.assertRaises(ValueError):
+            ayane.Profiler("perf")
+
+        profiler = ayane.Profiler("cprofile", 60)
+        profiler.gauges["items"] = lambda: 3
+        profiler.start()
+        thread = threading.Thread(target=profiler.wrap("worker", lambda: sum(range(10000))))
+        thread.start()
+        thread.join()
+        self.assertEqual(profiler.measure("add", lambda a, b: a + b, 1, 2), 3)
+        self.assertEqual(profiler.measure("add", lambda a, b: a + b, 3, 4), 7)
+        profiler.stop()
+
+        self.assertEqual(profiler.timers["worker"][0], 1)
+        self.assertEqual(profiler.timers["add"][0], 2)
+        self.assertEqual(len(profiler.memory_samples), 2)
+        self.assertEqual(profiler.memory_samples[-1][2], {"items": 3})
+        report = profiler.report()
+        self.assertIn("worker", report)
+        self.assertIn("cProfile", report)
+        self.assertIn("memory growth", report)
+
+    def test_ayane16(self):
+        print("test_ayane16 : ")
+
+        usi = ayane.UsiEngine()
+        recorder = ayane.PvTraceRecorder()
+        usi.pv_recorder = recorder
+        usi.think_result = ayane.UsiThinkResult()
+
+        recorder.begin_search("startpos")
+        usi.handle_info("info depth 1 seldepth 2 score cp 30 nodes 100 time 1 pv 7g7f 3c3d")
+        usi.handle_info("info depth 2 seldepth 4 score cp 12 lowerbound nodes 900 time 3 pv 2g2f")
+        usi.handle_info("info string hello")
+        recorder.begin_search("startpos moves 7g7f")
+        usi.handle_info("info depth 5 score mate 3 multipv 2 nodes 5000 time 9 pv 3c3d 2g2f 8c8d")
+        usi.handle_info("info depth 6 nodes 7000")
+
+        self.assertEqual(len(recorder), 4)
+        self.assertEqual(recorder.searches(), 2)
+        self.assertEqual(recorder.search_range(0), (0, 2))
+        self.assertEqual(recorder.search_range(1), (2, 4))
+        self.assertEqual(list(recorder.depth), [1, 2, 5, 6])
+        self.assertEqual(recorder.eval[1], 12)
+        self.assertEqual(recorder.eval[2], ayane.UsiEvalValue.mate_in_ply(3))
+        self.assertEqual(recorder.eval[3], ayane.PvTraceRecorder.NO_VALUE)
+        self.assertEqual(recorder.bound[1], ayane.UsiBound.BoundLower.value)
+        self.assertEqual(list(recorder.multipv), [1, 1, 2, 1])
+        self.assertEqual(recorder.pv(2), ["3c3d", "2g2f", "8c8d"])
+        self.assertEqual(recorder.pv(3), [])
+        # 同じ指し手は同じ番号になる。
+        self.assertEqual(len(recorder.move_names), 4)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "pv.trace")
+            recorder.save(path)
+            loaded = ayane.PvTraceRecorder.load(path)
+        self.assertEqual(loaded.columns(), recorder.columns())
+        self.assertEqual(loaded.search_positions, ["startpos", "startpos moves 7g7f"])
+        self.assertEqual(loaded.pv(0), ["7g7f", "3c3d"])
+
+    def test_ayane17(self):
+        print("test_ayane17 : ")
+
+        kifu = ayane.GameKifu()
+        kifu.start_sfen = "startpos"
+        kifu.sfen = "startpos moves 7g7f 3c3d"
+        kifu.game_result = ayane.GameResult.BLACK_WIN
+        pv = ayane.UsiThinkPV()
+        pv.eval = ayane.UsiEvalValue(35)
+        pv.depth = "12"
+        pv.nodes = "123456"
+        kifu.add_ply(None, None)
+        kifu.add_ply(pv, 980)
+        self.assertEqual(kifu.ply_values(0)["evals"], None)
+        self.assertEqual(kifu.ply_values(1)["evals"], 35)
+        self.assertEqual(kifu.ply_values(1)["nps"], None)
+        self.assertEqual(kifu.ply_values(2)["depths"], None)
+
+        restored = ayane.GameKifu.from_dict(json.loads(json.dumps(kifu.to_dict())))
+        self.assertEqual(restored.depths, kifu.depths)
+        self.assertEqual(restored.think_times.typecode, "q")
+
+        with tempfile.TemporaryDirectory() as folder:
+            # 評価値などの列がなかったころのデータベースは、開いたときに列が追加される。
+            path = os.path.join(folder, "results.db")
+            connection = sqlite3.connect(path)
+            connection.executescript(
+                "CREATE TABLE games (game_id INTEGER PRIMARY KEY AUTOINCREMENT , run_id TEXT , player1 TEXT , player2 TEXT ,"
+                " options1 TEXT , options2 TEXT , time_setting TEXT , start_sfen TEXT , flip_turn INTEGER , result INTEGER ,"
+                " player1_score REAL , plies INTEGER , pair_id INTEGER , start_time REAL , end_time REAL , sfen TEXT);"
+                "CREATE TABLE moves (game_id INTEGER , ply INTEGER , move TEXT , PRIMARY KEY (game_id , ply)) WITHOUT ROWID;"
+                "INSERT INTO moves VALUES (100 , 0 , '7g7f');"
+            )
+            connection.close()
+
+            store = ayane.ResultStore(path)
+            store.add_game(kifu, ["A", "B"], [{}, {}], "byoyomi 1000")
+            store.close()
+            self.assertEqual(store.query("PRAGMA user_version"), [(1,)])
+            self.assertEqual(
+                store.query("SELECT move , eval , depth , think_time FROM moves ORDER BY game_id , ply"),
+                [("7g7f", None, None, None), ("3c3d", 35, 12, 980), ("7g7f", None, None, None)],
+            )
+
+    def test_ayane18(self):
+        print("test_ayane18 : ")
+
+        analyzer = ayane.KifuAnalyzer()
+        analyzer.parallel = 2
+        analyzer.multipv = 2
+        analyzer.go_options = "btime 0 wtime 0 byoyomi 100"
+        analyzer.connect_engine = lambda engine: engine.connect_transport(
+            ayane.FakeUsiEngine.start_transport(), "FakeUsiEngine"
+        )
+        games = ["startpos moves 7g7f 3c3d", "", "position sfen lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"]
+        self.assertEqual(
+            analyzer.positions_of(games[0]),
+            [(0, "startpos", "7g7f"), (1, "startpos moves 7g7f", "3c3d"), (2, "startpos moves 7g7f 3c3d", None)],
+        )
+        self.assertEqual(analyzer.count_positions(games), 4)
+
+        with tempfile.TemporaryDirectory() as folder:
+            # 途中まで解析した(最後の行は書き込み途中で中断された)出力ファイルから再開する。
+            analyzer.output_path = os.path.join(folder, "analysis.jsonl")
+            with open(analyzer.output_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"game": 0, "ply": 1, "pvs": []}) + "\n")
+                f.write('{"game": 0, "pl')
+            progress = []
+            analyzer.analyze(games, lambda done, total: progress.append((done, total)), 4)
+            self.assertEqual((analyzer.skipped, analyzer.analyzed), (1, 3))
+            self.assertEqual(progress[-1], (4, 4))
+
+            with open(analyzer.output_path, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            results = {}
+            for line in lines:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                results[(result["game"], result["ply"])] = result
+            self.assertEqual(sorted(results), [(0, 0), (0, 1), (0, 2), (2, 0)])
+            self.assertEqual(results[(0, 0)]["move"], "7g7f")
+            self.assertIsNotNone(results[(0, 2)]["bestmove"])
+            self.assertEqual([pv["multipv"] for pv in results[(2, 0)]["pvs"]], [1, 2])
+
+            # すべて解析済みなら、エンジンには何も解析させない。
+            analyzer.analyze(games)
+            self.assertEqual((analyzer.skipped, analyzer.analyzed), (4, 0))
+
+        with self.assertRaises(ValueError):
+            analyzer.positions_of("7g7f 3c3d")
+
+        # エンジンが起動できなかったり、解析中に接続が切れたりしたら、止まらずに例外を投げる。
+        analyzer = ayane.KifuAnalyzer()
+        analyzer.parallel = 2
+        analyzer.engine_path = "/nonexistent/engine"
+        with self.assertRaises(FileNotFoundError):
+            analyzer.analyze(["startpos moves " + " ".join(["7g7f", "3c3d"] * 20)] * 20)
+
+        with tempfile.TemporaryDirectory() as folder:
+            # "go"を受け取ると、bestmoveを返さずに終了するエンジン
+            path = os.path.join(folder, "crash.py")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(
+                    "import sys\n"
+                    "for line in sys.stdin:\n"
+                    "    if line.startswith('usi'):\n"
+                    "        print('usiok', flush=True)\n"
+                    "    elif line.startswith('isready'):\n"
+                    "        print('readyok', flush=True)\n"
+                    "    elif line.startswith('go'):\n"
+                    "        sys.exit(1)\n"
+                )
+            analyzer.connect_engine = lambda engine: engine.connect_transport(
+                ayane.UsiProcessTransport('"{0}" "{1}"'.format(sys.executable, path), folder)
+            )
+            with self.assertRaises(ValueError):
+                analyzer.analyze(["startpos moves " + " ".join(["7g7f", "3c3d"] * 20)] * 20)
+            self.assertEqual(analyzer.analyzed, 0)
+
+    def test_ayane19(self):
+        print("test_ayane19 : ")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # 思考時間0、読み筋なしで、"go"に対してすぐに"bestmove"を返すエンジンとのやりとりを記録する。
+            path = os.path.join(tmp, "transcript.txt")
+            usi = ayane.UsiEngine()
+            usi.transcript_path = path
+            usi.tracer = ayane.ChromeTracer()
+            usi.set_engine_options({"FakeInfoLines": "0"})
+            usi.connect_transport(ayane.FakeUsiEngine.start_transport())
+            usi.wait_for_state(ayane.UsiEngineState.WaitCommand)
+            # 送信から戻ってくるのを遅らせて、その間に応答が届くようにする。
+            write = usi.transport.write
+            usi.transport.write = lambda line: (write(line), time.sleep(0.005))
+            bestmoves = []
+            for i in range(30):
+                usi.usi_position("startpos moves " + " ".join(["7g7f", "3c3d"][: i % 3]))
+                usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+                bestmoves.append(usi.think_result.bestmove)
+            usi.disconnect()
+
+            # traceの"go"の区間も、送信する前に開始して"bestmove"で閉じている。
+            spans = [e["name"] for e in usi.tracer.events if e.get("cat") == "engine"]
+            self.assertEqual(spans[spans.index("position"):], ["position", "go", "wait"] * 30)
+
+            # 応答は、必ずそれを返させたコマンドのあとに記録されている。
+            command = None
+            for _, direction, message in ayane.UsiTranscript.read(path):
+                if direction == "<":
+                    command = message.split()[0]
+                elif message.startswith("bestmove"):
+                    self.assertEqual(command, "go")
+                elif message == "readyok":
+                    self.assertEqual(command, "isready")
+
+            usi.connect_transport(ayane.ReplayUsiEngine.start_transport(path, 0))
+            usi.wait_for_state(ayane.UsiEngineState.WaitCommand)
+            for i in range(30):
+                usi.usi_position("startpos moves " + " ".join(["7g7f", "3c3d"][: i % 3]))
+                usi.usi_go_and_wait_bestmove("btime 0 wtime 0 byoyomi 100")
+                self.assertEqual(usi.think_result.bestmove, bestmoves[i])
+            usi.disconnect()
+
+    def test_ayane20(self):
+        print("test_ayane20 : ")
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "results.db")
+            store = ayane.ResultStore(path)
+            self.assertTrue(store.write_thread.daemon)
+            kifu = ayane.GameKifu()
+            kifu.start_sfen = "startpos"
+            kifu.sfen = "startpos moves 7g7f"
+            kifu.game_result = ayane.GameResult.BLACK_WIN
+
+            # 書き込みに失敗したら、flush()で例外が投げられる。書き込みスレッドは止まらない。
+            connection = sqlite3.connect(path)
+            connection.execute("DROP TABLE moves")
+            connection.close()
+            store.add_game(kifu, ["A", "B"], [{}, {}], "byoyomi 100")
+            with self.assertRaises(sqlite3.OperationalError):
+                store.flush()
+            self.assertEqual(store.query("SELECT COUNT(*) FROM games"), [(0,)])
+
+            connection = sqlite3.connect(path)
+            connection.executescript(ayane.ResultStore.SCHEMA)
+            connection.close()
+            store.add_game(kifu, ["A", "B"], [{}, {}], "byoyomi 100")
+            store.flush()
+            store.close()
+            self.assertEqual(store.query("SELECT COUNT(*) FROM games"), [(1,)])
+
+    def test_ayane21(self):
+        print("test_ayane21 : ")
+
+        def make_kifu(result):
+            kifu = ayane.GameKifu()
+            kifu.start_sfen = "startpos"
+            kifu.sfen = "startpos moves 7g7f"
+            kifu.game_result = result
+            return kifu
+
+        with tempfile.TemporaryDirectory() as folder:
+            server = ayane.MultiAyaneruServer()
+            server.kifu_path = os.path.join(folder, "colosseum.checkpoint.kifu")
+            server.init_results()
+            server.count_game(make_kifu(ayane.GameResult.BLACK_WIN))
+            server.count_game(make_kifu(ayane.GameResult.WHITE_WIN))
+
+            # checkpointには棋譜は含まれず、棋譜のファイルのどこまで書いたかだけが含まれる。
+            state = json.loads(json.dumps(server.checkpoint()))
+            self.assertNotIn("game_kifus", state)
+            self.assertEqual(state["kifu_offset"], os.path.getsize(server.kifu_path))
+
+            # checkpointのあとに終局した対局は、再開したときに捨てられる。(指し直しになる)
+            server.count_game(make_kifu(ayane.GameResult.MAX_MOVES))
+            resumed = ayane.MultiAyaneruServer()
+            resumed.kifu_path = server.kifu_path
+            resumed.restore(state)
+            resumed.init_results()
+            self.assertEqual(resumed.total_games, 2)
+            self.assertEqual(
+                [kifu.game_result for kifu in resumed.game_kifus],
+                [ayane.GameResult.BLACK_WIN, ayane.GameResult.WHITE_WIN],
+            )
+            self.assertEqual(os.path.getsize(server.kifu_path), state["kifu_offset"])
+
+            # restore()しないで開始したら、棋譜のファイルは空にされる。
+            resumed.count_game(make_kifu(ayane.GameResult.MAX_MOVES))
+            restarted = ayane.MultiAyaneruServer()
+            restarted.kifu_path = server.kifu_path
+            restarted.init_results()
+            self.assertEqual(os.path.getsize(server.kifu_path), 0)
+
+            # 集計してcheckpointを保存するとき、対局中のペアの対局と、終局したがまだ集計していないペアの対局は、
+            # 再開後に指し直す。集計した対局は指し直さない。
+            def make_server(server_id, pair_id, result):
+                kifu = make_kifu(result)
+                kifu.pair_id = pair_id
+                return types.SimpleNamespace(
+                    server_id=server_id, pair_id=pair_id, opening_index=pair_id, flip_turn=False,
+                    game_result=result, game_kifu=lambda: kifu,
+                )
+
+            def start_server(s):
+                s.pair_id, s.opening_index, s.flip_turn = 3, 3, False
+                s.game_result = ayane.GameResult.PLAYING
+
+            server = ayane.MultiAyaneruServer()
+            server.paired_openings = True
+            server.checkpoint_path = os.path.join(folder, "colosseum.checkpoint")
+            server.checkpoint_interval = 1
+            server.init_results()
+            server.servers = [
+                make_server(0, 0, ayane.GameResult.BLACK_WIN),
+                make_server(1, 1, ayane.GameResult.WHITE_WIN),
+                make_server(2, 2, ayane.GameResult.PLAYING),
+                make_server(3, 4, ayane.GameResult.INIT),
+            ]
+            with unittest.mock.patch.object(server, "start_server", start_server):
+                server.restart_server(server.servers[0])
+            state = ayane.Checkpoint.load(server.checkpoint_path)["server"]
+            self.assertEqual(state["total_games"], 1)
+            self.assertEqual(
+                [tuple(game) for game in state["pending_pair_games"]],
+                [(3, 3, False), (1, 1, False), (2, 2, False)],
+            )
+
+    # MatchCoordinatorの、切れた接続の後始末のテスト(socketpairでconnection_worker()を直接動かす)
+    def test_ayane22(self):
+        print("test_ayane22 : ")
+
+        coordinator = ayane.MatchCoordinator()
+        coordinator.init_results()
+        for i in range(3):
+            server_side, worker_side = socket.socketpair()
+            thread = threading.Thread(
+                target=coordinator.connection_worker, args=(server_side, "worker")
+            )
+            coordinator.connections.append((server_side, thread))
+            thread.start()
+
+            f = worker_side.makefile("rwb")
+            ayane.MatchCoordinator.send_message(f, {"command": "hello", "name": "w"})
+            self.assertEqual(ayane.MatchCoordinator.recv_message(f)["worker_id"], i)
+            self.assertEqual(len(coordinator.connections), 1)
+
+            # MatchWorkerが切断したら、接続とそのワーカーは取り除かれる。
+            f.close()
+            worker_side.close()
+            thread.join()
+            self.assertEqual(coordinator.connections, [])
+            self.assertEqual(coordinator.workers, {})
+
+    # ConcurrencyControllerの、対局サーバー数を増減させる判断のテスト(終局した対局サーバーの代わりに、必要な属性だけを持つものを渡す)
+    def test_ayane23(self):
+        print("test_ayane23 : ")
+
+        def game(nps=1000, max_time_excess=0, timeup=False):
+            return types.SimpleNamespace(
+                timeup=timeup, max_time_excess=max_time_excess, nps_total=nps, nps_count=1
+            )
+
+        def play(controller, games, **kwargs):
+            return [controller.on_game_end(game(**kwargs)) for _ in range(games)]
+
+        controller = ayane.ConcurrencyController(1, 0)
+        controller.initial_servers = 2
+        controller.window_games = 3
+        # load averageは環境によるので、常に上限未満になるようにしておく。
+        controller.max_load = 1e9
+        self.assertEqual(controller.start(4), 2)
+
+        # window_games局ごとに、npsが落ちていなければ1つずつ増やす。用意された数(4)より多くはしない。
+        self.assertEqual(play(controller, 3, nps=1000), [2, 2, 3])
+        self.assertEqual(play(controller, 3, nps=950), [3, 3, 4])
+        self.assertEqual(play(controller, 3, nps=1000), [4, 4, 4])
+
+        # npsが最初の0.9倍を下回ったら減らして、以降はその数より増やさない。
+        self.assertEqual(play(controller, 3, nps=800), [4, 4, 3])
+        self.assertEqual(controller.ceiling, 3)
+        self.assertEqual(play(controller, 3, nps=1000), [3, 3, 3])
+
+        # 時間超過はすぐに減らす。min_serversより少なくはしない。
+        self.assertEqual(play(controller, 1, max_time_excess=300), [2])
+        self.assertEqual(play(controller, 2, timeup=True), [1, 1])
+        self.assertEqual(controller.ceiling, 1)
+        self.assertEqual(len(controller.history), 5)
+
+        # load averageが上限以上なら増やさない。
+        controller = ayane.ConcurrencyController(1, 3)
+        controller.initial_servers = 1
+        controller.window_games = 2
+        controller.max_load = -1
+        self.assertEqual(controller.start(8), 1)
+        self.assertEqual(controller.ceiling, 3)
+        self.assertEqual(play(controller, 4), [1, 1, 1, 1])
+        controller.max_load = 1e9
+        self.assertEqual(play(controller, 2), [1, 2])
+
+    # OpeningBookの行の参照、indexファイルの再利用と作り直し、開始局面の打ち切りと重複の除去のテスト
+    def test_ayane24(self):
+        print("test_ayane24 : ")
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "book.sfen")
+            with open(path, "wb") as f:
+                f.write(
+                    b"startpos moves 7g7f 3c3d 2g2f\r\n"
+                    b"\n"
+                    b"  startpos moves 7g7f 3c3d 8c8d\n"
+                    b"startpos moves 2g2f 8c8d\n"
+                    b"startpos moves 7g7f 3c3d 2g2f"
+                )
+
+            # 空行と前後の空白は除かれる。
+            book = ayane.OpeningBook(path)
+            self.assertEqual(len(book), 4)
+            self.assertEqual(book[1], "startpos moves 7g7f 3c3d 8c8d")
+            self.assertEqual(book[3], "startpos moves 7g7f 3c3d 2g2f")
+            self.assertTrue(os.path.exists(path + ".idx"))
+
+            # 打ち切った結果が同じ行は1つにまとめられる。
+            self.assertEqual(list(book.start_sfens(0)), [book[0], book[1], book[2]])
+            self.assertEqual(
+                list(book.start_sfens(2)), ["startpos moves 7g7f", "startpos moves 2g2f"]
+            )
+            self.assertEqual(list(book.start_sfens(1)), ["startpos"])
+            book.close()
+
+            # 2回目からはindexファイルを読み込むので、indexを作り直さない。
+            with unittest.mock.patch.object(
+                ayane.OpeningBook, "build_line_index", side_effect=AssertionError
+            ), unittest.mock.patch.object(
+                ayane.OpeningBook, "build_truncated_index", side_effect=AssertionError
+            ):
+                book = ayane.OpeningBook(path)
+                self.assertEqual(book[2], "startpos moves 2g2f 8c8d")
+                self.assertEqual(len(book.start_sfens(2)), 2)
+                book.close()
+
+            # 定跡ファイルが変わったら、indexは作り直される。
+            with open(path, "wb") as f:
+                f.write(b"startpos moves 5g5f\nstartpos moves 5g5f\nstartpos moves 7g7f 8c8d\n")
+            book = ayane.OpeningBook(path)
+            self.assertEqual(len(book), 3)
+            self.assertEqual(book[2], "startpos moves 7g7f 8c8d")
+            self.assertEqual(
+                list(book.start_sfens(2)), ["startpos moves 5g5f", "startpos moves 7g7f"]
+            )
+            book.close()
+
+    # SharedBookの指し手の選択と、OpeningBookViewが定跡ファイルの行と同じものを返すことのテスト
+    def test_ayane25(self):
+        print("test_ayane25 : ")
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "book.sfen")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("startpos moves 7g7f 3c3d 2g2f\n")
+                f.write("startpos moves 7g7f 8c8d 2g2f\n")
+                f.write("startpos moves 7g7f 3c3d 6g6f\n")
+                f.write("startpos moves 2g2f 8c8d\n")
+
+            # 重複のない定跡なら、打ち切らない開始局面はそのまま定跡ファイルの各行になる。
+            book = ayane.OpeningBook(path)
+            view = book.start_sfens(0)
+            self.assertEqual(len(view), len(book))
+            self.assertEqual(list(view), [book[i] for i in range(len(book))])
+            self.assertEqual(view[-1], "startpos moves 2g2f 8c8d")
+            book.close()
+
+            shared = ayane.SharedBook()
+            shared.load(path, 2)
+            # 初期局面、7g7f、2g2fのあとの3局面
+            self.assertEqual(shared.positions, 3)
+            self.assertEqual(shared.probe("startpos moves 2g2f"), "8c8d")
+            self.assertIsNone(shared.probe("startpos moves 7g7f 3c3d"))
+            self.assertIsNone(shared.probe("sfen lnsgkgsnl/9/9/9/9/9/9/9/LNSGKGSNL b - 1"))
+            shared.min_count = 3
+            self.assertEqual(shared.probe("startpos"), "7g7f")
+            self.assertIsNone(shared.probe("startpos moves 7g7f"))
+            shared.min_count = 1
+
+            # 1つのinstanceを複数の対局サーバーで共有しても、対局サーバーごとに読み込んでも、同じ乱数なら同じ指し手を選ぶ。
+            positions = ["startpos", "startpos moves 7g7f", "startpos moves 2g2f"] * 20
+            separate = [ayane.SharedBook(), ayane.SharedBook()]
+            for b in separate:
+                b.load(path, 2)
+            random.seed(1)
+            moves_shared = [shared.probe(sfen) for sfen in positions]
+            random.seed(1)
+            moves_separate = [separate[i % 2].probe(sfen) for i, sfen in enumerate(positions)]
+            self.assertEqual(moves_shared, moves_separate)
+            self.assertEqual(set(moves_shared), {"7g7f", "2g2f", "3c3d", "8c8d"})
+
+            # 対局サーバーは、定跡にある局面ではエンジンに思考させずに定跡の指し手を指す。
+            path = os.path.join(folder, "line.sfen")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("startpos moves 5g5f 5c5d 5f5e\n")
+            line = ayane.SharedBook()
+            line.load(path, 2)
+            server = ayane.AyaneruServer()
+            server.book = line
+            for engine in server.engines:
+                engine.set_engine_options({"FakeResignPly": "6", "FakeInfoLines": "1"})
+                engine.connect_transport(ayane.FakeUsiEngine.start_transport(), "FakeUsiEngine")
+            server.set_time_setting("byoyomi 100")
+            server.game_start()
+            while not server.game_result.is_gameover():
+                time.sleep(0.01)
+            kifu = server.game_kifu()
+            self.assertTrue(kifu.sfen.startswith("startpos moves 5g5f 5c5d "))
+            self.assertEqual(list(kifu.depths[:2]), [ayane.GameKifu.NO_VALUE] * 2)
+            self.assertNotEqual(kifu.depths[2], ayane.GameKifu.NO_VALUE)
+            server.terminate()
+
+    # TournamentSchedulerのペアリングの作り方と、空いたコアに対局を詰めていく順番のテスト
+    # (エンジンは起動せずに、start_game()を開始したペアリングを記録するだけのものに置き換える)
+    def test_ayane26(self):
+        print("test_ayane26 : ")
+
+        def make_scheduler():
+            scheduler = ayane.TournamentScheduler()
+            scheduler.cores = 3
+            scheduler.add_engine("A", {}, 2)
+            scheduler.add_engine("B", {}, 1)
+            scheduler.add_engine("C", {}, 1)
+            scheduler.add_engine("D", {}, 4, True)
+            scheduler.add_engine("E", {}, 1, True)
+            scheduler.free_cores = scheduler.cores
+            return scheduler
+
+        started = []
+
+        def start_game(scheduler, pairing):
+            pairing.started_games += 1
+            scheduler.free_cores -= pairing.threads
+            started.append((pairing.player1, pairing.player2))
+
+        def finish(scheduler, p1, p2):
+            pairing = next(
+                p for p in scheduler.pairings
+                if (p.player1, p.player2) == (p1, p2) and p.started_games > p.total_games
+            )
+            pairing.total_games += 1
+            scheduler.free_cores += pairing.threads
+            scheduler.fill_slots()
+
+        scheduler = make_scheduler()
+        # 基準ソフト同士(DとE)は対局させない。スレッド数はcoresまでに抑える。
+        scheduler.make_pairings("roundrobin", 1, 2)
+        self.assertEqual(len(scheduler.pairings), 9)
+        self.assertNotIn((3, 4), [(p.player1, p.player2) for p in scheduler.pairings])
+        self.assertEqual(scheduler.pairings[2].threads, 3)
+        scheduler.make_pairings("gauntlet", 2, 2, 1)
+        self.assertEqual(
+            [(p.player1, p.player2) for p in scheduler.pairings],
+            [(0, 1), (1, 2), (1, 3), (1, 4)] * 2,
+        )
+
+        # 空いたコアに収まるペアリングの対局を、pairingsの順に開始する。
+        scheduler = make_scheduler()
+        scheduler.engines = scheduler.engines[:3]
+        scheduler.make_pairings("roundrobin", 1, 2)
+        with unittest.mock.patch.object(
+            scheduler, "start_game", lambda pairing: start_game(scheduler, pairing)
+        ):
+            scheduler.fill_slots()
+            self.assertEqual(started, [(0, 1), (1, 2)])
+            finish(scheduler, 1, 2)
+            self.assertEqual(started[2:], [(1, 2)])
+            finish(scheduler, 0, 1)
+            self.assertEqual(started[3:], [(0, 1)])
+            finish(scheduler, 1, 2)
+            self.assertEqual(started[4:], [])
+            finish(scheduler, 0, 1)
+            self.assertEqual(started[4:], [(0, 2)])
+            finish(scheduler, 0, 2)
+            finish(scheduler, 0, 2)
+            self.assertEqual(started[5:], [(0, 2)])
+            self.assertTrue(scheduler.is_finished())
+
+        # randomなら、開始していない対局がなくなるたびに、その時点の乱数で次のペアリングを選ぶ。
+        random.seed(7)
+        started.clear()
+        scheduler = make_scheduler()
+        scheduler.engines = scheduler.engines[:3]
+        scheduler.make_pairings("random", 3, 1)
+        with unittest.mock.patch.object(
+            scheduler, "start_game", lambda pairing: start_game(scheduler, pairing)
+        ):
+            scheduler.fill_slots()
+            self.assertEqual(started, [(0, 2)])
+            finish(scheduler, 0, 2)
+            self.assertEqual(started, [(0, 2), (0, 1)])
+            finish(scheduler, 0, 1)
+            self.assertEqual(started, [(0, 2), (0, 1), (0, 2)])
+            finish(scheduler, 0, 2)
+            self.assertEqual(scheduler.pending_pairings, 0)
+            self.assertTrue(scheduler.is_finished())
+
+        # pairing_selectorを設定すれば、それが選んだペアリングになる。
+        started.clear()
+        scheduler = make_scheduler()
+        scheduler.engines = scheduler.engines[:3]
+        scheduler.make_pairings("random", 2, 1)
+        scheduler.pairing_selector = lambda candidates: candidates[-1]
+        with unittest.mock.patch.object(
+            scheduler, "start_game", lambda pairing: start_game(scheduler, pairing)
+        ):
+            scheduler.fill_slots()
+        self.assertEqual(started, [(1, 2), (1, 2)])
+
+    def test_ayane27(self):
+        print("test_ayane27 : ")
+
+        sfens = ["startpos", "startpos moves 7g7f", "startpos moves 2g2f", "startpos moves 7g7f 3c3d"]
+
+        evaluator = ayane.PositionEvaluator()
+        evaluator.engine_path = "/nonexistent/engine"
+        evaluator.parallel = 2
+        with self.assertRaises(FileNotFoundError):
+            evaluator.evaluate(sfens)
+
+        with tempfile.TemporaryDirectory() as folder:
+            # 1回目の"go"にはbestmoveを返して、2回目の"go"を受け取ると終了するエンジン
+            path = os.path.join(folder, "crash.py")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(
+                    "#!{0}\n"
+                    "import sys\n"
+                    "go = 0\n"
+                    "for line in sys.stdin:\n"
+                    "    if line.startswith('usi'):\n"
+                    "        print('usiok', flush=True)\n"
+                    "    elif line.startswith('isready'):\n"
+                    "        print('readyok', flush=True)\n"
+                    "    elif line.startswith('go'):\n"
+                    "        go += 1\n"
+                    "        if go == 2:\n"
+                    "            sys.exit(1)\n"
+                    "        print('info depth 1 score cp 35 pv 7g7f', flush=True)\n"
+                    "        print('bestmove 7g7f', flush=True)\n".format(sys.executable)
+                )
+            os.chmod(path, 0o755)
+
+            # 評価できた局面はcacheに書き出してから、例外を投げる。
+            evaluator.engine_path = path
+            evaluator.parallel = 1
+            evaluator.cache_path = os.path.join(folder, "cache.txt")
+            with self.assertRaises(ValueError):
+                evaluator.evaluate(sfens)
+            self.assertEqual(evaluator.evaluated, 1)
+            with open(evaluator.cache_path, encoding="utf-8") as f:
+                self.assertEqual(f.read(), "35\tstartpos\n")
 
 if __name__ == "__main__":
     unittest.main()